@@ -0,0 +1,446 @@
+import os
+import time
+import shutil
+import torch
+import tempfile
+import tracemalloc
+import heapq
+import logging
+import xml.dom.minidom
+import random
+import numpy as np
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+import traci.constants as tc
+from config import get_config, classify_and_return_args
+from control_env import ControlEnv
+from sim_backend import get_backend_name
+from sim_config import SUMO_PROFILES
+from utils import scale_demand, convert_demand_to_scale_factor
+from demand_table import ROUTES_HEADER, load_demand_table
+
+def run_control_steps(env, num_actions, seed=0):
+    """
+    Run the per step path of the control env (apply action, simulation step, occupancy map, observation, pressures).
+    Actions are random (but seeded) so that both backends see the same sequence.
+    Returns the number of simulation steps and the time it took (excluding reset).
+    """
+    rng = random.Random(seed)
+    env.reset()
+    previous_tl_action = None
+    sim_steps = 0
+    start = time.perf_counter()
+    for _ in range(num_actions):
+        action = torch.tensor([rng.randint(0, 3), rng.randint(0, 1), rng.randint(0, 1)], dtype=torch.long)
+        for action_step in range(env.steps_per_action):
+            env._apply_action(action, action_step, previous_tl_action)
+            env.sim.simulationStep()
+            env.collector.update()
+            env._get_observation()
+            env._update_pressures()
+            sim_steps += 1
+        previous_tl_action = action[0].item()
+    elapsed = time.perf_counter() - start
+    return sim_steps, elapsed
+
+def benchmark_backends(config, num_actions=50, network_iteration='base', seed=0):
+    """
+    Steps/sec of the Craver network (network_iteration_{network_iteration}.net.xml in the network_dir) with traci (socket) and libsumo (in-process). Headless.
+    The demand is fixed (min = max) so that both backends simulate the same traffic.
+    """
+    config = dict(config)
+    config['gui'] = False
+    config['demand_scale_max'] = config['demand_scale_min']
+    _, control_args, _, _ = classify_and_return_args(config, torch.device("cpu"))
+
+    results = {}
+    for use_libsumo in [False, True]:
+        random.seed(seed)
+        np.random.seed(seed)
+        control_args['use_libsumo'] = use_libsumo
+        env = ControlEnv(control_args, worker_id=None, network_iteration=network_iteration)
+        name = get_backend_name(env.sim)
+        if name in results:
+            print("libsumo not available. Skipping.")
+            continue
+        sim_steps, elapsed = run_control_steps(env, num_actions, seed=seed)
+        env.close()
+        results[name] = sim_steps / elapsed
+        print(f"{name}: {sim_steps} steps in {elapsed:.2f}s, {results[name]:.1f} steps/sec")
+
+    if 'traci' in results and 'libsumo' in results:
+        print(f"Speedup (libsumo/ traci): {results['libsumo']/results['traci']:.2f}x")
+    return results
+
+def benchmark_crosswalk_enforcement(config, crosswalk_nums=(3, 4, 5), num_steps=300, seed=0):
+    """
+    Per step cost of enforcing disabled crosswalks at the maximum demand (demand_scale_max): 
+    'python' (reroute persons one at a time every step) vs 'native' (lane permissions, SUMO reroutes).
+    Only the enforcement is timed (not the simulation step itself).
+    The crosswalk_nums are crosswalks of the original Craver network (the generated networks do not have them). 
+    ControlEnv loads network_iteration_{label}.net.xml from the network_dir, so the original net file is copied to a temporary network_dir.
+    """
+    config = dict(config)
+    config['gui'] = False
+    config['demand_scale_min'] = config['demand_scale_max']
+    config['design_mode'] = 'netconvert'
+    _, control_args, _, _ = classify_and_return_args(config, torch.device("cpu"))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as network_dir:
+        shutil.copy(config['original_net_file'], os.path.join(network_dir, 'network_iteration_original.net.xml'))
+        control_args['network_dir'] = network_dir
+        for engine in ['python', 'native']:
+            results[engine] = _time_crosswalk_enforcement(control_args, engine, crosswalk_nums, num_steps, seed)
+    return results
+
+def _time_crosswalk_enforcement(control_args, engine, crosswalk_nums, num_steps, seed):
+    """
+    ms/step spent enforcing the disabled crosswalk_nums with the given engine (benchmark_crosswalk_enforcement).
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    control_args['crosswalk_enforcement'] = engine
+    env = ControlEnv(control_args, worker_id=None, network_iteration='original')
+    env.reset()
+
+    enforcement_time = 0.0
+    num_persons = 0
+    for _ in range(num_steps):
+        start = time.perf_counter()
+        env._set_crosswalks_to_disable(crosswalk_nums) # No-op after the first call
+        env._enforce_crosswalks()
+        enforcement_time += time.perf_counter() - start
+        env.sim.simulationStep()
+        num_persons += env.sim.person.getIDCount()
+    env.close()
+
+    ms_per_step = 1000 * enforcement_time / num_steps
+    print(f"{engine}: {ms_per_step:.3f} ms/step for enforcement (avg. {num_persons/num_steps:.0f} persons in the simulation)")
+    return ms_per_step
+
+def benchmark_pedestrian_status(config, num_steps=1500, report_every=100, network_iteration='base', seed=0):
+    """
+    Size of the pedestrian status store (persons that have crossed) over an episode at the maximum pedestrian demand.
+    With eviction on arrival it should stay flat (bounded by the persons in the simulation) instead of growing with the episode.
+    """
+    config = dict(config)
+    config['gui'] = False
+    config['demand_scale_min'] = config['demand_scale_max']
+    _, control_args, _, _ = classify_and_return_args(config, torch.device("cpu"))
+
+    random.seed(seed)
+    np.random.seed(seed)
+    env = ControlEnv(control_args, worker_id=None, network_iteration=network_iteration)
+    env.reset()
+    sizes = []
+    for step in range(num_steps):
+        env.sim.simulationStep()
+        env.collector.update()
+        env.tl_pedestrian_status.update(env.collector, env.sim)
+        env._get_observation() # Marks the persons that crossed
+        if step % report_every == 0:
+            metrics = env.tl_pedestrian_status.get_metrics()
+            sizes.append(metrics['size'])
+            print(f"Step {step}: {metrics['size']} crossed persons stored ({metrics['memory_bytes']} bytes), {env.sim.person.getIDCount()} persons in the simulation, {metrics['evicted']} evicted")
+    metrics = env.tl_pedestrian_status.get_metrics()
+    env.close()
+    print(f"Peak size: {metrics['peak_size']}, total evicted: {metrics['evicted']}")
+    return sizes
+
+def _read_demand_lines(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read().splitlines()[1:] # Skip the XML declaration (minidom writes it without the encoding)
+
+def scale_demand_dom(input_file, output_file, scale_factor, demand_type):
+    """
+    Older version of scale_demand (parses the whole file, clones the elements and pretty prints with minidom).
+    Only kept here as the reference for benchmark_scale_demand, the output is the same.
+    """
+    # Parse the XML file
+    tree = ET.parse(input_file)
+    root = tree.getroot()
+
+    if demand_type == "vehicle":
+        # Vehicle demand
+        trips = root.findall("trip")
+        for trip in trips:
+            current_depart = float(trip.get('depart'))
+            new_depart = current_depart / scale_factor
+            trip.set('depart', f"{new_depart:.2f}")
+
+        original_trip_count = len(trips)
+        for i in range(1, int(scale_factor)):
+            for trip in trips[:original_trip_count]:
+                new_trip = ET.Element('trip')
+                for attr, value in trip.attrib.items():
+                    if attr == 'id':
+                        new_trip.set(attr, f"{value}_{i}")
+                    elif attr == 'depart':
+                        new_depart = float(value) + (3600 * i / scale_factor)
+                        new_trip.set(attr, f"{new_depart:.2f}")
+                    else:
+                        new_trip.set(attr, value)
+                root.append(new_trip)
+
+    elif demand_type == "pedestrian":
+        # Pedestrian demand
+        persons = root.findall(".//person")
+        for person in persons:
+            current_depart = float(person.get('depart'))
+            new_depart = current_depart / scale_factor
+            person.set('depart', f"{new_depart:.2f}")
+
+        original_person_count = len(persons)
+        for i in range(1, int(scale_factor)):
+            for person in persons[:original_person_count]:
+                new_person = ET.Element('person')
+                for attr, value in person.attrib.items():
+                    if attr == 'id':
+                        new_person.set(attr, f"{value}_{i}")
+                    elif attr == 'depart':
+                        new_depart = float(value) + (3600 * i / scale_factor)
+                        new_person.set(attr, f"{new_depart:.2f}")
+                    else:
+                        new_person.set(attr, value)
+                
+                # Copy all child elements (like <walk>)
+                for child in person:
+                    new_child = ET.SubElement(new_person, child.tag, child.attrib)
+                    # Ensure 'from' attribute is present for walk elements
+                    if child.tag == 'walk' and 'from' not in child.attrib:
+                        # If 'from' is missing, use the first edge in the route
+                        edges = child.get('edges', '').split()
+                        if edges:
+                            new_child.set('from', edges[0])
+                        else:
+                            logging.warning(f"Walk element for person {new_person.get('id')} is missing both 'from' and 'edges' attributes.")
+                
+                # Find the correct parent to append the new person
+                parent = root.find(".//routes")
+                if parent is None:
+                    parent = root
+                parent.append(new_person)
+
+    else:
+        print("Invalid demand type. Please specify 'vehicle' or 'pedestrian'.")
+        return
+
+    # Convert to string
+    xml_str = ET.tostring(root, encoding='unicode')
+   
+    # Pretty print the XML string
+    dom = xml.dom.minidom.parseString(xml_str)
+    pretty_xml_str = dom.toprettyxml(indent="    ")
+   
+    # Remove extra newlines between elements
+    pretty_xml_str = '\n'.join([line for line in pretty_xml_str.split('\n') if line.strip()])
+    
+    # If there are folders in the path that dont exist, create them
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    # Write the formatted XML to the output file
+    # Write to a temporary file first and then rename it. The rename is atomic, SUMO never sees a partially written file (no need to wait after writing).
+    temp_output_file = f"{output_file}.tmp"
+    with open(temp_output_file, 'w', encoding='utf-8') as f:
+        f.write(pretty_xml_str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_output_file, output_file)
+    
+    print(f"{demand_type.capitalize()} demand scaled by factor {scale_factor}.") # Output written to {output_file}")
+
+def _format_attributes(attrib):
+    return ''.join(f' {name}="{escape(value, {chr(34): "&quot;"})}"' for name, value in attrib.items())
+
+def _iter_demand(input_file):
+    """
+    Stream the top level elements of a trips file (iterparse). Yields (tag, attrib, children), children is a list of (tag, attrib).
+    Each element is dropped from the tree once it is read, so memory does not grow with the file.
+    """
+    context = ET.iterparse(input_file, events=('start', 'end'))
+    _, root = next(context)
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0: # A direct child of <routes>
+            yield elem.tag, dict(elem.attrib), [(child.tag, dict(child.attrib)) for child in elem]
+            root.clear()
+
+def _iter_scaled_copy(input_file, scale_factor, demand_type, copy_index):
+    """
+    One copy of the demand, compressed in time by the scale factor and shifted into its own window (copy_index * 3600/ scale_factor).
+    Yields ((depart, copy_index, order), text), the key orders ties by copy and then by the position in the file. Elements without a depart (e.g., vType) are only kept in the first copy and come first.
+    """
+    tags = ('trip', 'vehicle') if demand_type == 'vehicle' else ('person',) # Routed vehicles (duarouter) are <vehicle> with a <route>
+    for order, (elem_tag, attrib, children) in enumerate(_iter_demand(input_file)):
+        if elem_tag not in tags:
+            if copy_index == 0:
+                yield (float('-inf'), copy_index, order), _format_element(elem_tag, attrib, children)
+            continue
+
+        # Same rounding as before: the depart in the first copy is rounded to 2 decimals and the other copies are shifted from that.
+        depart = float(f"{float(attrib['depart']) / scale_factor:.2f}")
+        if copy_index > 0:
+            depart = depart + (3600 * copy_index / scale_factor)
+            attrib['id'] = f"{attrib['id']}_{copy_index}"
+            if demand_type == 'pedestrian':
+                for child_tag, child_attrib in children:
+                    # Ensure 'from' attribute is present for walk elements
+                    if child_tag == 'walk' and 'from' not in child_attrib:
+                        edges = child_attrib.get('edges', '').split()
+                        if edges:
+                            child_attrib['from'] = edges[0]
+                        else:
+                            logging.warning(f"Walk element for person {attrib['id']} is missing both 'from' and 'edges' attributes.")
+        attrib['depart'] = f"{depart:.2f}"
+        yield (float(attrib['depart']), copy_index, order), _format_element(elem_tag, attrib, children)
+
+def _format_element(tag, attrib, children):
+    if not children:
+        return f"    <{tag}{_format_attributes(attrib)}/>\n"
+    lines = [f"    <{tag}{_format_attributes(attrib)}>\n"]
+    lines.extend(f"        <{child_tag}{_format_attributes(child_attrib)}/>\n" for child_tag, child_attrib in children)
+    lines.append(f"    </{tag}>\n")
+    return ''.join(lines)
+
+def scale_demand_streaming(input_file, output_file, scale_factor, demand_type):
+    """
+    Streaming version of scale_demand without a demand table, the baseline in between for benchmark_scale_demand. Same output as scale_demand_dom (the departs are compressed by the scale factor and int(scale_factor) copies fill the hour).
+    Streaming: every copy reads the input with iterparse and the copies are merged by depart time (heapq.merge) while they are written out.
+    - Memory stays flat (one element per copy is held at a time) instead of holding the whole tree, the clones and the pretty printed string.
+    - No minidom round-trip, the elements are written directly in the indented form.
+    - The output stays sorted by depart (SUMO expects that) even if the copies overlap in time.
+    Written to a temporary file and renamed (atomic), SUMO never sees a partially written file.
+    """
+    if demand_type not in ['vehicle', 'pedestrian']:
+        print("Invalid demand type. Please specify 'vehicle' or 'pedestrian'.")
+        return
+
+    copies = [_iter_scaled_copy(input_file, scale_factor, demand_type, i) for i in range(max(1, int(scale_factor)))]
+    merged = heapq.merge(*copies) # Compares the keys only (they are unique)
+
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    temp_output_file = f"{output_file}.tmp"
+    with open(temp_output_file, 'w', encoding='utf-8') as f:
+        f.write(ROUTES_HEADER)
+        for _, text in merged:
+            f.write(text)
+        f.write("</routes>\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_output_file, output_file)
+
+    print(f"{demand_type.capitalize()} demand scaled by factor {scale_factor}.")
+
+def benchmark_scale_demand(config, scale_factors=(1.0, 2.5, 4.0), repeats=3):
+    """
+    Time and peak (python) memory of scaling the trips files: scale_demand (demand table) and scale_demand_streaming vs the older scale_demand_dom.
+    Also checks that all write the same demand.
+    The demand tables are compiled (or loaded) before timing, that happens once per machine (and the mapping once per process).
+    """
+    inputs = [(config['vehicle_input_trips'], 'vehicle'), (config['pedestrian_input_trips'], 'pedestrian')]
+    for input_file, demand_type in inputs:
+        start = time.perf_counter()
+        load_demand_table(input_file, demand_type)
+        print(f"{demand_type} demand table ready in {1000*(time.perf_counter() - start):.1f} ms")
+        start = time.perf_counter()
+        convert_demand_to_scale_factor(100, demand_type, input_file)
+        print(f"{demand_type} demand rate from the table in {1000*(time.perf_counter() - start):.2f} ms")
+
+    results = {}
+    variants = [('dom', scale_demand_dom), ('streaming', scale_demand_streaming), ('table', scale_demand)]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for input_file, demand_type in inputs:
+            for scale_factor in scale_factors:
+                for name, function in variants:
+                    output_file = os.path.join(temp_dir, f"{name}_{demand_type}.xml")
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    for _ in range(repeats):
+                        function(input_file, output_file, scale_factor, demand_type)
+                    elapsed = (time.perf_counter() - start) / repeats
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    results[(demand_type, scale_factor, name)] = (elapsed, peak)
+
+                reference = _read_demand_lines(os.path.join(temp_dir, f"dom_{demand_type}.xml"))
+                same = all(_read_demand_lines(os.path.join(temp_dir, f"{name}_{demand_type}.xml")) == reference for name, _ in variants)
+                dom_time = results[(demand_type, scale_factor, 'dom')][0]
+                timings = ", ".join(f"{name} {1000*results[(demand_type, scale_factor, name)][0]:.1f} ms ({results[(demand_type, scale_factor, name)][1]/1e6:.1f} MB peak, {dom_time/results[(demand_type, scale_factor, name)][0]:.1f}x)" 
+                                    for name, _ in variants)
+                print(f"{demand_type} x{scale_factor}: {timings}, same output: {same}")
+    return results
+
+def benchmark_sumo_profiles(config, profiles=None, num_actions=100, network_iteration='base', seed=0):
+    """
+    Steps/sec of each SUMO profile (sim_config.SUMO_PROFILES) and the drift of key traffic metrics against 'fidelity'.
+    Same fixed demand (min = max), same SUMO seed, same (seeded) random actions and no snapshots for all profiles. Headless.
+    Metrics over the episode: arrived vehicles and persons, teleports, and for the vehicles near the junction the mean speed, mean number stopped and max waiting time.
+    """
+    config = dict(config)
+    config['gui'] = False
+    config['use_snapshots'] = False
+    config['demand_scale_max'] = config['demand_scale_min']
+    _, control_args, _, _ = classify_and_return_args(config, torch.device("cpu"))
+    profiles = list(SUMO_PROFILES) if profiles is None else profiles
+
+    results = {}
+    for profile in profiles:
+        random.seed(seed)
+        np.random.seed(seed)
+        control_args['sumo_profile'] = profile
+        env = ControlEnv(control_args, worker_id=None, network_iteration=network_iteration)
+        env.reset()
+        rng = random.Random(seed)
+        previous_tl_action = None
+        metrics = {'arrived_vehicles': 0, 'arrived_persons': 0, 'teleports': 0, 'mean_speed': 0.0, 'mean_stopped': 0.0, 'max_waiting_time': 0.0}
+        sim_steps = 0
+        step_time = 0.0
+        for _ in range(num_actions):
+            action = torch.tensor([rng.randint(0, 3), rng.randint(0, 1), rng.randint(0, 1)], dtype=torch.long)
+            for action_step in range(env.steps_per_action):
+                env._apply_action(action, action_step, previous_tl_action)
+                start = time.perf_counter()
+                env.sim.simulationStep() # Only the simulation step is timed (the profiles only change SUMO)
+                step_time += time.perf_counter() - start
+                env.collector.update()
+                sim_steps += 1
+
+                metrics['arrived_vehicles'] += env.sim.simulation.getArrivedNumber()
+                metrics['arrived_persons'] += len(env.collector.arrived_persons)
+                metrics['teleports'] += env.collector.teleports_starting
+                for tl_id in env.tl_ids:
+                    speeds = [data[tc.VAR_SPEED] for data in env.collector.context_results[tl_id].values()]
+                    metrics['mean_speed'] += sum(speeds) / len(speeds) if speeds else 0.0
+                    _, num_stopped, max_waiting_time = env.collector.get_traffic_stats(tl_id)
+                    metrics['mean_stopped'] += num_stopped
+                    metrics['max_waiting_time'] = max(metrics['max_waiting_time'], max_waiting_time)
+            previous_tl_action = action[0].item()
+        env.close()
+
+        metrics['mean_speed'] /= sim_steps * len(env.tl_ids)
+        metrics['mean_stopped'] /= sim_steps * len(env.tl_ids)
+        results[profile] = {'steps_per_sec': sim_steps / step_time, **metrics}
+        print(f"{profile}: {results[profile]['steps_per_sec']:.1f} steps/sec, " + ", ".join(f"{name} {value:.2f}" if isinstance(value, float) else f"{name} {value}" for name, value in metrics.items()))
+
+    if 'fidelity' in results:
+        reference = results['fidelity']
+        for profile, result in results.items():
+            if profile == 'fidelity':
+                continue
+            drift = ", ".join(f"{name} {100*(result[name] - reference[name])/reference[name]:+.1f}%" if reference[name] else f"{name} {result[name] - reference[name]:+g}" 
+                              for name in reference if name != 'steps_per_sec')
+            print(f"{profile} vs fidelity: {result['steps_per_sec']/reference['steps_per_sec']:.2f}x steps/sec, drift: {drift}")
+    return results
+
+if __name__ == "__main__":
+    config = get_config()
+    benchmark_backends(config)
+    benchmark_crosswalk_enforcement(config)
+    benchmark_pedestrian_status(config)
+    benchmark_scale_demand(config)
+    benchmark_sumo_profiles(config)
@@ -0,0 +1,58 @@
+import os
+import re
+import shutil
+import hashlib
+import threading
+
+_content_hashes = {} # (file, size, mtime, strip_comments) -> hash of the content. Each file is only hashed once per process.
+_lock = threading.Lock() # Envs in threads (see vec_control_env.py) share the hashes
+
+def content_hash(path, strip_comments=False):
+    """
+    Hash of the content of a file, for the content addressed caches (demand library, route cache, network cache).
+    strip_comments: leave XML comments out (netconvert writes the time and the options, i.e., paths of the run, into a comment).
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, strip_comments)
+    with _lock:
+        if key not in _content_hashes:
+            with open(path, 'rb') as f:
+                content = f.read()
+            if strip_comments:
+                content = re.sub(rb'<!--.*?-->', b'', content, flags=re.S)
+            _content_hashes[key] = hashlib.sha256(content).hexdigest()
+        return _content_hashes[key]
+
+def evict_least_recently_used(paths, max_bytes, keep=None):
+    """
+    Remove the least recently used (oldest modification time) of the paths until their total size fits max_bytes. keep is never removed.
+    A path can also be a directory (an entry made of several files): its size is the size of its files and it is removed as a whole.
+    Returns the number of removed files (or directories).
+    """
+    files = []
+    total_bytes = 0
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file()) if os.path.isdir(path) else stat.st_size
+        except FileNotFoundError: # Evicted by someone else
+            continue
+        files.append((stat.st_mtime, path, size))
+        total_bytes += size
+
+    removed = 0
+    for _, path, size in sorted(files):
+        if total_bytes <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+    return removed
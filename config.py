@@ -9,6 +9,11 @@ def get_config():
         "step_length": 1.0,  # Simulation step length (default: 1.0). Since we have pedestrians, who walk slow. A value too small is not required.
         "action_duration": 10,  # Duration of each action (default: 10.0)
         "auto_start": True,  # Automatically start the simulation
+        "persistent_sumo": True,  # Reuse the SUMO process across episodes (reset reloads the network and routes with load() instead of close/ start)
+        "use_libsumo": False,  # Run SUMO in-process with libsumo (headless only, no socket round-trips). traci is used with the GUI.
+        "sumo_profile": "fidelity",  # Bundle of SUMO options (sim_config.SUMO_PROFILES): "fidelity" (SUMO defaults, verbose), "train-fast" (same models, no logs) or "screening" (non-interacting pedestrians, ballistic, faster teleports)
+        "crosswalk_enforcement": "python",  # How disabled crosswalks are enforced: "python" (reroute persons one at a time every step) or "native" (close the crosswalk lanes, SUMO reroutes. SUMO 1.20 does not see closures made after its first pedestrian routing, see ControlEnv._apply_crosswalk_permissions)
+        "coalesce_substeps": False,  # Advance consecutive substeps with the same signal state in one simulationStep call (the observation is collected once per such run, at its end. The other rows of the run are zero, see info["observed_rows"] of ControlEnv.step)
         "vehicle_input_trips": "./SUMO_files/original_vehtrips.xml",  # Original Input trips file
         "vehicle_output_trips": "./SUMO_files/scaled_trips/scaled_vehtrips.xml",  # Output trips file
         "pedestrian_input_trips": "./SUMO_files/original_pedtrips.xml",  # Original Input pedestrian trips file
@@ -16,6 +21,10 @@ def get_config():
         "original_net_file": "./SUMO_files/Craver_traffic_lights.net.xml",  # Original net file
         "component_dir": "./SUMO_files/component_SUMO_files",
         "network_dir": "./SUMO_files/network_iterations",
+        "use_run_workspace": True,  # Every run gets its own workspace (network iterations, component files, snapshots, per worker sumocfg/ logs/ scaled trips). component_dir, network_dir and snapshot_dir are placed in it
+        "workspace_root": None,  # Where run workspaces are created. None: /dev/shm (tmpfs) if available, ./workspaces otherwise
+        "workspace_min_free_mb": 1024,  # /dev/shm is only used with at least this much free memory
+        "keep_workspace": False,  # Keep the run workspace after training (removed by default, on tmpfs it holds memory)
 
         # Demand scaling
         "manual_demand_veh": None,  # Manually scale vehicle demand before starting the simulation (veh/hr)
@@ -23,11 +32,35 @@ def get_config():
         "demand_scale_min": 0.5,  # Minimum demand scaling factor for automatic scaling
         "demand_scale_max": 4.0,  # Maximum demand scaling factor for automatic scaling
 
+        # Warm-up snapshots
+        "warmup_steps": 0,  # Steps simulated (without actions) before each episode starts. 0 to disable (e.g. 300)
+        "use_snapshots": False,  # Simulate the warm-up once per (network iteration, demand bucket, seed) and share it (saveState/ --load-state)
+        "snapshot_dir": "./SUMO_files/snapshots",  # Where the warm-up snapshots are saved
+        "demand_bucket_size": 0.25,  # Demand scale factors are quantized to this bucket size when snapshots are used
+        "num_snapshot_seeds": 1,  # Number of SUMO seeds to pick from (each seed gets its own snapshot)
+        "demand_mode": "rewrite",  # "rewrite": scale the trips files in python (or use the demand library below). "native": SUMO scales the original trips files (vType scale, randomized), no route file I/O. "inject": add the demand through TraCI (no route files)
+        # Demand library
+        "use_demand_library": False,  # Generate the scaled demand files once per quantized scale factor and share them (all workers and runs on the machine). Only used with demand_mode "rewrite"
+        "demand_library_dir": "~/.cache/urban_design/demand_library",  # Shared by every checkout on the machine (the files are keyed by the content of the input trips)
+        "demand_grid_size": 0.25,  # Demand scale factors are quantized to this grid (when snapshots are used, the snapshot buckets are used instead)
+        "demand_library_max_mb": 500,  # Disk budget. Least recently used files are evicted beyond this
+        # Pre-routed demand
+        "use_routed_demand": False,  # Route the trips files once per network iteration with duarouter (vehicles and pedestrians) and load the routed files. SUMO does not route at insertion. Unroutable trips are dropped
+        "route_cache_dir": "~/.cache/urban_design/routed_demand",  # Routed files, keyed by the content of the net file and the trips file
+        "route_cache_max_mb": 500,  # Disk budget. Least recently used files are evicted beyond this
+
         # PPO (general params)
         "seed": None,  # Random seed (default: None)
         "gpu": True,  # Use GPU if available (default: use CPU)
         "total_timesteps": 1500000,  # Total number of timesteps the simulation will run
         "max_timesteps": 1500,  # Maximum number of steps in one episode (for the lower level agent)
+        "terminate_on_empty": True,  # Terminate the episode early if the network is empty (the demand has drained)
+        "gridlock_stopped_fraction": 0.9,  # Truncate if this fraction of vehicles near the junction is stopped ... (None to disable)
+        "gridlock_patience": 120,  # ... for this many consecutive steps
+        "gridlock_min_vehicles": 10,  # Minimum number of vehicles near the junction to consider a gridlock
+        "max_waiting_time": 600,  # Truncate if a vehicle near the junction has been waiting longer than this (seconds, None to disable)
+        "max_teleports": 20,  # Truncate if SUMO teleported more vehicles than this in the episode (None to disable)
+        "pedestrian_status_sweep_interval": 300,  # Every this many steps, drop the crossed persons that are no longer in the simulation (arrivals are dropped every step)
         "total_sweep_trials": 128,  # Total number of trials for the wandb sweep
         "memory_transfer_freq": 16,  # Frequency of memory transfer from worker to main process (Only applicable for lower level agent)
 
@@ -61,6 +94,12 @@ def get_config():
         "max_coordinate": 1.0,  # Maximum coordinate for crosswalk placement
         "save_graph_images": True, # Save graph image every iteration.
         "save_gmm_plots": True, # Save GMM visualization every iteration.
+        "design_mode": "netconvert",  # "netconvert": a new network (XML components + netconvert) every design step. "superset": every candidate crosswalk is compiled into one network once, a design only activates a subset (no netconvert per step)
+        "superset_grid_size": 0.1,  # Candidate crosswalk locations (normalized) are discretized to this grid in the superset mode
+        "superset_widths": [2.0, 4.0, 6.0],  # Precompiled crosswalk widths per grid cell. The proposed thickness snaps to the closest
+        "use_network_cache": True,  # Cache the generated networks by design (sorted proposals, rounded like the node coordinates). A repeated design is copied instead of running netconvert
+        "network_cache_dir": "~/.cache/urban_design/networks",  # Shared by every run on the machine (keyed by the design and the content of the component files it is built from)
+        "network_cache_max_mb": 500,  # Disk budget. Least recently used networks are evicted beyond this
 
         # PPO (lower level agent)
         "lower_anneal_lr": True,  # Anneal learning rate
@@ -75,6 +114,7 @@ def get_config():
         "lower_vf_coef": 0.5,  # Value function coefficient
         "lower_batch_size": 32,  # Batch size
         "lower_num_processes": 1,  # Number of parallel processes to use (Lower level agent has multiple workers)
+        "lower_envs_per_process": 1,  # Number of SUMO instances each worker process drives (vector env over labeled traci connections, batched inference)
         "lower_kernel_size": 3,  # Kernel size for CNN
         "lower_model_size": "medium",  # Model size for CNN: 'small' or 'medium'
         "lower_dropout_rate": 0.2,  # Dropout rate for CNN
@@ -105,6 +145,12 @@ def classify_and_return_args(train_config, worker_device):
         'original_net_file': train_config['original_net_file'],
         'component_dir': train_config['component_dir'],
         'network_dir': train_config['network_dir'],
+        'design_mode': train_config['design_mode'],
+        'superset_grid_size': train_config['superset_grid_size'],
+        'superset_widths': train_config['superset_widths'],
+        'use_network_cache': train_config['use_network_cache'],
+        'network_cache_dir': train_config['network_cache_dir'],
+        'network_cache_max_mb': train_config['network_cache_max_mb'],
     }
 
     control_args = {
@@ -118,9 +164,37 @@ def classify_and_return_args(train_config, worker_device):
         'action_duration': train_config['action_duration'],
         'gui': train_config['gui'],
         'auto_start': train_config['auto_start'],
+        'persistent_sumo': train_config['persistent_sumo'],
+        'use_libsumo': train_config['use_libsumo'],
+        'sumo_profile': train_config['sumo_profile'],
+        'crosswalk_enforcement': train_config['crosswalk_enforcement'],
+        'coalesce_substeps': train_config['coalesce_substeps'],
         'max_timesteps': train_config['max_timesteps'],
+        'terminate_on_empty': train_config['terminate_on_empty'],
+        'gridlock_stopped_fraction': train_config['gridlock_stopped_fraction'],
+        'gridlock_patience': train_config['gridlock_patience'],
+        'gridlock_min_vehicles': train_config['gridlock_min_vehicles'],
+        'max_waiting_time': train_config['max_waiting_time'],
+        'max_teleports': train_config['max_teleports'],
+        'pedestrian_status_sweep_interval': train_config['pedestrian_status_sweep_interval'],
         'demand_scale_min': train_config['demand_scale_min'],
         'demand_scale_max': train_config['demand_scale_max'],
+        'warmup_steps': train_config['warmup_steps'],
+        'use_snapshots': train_config['use_snapshots'],
+        'snapshot_dir': train_config['snapshot_dir'],
+        'demand_bucket_size': train_config['demand_bucket_size'],
+        'num_snapshot_seeds': train_config['num_snapshot_seeds'],
+        'demand_mode': train_config['demand_mode'],
+        'use_demand_library': train_config['use_demand_library'],
+        'demand_library_dir': train_config['demand_library_dir'],
+        'demand_grid_size': train_config['demand_grid_size'],
+        'demand_library_max_mb': train_config['demand_library_max_mb'],
+        'use_routed_demand': train_config['use_routed_demand'],
+        'route_cache_dir': train_config['route_cache_dir'],
+        'route_cache_max_mb': train_config['route_cache_max_mb'],
+        'network_dir': train_config['network_dir'],
+        'run_dir': None, # Set in train() if the run has a workspace
+        'design_mode': train_config['design_mode'],
         'memory_transfer_freq': train_config['memory_transfer_freq'],
         'save_freq': train_config['save_freq'],
         'writer': None, # Need dummy values for dummy envs init.
@@ -128,6 +202,7 @@ def classify_and_return_args(train_config, worker_device):
         'global_seed': None,
         'total_action_timesteps_per_episode': None,
         'lower_num_processes': train_config['lower_num_processes'],
+        'lower_envs_per_process': train_config['lower_envs_per_process'],
         'lower_anneal_lr': train_config['lower_anneal_lr'],
         'lower_update_freq': train_config['lower_update_freq'],
     }
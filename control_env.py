@@ -1,3 +1,4 @@
+import os
 import math
 import time 
 import traci
@@ -6,7 +7,20 @@ import random
 import gymnasium as gym
 import numpy as np
 from utils import convert_demand_to_scale_factor, scale_demand, create_new_sumocfg
-from sim_config import (PHASES, DIRECTIONS_AND_EDGES, CONTROLLED_CROSSWALKS_DICT, initialize_lanes, get_tl_phase_groups, get_crosswalk_phase_groups)
+from sim_config import (PHASES, DIRECTIONS_AND_EDGES, CONTROLLED_CROSSWALKS_DICT, DEMAND_TYPE_IDS, SUMO_PROFILES, initialize_lanes, get_tl_phase_groups, get_crosswalk_phase_groups, compile_lane_layout)
+from subscriptions import SubscriptionCollector
+from sim_backend import get_sim_backend, get_backend_name, get_start_errors, get_command_errors, close_backend
+from snapshots import SnapshotCache
+from demand_library import DemandLibrary
+from route_cache import RouteCache
+from demand_injector import DemandInjector
+from demand_table import load_demand_table
+from termination import TerminationDetector
+from pedestrian_status import PedestrianStatusStore
+from workspace import get_worker_workspace
+from superset import SupersetNetwork
+
+_logged_backends = set() # The simulation backend is printed once per process (not for every env)
 
 class ControlEnv(gym.Env):
     """
@@ -17,10 +31,12 @@ class ControlEnv(gym.Env):
     - Tracking and occupancy map.
     """
 
-    def __init__(self, control_args, worker_id=None, network_iteration=None):
+    def __init__(self, control_args, worker_id=None, network_iteration=None, sumo_label=None):
         super().__init__()
         self.worker_id = worker_id
         self.network_iteration = network_iteration
+        # If a label is given, SUMO is started as a labeled traci connection (multiple SUMO instances in the same process, see vec_control_env.py).
+        self.sumo_label = sumo_label
         
         # Use dictionary access instead of attribute access
         self.vehicle_input_trips = control_args['vehicle_input_trips']
@@ -33,24 +49,77 @@ class ControlEnv(gym.Env):
         self.action_duration = control_args['action_duration']
         self.gui = control_args['gui']
         self.auto_start = control_args['auto_start']
+        # Keep the same SUMO process across episodes. reset() reloads the network and route files with load() instead of close() and start().
+        self.persistent_sumo = control_args.get('persistent_sumo', True)
+        self.sumo_ready_timeout = 30 # seconds
+        # Named bundle of SUMO options (sim_config.SUMO_PROFILES): pedestrian model, step method, threads, logging, teleports.
+        self.sumo_profile = control_args.get('sumo_profile', 'fidelity')
+        if self.sumo_profile not in SUMO_PROFILES:
+            raise ValueError(f"Unknown SUMO profile: {self.sumo_profile}. Choose from {list(SUMO_PROFILES)}")
+        # How disabled crosswalks are enforced. 
+        # 'python': every step, persons in the vicinity are rerouted one at a time (_disallow_pedestrians). 
+        # 'native': the crosswalk lanes are closed for pedestrians (lane permissions) and SUMO's own router moves them. Only done when the disabled crosswalks change.
+        self.crosswalk_enforcement = control_args.get('crosswalk_enforcement', 'python')
 
         # Modify file paths to include the unique suffix. Each worker has their own environment and hence their own copy of the trips file.
         self.unique_suffix = f"_{worker_id}" if worker_id is not None else ""
         self.vehicle_output_trips = self.vehicle_output_trips.replace('.xml', f'{self.unique_suffix}.xml')
         self.pedestrian_output_trips = self.pedestrian_output_trips.replace('.xml', f'{self.unique_suffix}.xml')
 
+        # Run workspace (workspace.py): this worker's own sumocfg, SUMO logs and scaled trips, no other worker or run writes them.
+        # Without a run workspace, the shared SUMO_files folder is used (as before).
+        self.network_dir = control_args.get('network_dir', './SUMO_files/network_iterations')
+        if control_args.get('run_dir') is not None:
+            self.worker_dir = get_worker_workspace(control_args['run_dir'], worker_id)
+            self.vehicle_output_trips = os.path.join(self.worker_dir, os.path.basename(self.vehicle_output_trips))
+            self.pedestrian_output_trips = os.path.join(self.worker_dir, os.path.basename(self.pedestrian_output_trips))
+        else:
+            self.worker_dir = './SUMO_files'
+        self.sumocfg_file = os.path.join(self.worker_dir, 'iterative_craver.sumocfg')
+
+        # 'superset' design mode (superset.py): every design iteration runs on the same superset network. The candidates that are not in the design are switched off at reset.
+        self.design_mode = control_args.get('design_mode', 'netconvert')
+        self.superset = SupersetNetwork(self.network_dir) if self.design_mode == 'superset' else None # The candidates are loaded at the first reset (written by the DesignEnv)
+
+        # How the demand is scaled.
+        # 'rewrite': the trips files are scaled in python (or picked from the demand library) and SUMO loads the scaled files.
+        # 'native': SUMO loads the original trips files and scales the traffic of the vehicle and pedestrian types itself (vehicletype.setScale). No route file I/O in reset.
+        # 'inject': no route files. The (scaled) demand is added through TraCI as the depart times arrive (demand_injector.py). 
+        # The default is in config.py.
+        self.demand_mode = control_args['demand_mode']
+        if self.demand_mode not in ('rewrite', 'native', 'inject'):
+            raise ValueError(f"Unknown demand_mode '{self.demand_mode}'.")
+
+        # Manual demand: the scale factors are fixed (used in every reset instead of sampling them).
+        self.manual_scale_vehicle = None
+        self.manual_scale_pedestrian = None
         if self.manual_demand_veh is not None :
             # Convert the demand to scaling factor first
-            scaling = convert_demand_to_scale_factor(self.manual_demand_veh, "vehicle", self.vehicle_input_trips)
-            scale_demand(self.vehicle_input_trips, self.vehicle_output_trips, scaling, demand_type="vehicle")
+            self.manual_scale_vehicle = convert_demand_to_scale_factor(self.manual_demand_veh, "vehicle", self.vehicle_input_trips)
+            if self.demand_mode == 'rewrite':
+                scale_demand(self.vehicle_input_trips, self.vehicle_output_trips, self.manual_scale_vehicle, demand_type="vehicle")
 
         if self.manual_demand_ped is not None:
             # Convert the demand to scaling factor first
-            scaling = convert_demand_to_scale_factor(self.manual_demand_ped, "pedestrian", self.pedestrian_input_trips)
-            scale_demand(self.pedestrian_input_trips, self.pedestrian_output_trips, scaling, demand_type="pedestrian")
+            self.manual_scale_pedestrian = convert_demand_to_scale_factor(self.manual_demand_ped, "pedestrian", self.pedestrian_input_trips)
+            if self.demand_mode == 'rewrite':
+                scale_demand(self.pedestrian_input_trips, self.pedestrian_output_trips, self.manual_scale_pedestrian, demand_type="pedestrian")
 
         self.use_gui = self.gui
+        # Simulation backend. libsumo (in-process, no socket round-trips) for headless runs if asked for, traci otherwise (and always for the GUI).
+        self.sim = get_sim_backend(control_args.get('use_libsumo', False) and sumo_label is None, self.use_gui) # libsumo can only run one simulation per process
+        if get_backend_name(self.sim) not in _logged_backends:
+            _logged_backends.add(get_backend_name(self.sim))
+            print(f"Simulation backend: {get_backend_name(self.sim)}")
         self.max_timesteps = control_args['max_timesteps']
+        # Early termination (empty network) and truncation (gridlock/ jam). Thresholds set to None disable the check.
+        self.termination_detector = TerminationDetector(terminate_on_empty=control_args['terminate_on_empty'],
+                                                        stopped_fraction=control_args['gridlock_stopped_fraction'],
+                                                        patience=control_args['gridlock_patience'],
+                                                        min_vehicles=control_args['gridlock_min_vehicles'],
+                                                        max_waiting_time=control_args['max_waiting_time'],
+                                                        max_teleports=control_args['max_teleports'])
+        self.termination_reason = None
         self.sumo_running = False
         self.step_count = 0
         self.tl_ids = ['cluster_172228464_482708521_9687148201_9687148202_#5more'] # Only control this one for now
@@ -64,16 +133,62 @@ class ControlEnv(gym.Env):
         self.phases = PHASES
         self.tl_phase_groups = get_tl_phase_groups(self.action_duration)
         self.crosswalk_phase_groups = get_crosswalk_phase_groups()
+        # Precompiled signal states (see _compile_signal_table). Only changed states are sent to SUMO.
+        self.signal_table = self._compile_signal_table()
+        self.last_signal_state = None
+        self.current_run_length = 1
+        # Coalesce consecutive substeps with the same signal state into one simulationStep(target_time) call. 
+        # Then the observation is collected once per run, at its end (see step).
+        self.coalesce_substeps = control_args.get('coalesce_substeps', False)
+        self.sim_time = 0.0
         self.controlled_crosswalks_dict = CONTROLLED_CROSSWALKS_DICT
         self.direction_and_edges = DIRECTIONS_AND_EDGES
 
         self.tl_lane_dict = {}
         self.tl_lane_dict['cluster_172228464_482708521_9687148201_9687148202_#5more'] = initialize_lanes()
-        self.tl_pedestrian_status = {} # For pedestrians related to crosswalks attached to TLS.
+        self.tl_pedestrian_status = PedestrianStatusStore(sweep_interval=control_args.get('pedestrian_status_sweep_interval', 300)) # For pedestrians related to crosswalks attached to TLS. Persons that have crossed.
+
+        self.cutoff_distance = 100
 
         self.demand_scale_min = control_args['demand_scale_min']
         self.demand_scale_max = control_args['demand_scale_max']
 
+        # Random draws of reset (demand scale, snapshot seed, initial action). The random module (seeded by main/ the worker) unless reset is given a seed.
+        # Then the env gets its own generator (envs that run in threads, see vec_control_env.py, would otherwise draw from the same one in any order).
+        self.rng = random
+
+        # Warm-up at the start of every episode (the network is empty at t=0). Simulated once per (network iteration, demand bucket, seed) and shared as a snapshot.
+        self.warmup_steps = control_args.get('warmup_steps', 0)
+        self.num_snapshot_seeds = control_args.get('num_snapshot_seeds', 1)
+        self.sumo_seed = None
+        if control_args.get('use_snapshots', False):
+            self.snapshot_cache = SnapshotCache(control_args['snapshot_dir'], bucket_size=control_args['demand_bucket_size'])
+        else:
+            self.snapshot_cache = None
+
+        # Shared library of scaled demand files (generated once per quantized scale factor, reused by all workers and runs). Only the rewrite mode writes scaled demand files.
+        if control_args.get('use_demand_library', False):
+            if self.demand_mode != 'rewrite':
+                raise ValueError(f"use_demand_library needs demand_mode 'rewrite' (got '{self.demand_mode}').")
+            self.demand_library = DemandLibrary(control_args['demand_library_dir'], 
+                                                grid_size=control_args['demand_grid_size'], 
+                                                max_bytes=control_args['demand_library_max_mb']*1024*1024)
+        else:
+            self.demand_library = None
+
+        # Pre-routed demand: the trips files routed once per network iteration by duarouter (route_cache.py). SUMO does not route the trips and walks itself.
+        # The DesignEnv prepares them for a new network, a miss here (e.g., a network that was not prepared) is routed by this worker.
+        if control_args.get('use_routed_demand', False):
+            self.route_cache = RouteCache(control_args['route_cache_dir'], max_bytes=control_args['route_cache_max_mb']*1024*1024)
+        else:
+            self.route_cache = None
+
+        if self.demand_mode == 'inject':
+            self.demand_injector = DemandInjector(self.sim, self._find_walking_stage)
+        else:
+            self.demand_injector = None
+        self.route_files = [self.vehicle_output_trips, self.pedestrian_output_trips] # The route files SUMO loads in the next reset
+
         self.current_crosswalk_selection = None 
         self.current_tl_phase_group = None
         self.current_crosswalk_actions = None
@@ -123,20 +238,31 @@ class ControlEnv(gym.Env):
         # Do these lists that are gotten from dict always maintain the same order (Yes/ No)? Answer: Yes, they do.
         #print(f"\n\nControlled crosswalk masked ids: {self.controlled_crosswalk_masked_ids}\n\n")
 
-        self.pressure_dict = {tl_id: {'vehicle': {}, 'pedestrian': {}} for tl_id in self.tl_ids}
-        self.pressure_dict['crosswalks'] = {c: 0 for c in self.controlled_crosswalk_masked_ids}
-
         self.directions = ['north', 'east', 'south', 'west']
         self.turns = ['straight', 'right', 'left']
 
         # TL state, crosswalk state, vehicle incoming, vehicle inside, vehicle outgoing, pedestrian incoming, pedestrian outgoing
         self.single_obs_shape = len(self.tl_ids)*(2 + 2 + 12 + 12 + 4 + 4 + 4)
 
+        # The lane tables are compiled once into integer indexed arrays. Each lane group (slot) holds a list of ids every step.
+        # The occupancy map dicts are views over these same lists. Counts and pressures are numpy vectors (pressure = pressure_matrix @ counts).
+        self.lane_layout = compile_lane_layout(self.tl_lane_dict, self.controlled_crosswalks_masked_dict, self.direction_and_edges, self.directions, self.turns)
+        self.occupancy_ids = [[] for _ in range(self.lane_layout['num_slots'])]
+        self.occupancy_counts = np.zeros(self.lane_layout['num_slots'], dtype=np.float32)
+        self.pressures = np.zeros(self.lane_layout['pressure_matrix'].shape[0], dtype=np.float32)
+        self.observation_buffer = np.zeros((self.steps_per_action, int(self.single_obs_shape)), dtype=np.float32) # Filled in place every action
+
+        # Vehicle ids, positions and signals are obtained through subscriptions (one round-trip per step instead of one per getter).
+        # Persons on the crosswalks (ids and vicinity walking edges) are subscribed as well and indexed by edge every step.
+        self.collector = SubscriptionCollector(self.sim, self.tl_ids, self.lane_layout, cutoff_distance=self.cutoff_distance)
+
         # For crosswalk control 
         self.walking_edges_to_reroute_from = []
         self.related_junction_edges_to_lookup_from = []
         self.alternative_crosswalks_flat = []
-        self.currently_rerouted = []
+        self.currently_rerouted = set()
+        self.walking_stage_memo = {} # (from_edge, to_edge) -> walking stage. Valid for the current network iteration.
+        self.walking_stage_memo_iteration = self.network_iteration
         self.alternative_crosswalks_num = []
         self.crosswalks_to_disable = []
 
@@ -164,17 +290,15 @@ class ControlEnv(gym.Env):
         Requires occupancy map as input. The changes made here should be reflected in the next time step's occupancy map.
         Some corrections have to be done every step.
         1. Update the pedestrian status when they cross: For each traffic light, check the outgoing pedestrians.
-        If a pedestrian is in the outgoing area and hasn't been marked as 'crossed', update their status to 'crossed' in the self.tl_pedestrian_status dictionary.
+        If a pedestrian is in the outgoing area, mark them as crossed in self.tl_pedestrian_status (evicted when they leave the simulation).
         2. In case the same lanes are used for L, R, S turns (in case of vehicles and incoming). The straight lane will have repeated entries, remove them.  
         3. Vehicles are only included in the occupancy map if they are close to a given distance. In both incoming and outgoing directions.
         """
         # Handle outgoing pedestrians
         for tl_id in self.tl_ids:
             for _, persons in occupancy_map[tl_id]['pedestrian']['outgoing'].items():
-                for person in persons:
-                    if person not in self.tl_pedestrian_status or self.tl_pedestrian_status[person] != 'crossed':
-                        # If the pedestrian crossed once, consider them as crossed (assume they wont cross twice, there is no way to know this without looking into their route, which is not practical.) 
-                        self.tl_pedestrian_status[person] = 'crossed'
+                # If the pedestrian crossed once, consider them as crossed (assume they wont cross twice, there is no way to know this without looking into their route, which is not practical.) 
+                self.tl_pedestrian_status.mark_crossed(persons)
 
         # Handle special case for incoming vehicles
         for tl_id in self.tl_ids:
@@ -194,7 +318,7 @@ class ControlEnv(gym.Env):
                 vehicles_to_remove = []
                 for vehicle in vehicles:
                     distance = self._get_vehicle_distance_to_junction(tl_id, vehicle)
-                    if distance > cutoff_distance:
+                    if distance is None or distance > cutoff_distance: # None if outside the subscribed radius
                         vehicles_to_remove.append(vehicle)
                     
                 # Remove vehicles outside the cutoff distance
@@ -231,121 +355,79 @@ class ControlEnv(gym.Env):
 
         :param junction_id: ID of the junction
         :param vehicle_id: ID of the vehicle
-        :return: Distance between the vehicle and the junction in meters
+        :return: Distance between the vehicle and the junction in meters (None if the vehicle is outside the cutoff distance)
         """
-        try:
-            # Get the x, y coordinates of the junction
-            junction_pos = traci.junction.getPosition(junction_id)
-
-            # Get the x, y coordinates of the vehicle
-            vehicle_pos = traci.vehicle.getPosition(vehicle_id)
-
-            # Calculate the Euclidean distance
-            distance = math.sqrt(
-                (junction_pos[0] - vehicle_pos[0])**2 + 
-                (junction_pos[1] - vehicle_pos[1])**2
-            )
+        # Both positions come from the subscriptions. The vehicle position is only available within the subscribed radius.
+        junction_pos = self.collector.junction_positions[junction_id]
+        vehicle_pos = self.collector.get_position(junction_id, vehicle_id)
+        if vehicle_pos is None:
+            return None
 
-            return distance
+        # Calculate the Euclidean distance
+        distance = math.sqrt(
+            (junction_pos[0] - vehicle_pos[0])**2 + 
+            (junction_pos[1] - vehicle_pos[1])**2
+        )
 
-        except traci.TraCIException as e:
-            print(f"Error calculating distance: {e}")
-            return None
+        return distance
     
-    def _update_pressure_dict(self, corrected_occupancy_map):
+    def _update_pressures(self):
         """
-        Update the data structure that holds info about pressure in outgoing directions.
-        For both vehicles and pedestrians.
+        Update the pressures in outgoing directions. For both vehicles and pedestrians (for each TL) and for crosswalks.
+        Computed as a single product of the compiled incidence matrix (see compile_lane_layout) and the occupancy counts (filled in _get_observation).
+        Vehicles: Pressure = incoming (incoming + inside lane groups heading towards the direction) - outgoing
 
         For crosswalks, If the pedestrians are being rerouted, that means there is pressure that is not being addressed.
         Pressure = incoming (upside + downside) - outgoing (inside)
         However, if rerouted, then Pressure = -ve (rerouted)
         """
+        layout = self.lane_layout
+        np.matmul(layout['pressure_matrix'], self.occupancy_counts, out=self.pressures)
 
-        for tl_id in self.tl_ids:
-            #### VEHICLES ####
-
-            # Initialize pressure and calculate for each direction
-            vehicle_pressure = {d: 0 for d in self.directions}
-
-            for outgoing_direction in self.directions:
-                # Calculate incoming traffic towards this direction
-                incoming = 0
-                if outgoing_direction == 'north': # These four are outgoing directions
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['south-straight'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['east-right'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['west-left'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['south-straight'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['east-right'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['west-left'])
-
-                elif outgoing_direction == 'south': # These four are outgoing directions
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['north-straight'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['east-left'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['west-right'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['north-straight'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['east-left'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['west-right'])
-
-                elif outgoing_direction == 'east': # These four are outgoing directions
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['west-straight'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['north-left'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['south-right'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['west-straight'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['north-left'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['south-right'])
-
-                elif outgoing_direction == 'west': # These four are outgoing directions
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['east-straight'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['north-right'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['incoming']['south-left'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['east-straight'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['north-right'])
-                    incoming += len(corrected_occupancy_map[tl_id]['vehicle']['inside']['south-left'])
-                
-                # Calculate actual outgoing traffic
-                outgoing = len(corrected_occupancy_map[tl_id]['vehicle']['outgoing'][outgoing_direction])
-                
-                # Calculate pressure
-                vehicle_pressure[outgoing_direction] = incoming - outgoing
-                self.pressure_dict[tl_id]['vehicle'][outgoing_direction] = vehicle_pressure[outgoing_direction]
-
-            #### PEDESTRIANS (In this TL crossings) ####
-            pedestrian_pressure = {d: 0 for d in self.directions}
-
-            for outgoing_direction in self.directions:
-                # Calculate incoming pedestrians towards this direction
-                incoming = len(corrected_occupancy_map[tl_id]['pedestrian']['incoming'][outgoing_direction])
-                
-                # Calculate actual outgoing pedestrians
-                outgoing = len(corrected_occupancy_map[tl_id]['pedestrian']['outgoing'][outgoing_direction])
-                
-                # Calculate pressure
-                pedestrian_pressure[outgoing_direction] = incoming - outgoing
-                self.pressure_dict[tl_id]['pedestrian'][outgoing_direction] = pedestrian_pressure[outgoing_direction]
-
-        #### CROSSWALKS ####  
-        for crosswalk_id in self.controlled_crosswalk_masked_ids:
-            if crosswalk_id != ':9687187501_c0': # Special case crosswalk
-                incoming = len(corrected_occupancy_map['crosswalks'][crosswalk_id]['upside']) + len(corrected_occupancy_map['crosswalks'][crosswalk_id]['downside'])
-                outgoing = len(corrected_occupancy_map['crosswalks'][crosswalk_id]['inside'])
-                rerouted = len(corrected_occupancy_map['crosswalks'][crosswalk_id]['rerouted'])
-
-                if rerouted > 0:
-                    self.pressure_dict['crosswalks'][crosswalk_id] = -rerouted
-                else:
-                    self.pressure_dict['crosswalks'][crosswalk_id] = incoming - outgoing
+        crosswalk_pressures = self.pressures[layout['pressure_slices']['crosswalks']] # A view, written in place
+        rerouted = self.occupancy_counts[layout['crosswalk_rerouted_slots']]
+        np.copyto(crosswalk_pressures, -rerouted, where=rerouted > 0)
 
     def _get_occupancy_map(self, ):
         """
         Features: 
             - If the same lane is used for multiple directions, the indicator light of vehicle is used to determine the direction. (The indicator light turns on about 100m far from the junction.)
+            - The lanes/ edges to read from every lane group come from the compiled lane layout (no string parsing every step). 
+            - The returned dict is a view: its lists are the same list objects as self.occupancy_ids (one per slot).
+            - Uses the subscription results read by collector.update() right after the simulation step.
         """
+        layout = self.lane_layout
+        self.occupancy_ids = [[] for _ in range(layout['num_slots'])]
+        slot_ids = self.occupancy_ids
+
+        for group_slot, kind, object_id in layout['vehicle_sources']:
+            slot_ids[group_slot].extend(self.collector.get_vehicle_ids(kind, object_id))
+
+        # Lanes that are common for all directions (-1). If there are multiple -1s, this case can occur multiple times.
+        # In this case, look at the indicator light of the vehicles in the straight lane group to get the direction.
+        # TODO: If there are multiple straight lanes where vehicles that want to go left or right also exist, then need to account for that
+        for group_slot, kind, object_id, turn_direction in layout['shared_sources']:
+            tl_id = layout['groups'][group_slot][0]
+            for veh_id in self.collector.get_vehicle_ids(kind, object_id):
+                # Signals are only subscribed within the cutoff distance. Vehicles further away are removed in _step_operations anyway.
+                signal_state = self.collector.get_signals(tl_id, veh_id)
+                if signal_state is not None and self._get_vehicle_direction(signal_state) == turn_direction:
+                    slot_ids[group_slot].append(veh_id)
+
+        # Persons on this junction (walking area or crossing) come from the pedestrian index.
+        for group_slot, direction, edge in layout['pedestrian_sources']:
+            for person in self.collector.get_person_ids(edge):
+                # If not crossed yet, add to incoming. For outgoing, just being inside the crossing is enough.
+                if direction == "outgoing" or person not in self.tl_pedestrian_status:
+                    slot_ids[group_slot].append(person)
+
+        # For the crosswalks related components: upside, downside (vicinity walking edges) and inside (the crosswalk ids).
+        # Special case: ':9687187500_c0' and ':9687187501_c0' represent a single disjoint crosswalk. They share the same slots (counted once).
+        for group_slot, edge in layout['crosswalk_sources']:
+            slot_ids[group_slot].extend(self.collector.get_person_ids(edge))
 
         occupancy_map = {}
-
-        # For the traffic light and its related components
-        for tl_id, lanes in self.tl_lane_dict.items():
+        for tl_id in self.tl_ids:
             occupancy_map[tl_id] = {
                 "vehicle": {
                     "incoming": {},
@@ -357,108 +439,23 @@ class ControlEnv(gym.Env):
                     "outgoing": {}
                 }
             }
-            
-            for agent_type in ["vehicle", "pedestrian"]:
-                for direction in  occupancy_map[tl_id][agent_type].keys():
-                    for lane_group, lane_list in lanes[agent_type][direction].items():
-                        occupancy_map[tl_id][agent_type][direction][lane_group] = []
-                        for lane in lane_list:
-                            if agent_type == "vehicle":
-
-                                if lane != '-1':  # Skip lanes that are common for all directions
-                                    ids = traci.lane.getLastStepVehicleIDs(lane) if "edge" not in lane else traci.edge.getLastStepVehicleIDs(lane.split('.')[1]) # Its actually an edge in the else case.
-                                    occupancy_map[tl_id][agent_type][direction][lane_group].extend(ids)
-                                else: 
-                                    # If there are multiple -1s, this case can occur multiple times.
-                                    # In this case, look at the indicator light of the vehicle to get the direction.
-                                    # Get the EW-NS direction and the current turn direction, then all vehicles in the straight lane group
-                                    ew_ns_direction = lane_group.split('-')[0]
-                                    turn_direction = lane_group.split('-')[1]
-
-                                    straight_lane_group = f"{ew_ns_direction}-straight"
-
-                                    # TODO: If there are multiple straight lanes where vehicles that want to go left or right also exist, then need to account for that
-                                    straight_lane = lanes[agent_type][direction][straight_lane_group][0] 
-                                    existing_ids = traci.lane.getLastStepVehicleIDs(straight_lane) if "edge" not in lane else traci.edge.getLastStepVehicleIDs(lane.split('.')[1])  # Its actually an edge in the else case.
-
-                                    #print(f"Straight lane: {straight_lane}, Existing ids: {existing_ids}")
-
-                                    if len(existing_ids)>0:
-                                        #print(f"Vehicle exists")
-                                        new_ids = []
-                                        for veh_id in existing_ids:
-                                            signal_state = traci.vehicle.getSignals(veh_id)
-                                            veh_direction = self._get_vehicle_direction(signal_state)
-                                            # print(f"Vehicle: {veh_id}, Signal: {signal_state}, Direction: {veh_direction}")
-                                            if veh_direction == turn_direction:
-                                                new_ids.append(veh_id)
-
-                                        occupancy_map[tl_id][agent_type][direction][lane_group].extend(new_ids) 
-
-                            else:  # pedestrian
-                                if lane.startswith(':'):  # Check if it's an internal lane
-                                    # Doing it the computationally expensive way
-                                    # Get all persons in the simulation
-                                    all_persons = traci.person.getIDList()
-                                    # Filter persons on this junction
-                                    for person in all_persons:
-                                        if traci.person.getRoadID(person) == lane:
-                                            # If not crossed yet, add to incoming 
-                                            
-                                            if direction == "incoming":
-                                                if person not in self.tl_pedestrian_status or self.tl_pedestrian_status[person] != 'crossed': 
-                                                    occupancy_map[tl_id][agent_type][direction][lane_group].append(person)
-                                            else: 
-                                                # Add to outgoing, just being inside the crossing is enough.
-                                                occupancy_map[tl_id][agent_type][direction][lane_group].append(person)
-
-                                else: 
-                                    print("Only implemented to work with JunctionDomain. Not implemented yet for external lanes or edges")
-
-        # For the crosswalks related components
-        # For each crosswalk, get the occupancy in the upside, downside, inside, and rerouted.
-        # Do we get the pedestrian ids or do we just get the count? # For now, let's get the ids.
-        # If they are being-rerouted, they should not be a part of upside, downside, and inside. 
-        occupancy_map['crosswalks'] = {}
-        for crosswalk_id in self.controlled_crosswalk_masked_ids:
-            occupancy_map['crosswalks'][crosswalk_id] = {
-                "upside": [],
-                "downside": [],
-                "inside": [],
-                "rerouted": [] }
-
-            # These already contain internal edges
-            vicinity_walking_edges = self.crosswalk_to_vicinity_walking_edges[crosswalk_id]
-        
-            # For upside and downside
-            for edge in vicinity_walking_edges:
-                pedestrians = traci.edge.getLastStepPersonIDs(edge)
-                direction = self.edge_to_direction[edge]
-                occupancy_map['crosswalks'][crosswalk_id][direction].extend(pedestrians) # Incase ids are wanted, use the list instead of the length
-
-            # For inside, use the crosswalk id itself.
-            pedestrians = traci.edge.getLastStepPersonIDs(crosswalk_id)
-            occupancy_map['crosswalks'][crosswalk_id]['inside'].extend(pedestrians)
-
-            # Add re-routed pedestrians
-            # If this crosswalk happens to be disabled, then add the upside and downside values to get the rerouted value. Setting upside, downside to 0.
-            # Inside may contain pessengers that are in the process of crossing when the new decision is made. Not setting that to 0.
-            if crosswalk_id in self.crosswalks_to_disable:
-                occupancy_map['crosswalks'][crosswalk_id]['rerouted'] = occupancy_map['crosswalks'][crosswalk_id]['upside'] + occupancy_map['crosswalks'][crosswalk_id]['downside']
-                occupancy_map['crosswalks'][crosswalk_id]['upside'] = []
-                occupancy_map['crosswalks'][crosswalk_id]['downside'] = []
-
-        # Special case: This id 'ids': [':9687187500_c0', ':9687187501_c0'] represents a single disjoint crosswalk. Do not repeat the counts twice.
-        # Just use the 9687187500_c0 once and skip the second part of the special case crosswalk (only for upside and downside) because it would have been counted in the first part.
-        # This is the special case crosswalk # Since this is updating for inside (it is not affected by re-routing)
-        # Also not affected by other possible problems beacuse of the order [500 comes before 501 inthe crosswalks list]
-        pedestrians = traci.edge.getLastStepPersonIDs(crosswalk_id)
-        occupancy_map['crosswalks'][':9687187500_c0']['inside'].extend(occupancy_map['crosswalks'][':9687187501_c0']['inside']) # Use ':9687187500_c0'
-        del occupancy_map['crosswalks'][':9687187501_c0'] # Delete the second part of the special case crosswalk
-
-        # for crosswalk_id in self.controlled_crosswalk_masked_ids:
-        #     if crosswalk_id != ':9687187501_c0':
-        #         print(f"\nStep:{self.step_count}\n\nCrosswalk: {crosswalk_id}\nUpside: {occupancy_map['crosswalks'][crosswalk_id]['upside']}\nDownside: {occupancy_map['crosswalks'][crosswalk_id]['downside']}\nInside: {occupancy_map['crosswalks'][crosswalk_id]['inside']}\nRerouted: {occupancy_map['crosswalks'][crosswalk_id]['rerouted']}")
+        occupancy_map['crosswalks'] = {crosswalk_key: {} for crosswalk_key in layout['crosswalk_keys']}
+        for group_slot, (owner, agent_type, direction, lane_group) in enumerate(layout['groups']):
+            if owner == 'crosswalks':
+                occupancy_map['crosswalks'][agent_type][direction] = slot_ids[group_slot]
+            else:
+                occupancy_map[owner][agent_type][direction][lane_group] = slot_ids[group_slot]
+
+        # Add re-routed pedestrians
+        # If this crosswalk happens to be disabled, then add the upside and downside values to get the rerouted value. Setting upside, downside to 0.
+        # Inside may contain pessengers that are in the process of crossing when the new decision is made. Not setting that to 0.
+        # Done in place so that the slot lists remain shared.
+        for crosswalk_key, crosswalk_data in occupancy_map['crosswalks'].items():
+            if crosswalk_key in self.crosswalks_to_disable:
+                crosswalk_data['rerouted'].extend(crosswalk_data['upside'] + crosswalk_data['downside'])
+                crosswalk_data['upside'].clear()
+                crosswalk_data['downside'].clear()
+
         return occupancy_map
     
     @property
@@ -517,7 +514,9 @@ class ControlEnv(gym.Env):
         
         reward = 0
         done = False
-        observation_buffer = []
+        truncated = False
+        observation_buffer = self.observation_buffer # Preallocated, rows are filled in place
+        observed_rows = np.zeros(self.steps_per_action, dtype=bool) # Rows that hold an observation (not a skipped substep of a coalesced run or a step after the end of the episode)
         print(f"\nAction: {action}")
 
         # break down the actions into their components
@@ -526,33 +525,50 @@ class ControlEnv(gym.Env):
         current_ew_crosswalk_action = action[2].item()
 
         # Run simulation steps for the duration of the action
-        for _ in range(self.steps_per_action):
+        filled_rows = 0
+        while filled_rows < self.steps_per_action:
             
             # Apply action needs to happen every timestep
             self._apply_action(action, self.current_action_step, self.previous_tl_action)
-
-            traci.simulationStep() # Step length is the simulation time that elapses when each time this is called.
-            self.step_count += 1
+            self._enforce_crosswalks()
+
+            # Substeps to advance. More than 1 only if coalescing (the python crosswalk enforcement needs every step).
+            num_substeps = 1
+            if self.coalesce_substeps and not (self.crosswalk_enforcement == 'python' and self.crosswalks_to_disable):
+                num_substeps = min(self.current_run_length, self.steps_per_action - filled_rows, max(1, self.max_timesteps - self.step_count))
+
+            self._inject_demand(self.sim_time + num_substeps*self.step_length)
+            if num_substeps == 1:
+                self.sim.simulationStep() # Step length is the simulation time that elapses when each time this is called.
+            else:
+                self.sim.simulationStep(self.sim_time + num_substeps*self.step_length) # Simulate until this time in one call
+            self.sim_time += num_substeps*self.step_length
+            self.step_count += num_substeps
+            self.collector.update() # Subscription results from this step (no round-trip). Used by the observation and the termination check.
+            self.tl_pedestrian_status.update(self.collector, self.sim, num_substeps)
             # Increment the current action step
-            self.current_action_step = (self.current_action_step + 1) % self.steps_per_action # Wrapped around some modulo arithmetic
+            self.current_action_step = (self.current_action_step + num_substeps) % self.steps_per_action # Wrapped around some modulo arithmetic
 
             # TODO: For the time being. Modify it later.
-            # Collect observation at each substep
-            obs = np.random.rand(40)
-            #obs = self._get_observation(print_map=False)
-            #print(f"\nObservation: {obs}")
-            observation_buffer.append(obs)
+            # Collect observation at each substep. A coalesced run is only observed at its end (the last row of the run), the rows of the substeps before it are zero and not marked as observed.
+            run_end = filled_rows + num_substeps - 1
+            observation_buffer[filled_rows:run_end] = 0
+            observation_buffer[run_end] = np.random.rand(40)
+            #self._get_observation(print_map=False, out=observation_buffer[run_end])
+            #print(f"\nObservation: {observation_buffer[run_end]}")
+            observed_rows[run_end] = True
+            filled_rows += num_substeps
 
             # TODO: For the time being. Modify it later.
-            #self._update_pressure_dict(self.corrected_occupancy_map)
+            #self._update_pressures()
 
             # Accumulate reward
-            #reward += self._get_reward(current_tl_action)
+            #reward += num_substeps*self._get_reward(current_tl_action)
             reward += 0 # TODO: For the time being. Modify it later.
 
-            # Check if episode is done
-            if self._check_done():
-                done = True
+            # Check if episode is done (terminated) or cut short (truncated)
+            done, truncated = self._check_done(num_substeps)
+            if done or truncated:
                 break
 
         # formatted_buffer = "\n".join(f"{arr})" for arr in observation_buffer)
@@ -560,13 +576,16 @@ class ControlEnv(gym.Env):
         # print(f"\nCurrent Action: {action}")
         #print(f"\nAccumulated Reward: {reward}")
         self.previous_tl_action = current_tl_action
-        observation = np.asarray(observation_buffer) # shape (steps_per_action, 74); e.g. (10, 74) with 10 items each of size 74 
+        observation_buffer[filled_rows:] = 0 # If the episode ended early, the rest of the buffer is not stale
+        observation = observation_buffer.copy() # shape (steps_per_action, 40); e.g. (10, 40). Copy because the buffer is reused in the next step.
         #print(f"\nAccumulated Observation:\n{observation}, shape: {observation.shape}")
-        info = {}
+        info = {'termination_reason': self.termination_reason,
+                'pedestrian_status_size': len(self.tl_pedestrian_status),
+                'observed_rows': observed_rows}
 
-        return observation, reward, done, False, info
+        return observation, reward, done, truncated, info
         
-    def _get_observation(self, print_map=False):
+    def _get_observation(self, print_map=False, out=None):
         """
         This is per step observation.
         About including previous action in the observation:
@@ -575,68 +594,31 @@ class ControlEnv(gym.Env):
             - It would have been fine if model was MLP (we can just attach the previous action at the end)
             But for CNN, it breaks the grid structure.
         Pressure itself is not a part of the observation. It is only used for reward calculation.
+
+        If out is given (a row of the observation buffer), the observation is written into it directly.
+        The counts (also used for the pressures) are gathered from the occupancy slots in a single fancy index.
         """
         
         # Get the occupancy map and print it
         occupancy_map = self._get_occupancy_map()
-        self.corrected_occupancy_map = self._step_operations(occupancy_map, print_map=print_map, cutoff_distance=100)
-        
-        observation = []
-        tl_id = self.tl_ids[0]
+        self.corrected_occupancy_map = self._step_operations(occupancy_map, print_map=print_map, cutoff_distance=self.cutoff_distance)
+        self.occupancy_counts[:] = [len(ids) for ids in self.occupancy_ids]
+
+        observation = out if out is not None else np.empty(int(self.single_obs_shape), dtype=np.float32)
         
         #### Current phase group info (This changes even within the action timesteps) ####
-        current_tl_info = []
-        current_tl_info.append(self.current_tl_phase_group/4) # 0, 1, 2, 3 to 0, 0.25, 0.5, 0.75 
-        current_tl_info.append(self.current_tl_state_index/2) # For 0, 1, 2, 3, its always 0 but for 4 and 5, it varies in 0, 1, 2; convert that to 0, 0.5, 1
-
-        observation.extend(current_tl_info)
-        observation.extend([float(x) for x in self.current_crosswalk_actions]) # 0 and 1 to 0.0 and 1.0
+        observation[0] = self.current_tl_phase_group/4 # 0, 1, 2, 3 to 0, 0.25, 0.5, 0.75 
+        observation[1] = self.current_tl_state_index/2 # For 0, 1, 2, 3, its always 0 but for 4 and 5, it varies in 0, 1, 2; convert that to 0, 0.5, 1
+        observation[2] = float(self.current_crosswalk_actions[0]) # 0 and 1 to 0.0 and 1.0
+        observation[3] = float(self.current_crosswalk_actions[1])
         
-        #### VEHICLES INFO ####
-        # Incoming
-        for outgoing_direction in self.directions:
-            for turn in self.turns:
-                incoming = len(self.corrected_occupancy_map[tl_id]['vehicle']['incoming'][f"{outgoing_direction}-{turn}"])
-                observation.append(incoming)
-
-        # Inside
-        for outgoing_direction in self.directions:
-            for turn in self.turns:
-                inside = len(self.corrected_occupancy_map[tl_id]['vehicle']['inside'][f"{outgoing_direction}-{turn}"])
-                observation.append(inside)
-
-        # Outgoing
-        for outgoing_direction in self.directions:
-            outgoing = len(self.corrected_occupancy_map[tl_id]['vehicle']['outgoing'][outgoing_direction])
-            observation.append(outgoing)
-            
-        #### PEDESTRIANS INFO ####
-        # Incoming
-        for outgoing_direction in self.directions:
-            incoming = len(self.corrected_occupancy_map[tl_id]['pedestrian']['incoming'][outgoing_direction])
-            observation.append(incoming)
-
-        # Outgoing
-        for outgoing_direction in self.directions:
-            outgoing = len(self.corrected_occupancy_map[tl_id]['pedestrian']['outgoing'][outgoing_direction])
-            observation.append(outgoing)
-
-        observation = np.asarray(observation, dtype=np.float32)
-        # Create a mask for part of observations that do not need normalization i.e., a bunch of elements at the beginning (which do not need a normalization)
-
-        mask = list(range(len(current_tl_info) + len(self.current_crosswalk_actions), len(observation))) # Except 0, 1, 2, 3
-        observation[mask] /= 10.0 # TODO: A better normalization scheme?
+        #### VEHICLES INFO (incoming, inside, outgoing) and PEDESTRIANS INFO (incoming, outgoing) ####
+        # The first 4 elements do not need a normalization.
+        np.divide(self.occupancy_counts[self.lane_layout['observation_slots']], 10.0, out=observation[4:]) # TODO: A better normalization scheme?
 
         # #TODO: Accumulate crosswalk specific info to be accumulated for the design agent. 
-        # # Concatenate the crosswalk info (4 obs for each crosswalk)
-        # crosswalk_info = []
-        # for crosswalk_id in self.controlled_crosswalk_masked_ids: # ':9687187501_c0' and ':9687187500_c0' are same special case crosswalk
-        #     if crosswalk_id != ':9687187501_c0': # This if condition is a huge tax to the system.
-        #         crosswalk_info.append(len(self.corrected_occupancy_map['crosswalks'][crosswalk_id]['upside']))
-        #         crosswalk_info.append(len(self.corrected_occupancy_map['crosswalks'][crosswalk_id]['downside']))
-        #         crosswalk_info.append(len(self.corrected_occupancy_map['crosswalks'][crosswalk_id]['inside']))
-        #         crosswalk_info.append(len(self.corrected_occupancy_map['crosswalks'][crosswalk_id]['rerouted']))
-        # crosswalk_info = np.asarray(crosswalk_info, dtype=np.float32)
+        # # Concatenate the crosswalk info (4 obs for each crosswalk): upside, downside, inside, rerouted slots of each crosswalk key.
+        # crosswalk_info = self.occupancy_counts[self.lane_layout['slot'][('crosswalks', self.lane_layout['crosswalk_keys'][0], 'upside', None)]:]
 
         #print(f"\nObservation: {observation.shape}")
         return observation
@@ -644,6 +626,7 @@ class ControlEnv(gym.Env):
     def _get_tl_switch_state(self, east_to_north_switch, north_to_east_switch, current_action_step):
         """
         If this function is called, one of them needs to be true.
+        Returns the state and its index in the phase group.
         """
         if east_to_north_switch:
             current_tl_action = 4
@@ -653,13 +636,48 @@ class ControlEnv(gym.Env):
         durations = [phase["duration"] for phase in self.tl_phase_groups[current_tl_action]]
         cumulative_durations = [sum(durations[:i+1]) for i in range(len(durations))] # [4, 5, 10]
 
+        index = len(cumulative_durations) - 1 # The last phase lasts until the end of the action
         for i, duration in enumerate(cumulative_durations):
             if current_action_step < duration:
                 index = i
                 break
 
-        self.current_tl_state_index = index
-        return self.tl_phase_groups[current_tl_action][index]["state"]
+        return self.tl_phase_groups[current_tl_action][index]["state"], index
+
+    def _compile_signal_table(self):
+        """
+        Precompile the complete signal state strings (TL state + crosswalk state) at init. 
+        Indexed by (previous_tl_action, tl_action, crosswalk bits, substep). Values are (state, tl_state_index, run_length).
+        run_length is the number of substeps (starting from this one, within the action) that have the same state.
+
+        If there was a switch (between N-S and E-W), there needs to be a yellow round first (_get_tl_switch_state).
+        For the signalized crosswalk control. Append ArBCrD at the end of the tl state string.
+        """
+        signal_table = {}
+        tl_actions = [0, 1, 2, 3]
+        for previous_tl_action in tl_actions:
+            for tl_action in tl_actions:
+                # If these are true, then need yellow rounds in between.
+                east_to_north_switch = (tl_action == 1 and previous_tl_action == 0)
+                north_to_east_switch = (tl_action == 0 and previous_tl_action == 1)
+
+                for crosswalk_actions, crosswalk_state in self.crosswalk_phase_groups.items():
+                    # Construct the crosswalk state string from the dict values
+                    crosswalk_state_str = (crosswalk_state['A'] + crosswalk_state['B'] + 'r' + crosswalk_state['C'] + 'r' + crosswalk_state['D'])
+                    states = []
+                    for substep in range(self.steps_per_action):
+                        if east_to_north_switch or north_to_east_switch:
+                            tl_state, tl_state_index = self._get_tl_switch_state(east_to_north_switch, north_to_east_switch, substep)
+                        else: # Normal conditions. The list corresponding to normal conditions does not have multiple items.
+                            tl_state, tl_state_index = self.tl_phase_groups[tl_action][0]["state"], 0
+                        states.append((tl_state + crosswalk_state_str, tl_state_index))
+
+                    for substep, (state, tl_state_index) in enumerate(states):
+                        run_length = 1
+                        while substep + run_length < len(states) and states[substep + run_length][0] == state:
+                            run_length += 1
+                        signal_table[(previous_tl_action, tl_action, crosswalk_actions, substep)] = (state, tl_state_index, run_length)
+        return signal_table
 
     def _apply_action(self, action, current_action_step, previous_tl_action=None):
         """
@@ -674,35 +692,22 @@ class ControlEnv(gym.Env):
         1: Allow E-W disallow other directions
         2: Allow North-East and South-West direction (Dedicated left turns), disallow other directions
         3: Disallow vehicular traffic in all direction (Useful in situation where lets say the pedestrian demand is just too high)
+
+        The state strings come from the precompiled signal table. The state is only sent to SUMO if it changed.
         """
-        # First get the string together. 
-        # For the TL control. 
         current_tl_action = action[0].item() # 0, 1, 2, 3
         #print(f"\nCurrent Action: {action}, TL action: {current_tl_action} Previous TL Action: {previous_tl_action}")
 
         if previous_tl_action == None: # First action 
             previous_tl_action = current_tl_action # Assume that there was no switch
 
-        # If these are true, then need yellow rounds in between.
-        east_to_north_switch = (current_tl_action == 1 and previous_tl_action == 0)
-        north_to_east_switch = (current_tl_action == 0 and previous_tl_action == 1)
-        
-        if east_to_north_switch or north_to_east_switch:
-            tl_state = self._get_tl_switch_state(east_to_north_switch, north_to_east_switch, current_action_step)
-        else: # Normal conditions.
-            self.current_tl_state_index = 0
-            tl_state = self.tl_phase_groups[current_tl_action][self.current_tl_state_index]["state"] # The list corresponding to normal conditions does not have multiple items.
-            
-        # For the signalized crosswalk control. Append ArBCrD at the end of the tl state string.
         self.current_crosswalk_actions = str(action[1].item()) + str(action[2].item()) # two binary actions 0, 1
-        crosswalk_state = self.crosswalk_phase_groups[self.current_crosswalk_actions]
-        
-        # Construct the crosswalk state string from the dict values
-        crosswalk_state_str = (crosswalk_state['A'] + crosswalk_state['B'] + 'r' + crosswalk_state['C'] + 'r' + crosswalk_state['D'])
+        state, self.current_tl_state_index, self.current_run_length = self.signal_table[(previous_tl_action, current_tl_action, self.current_crosswalk_actions, current_action_step)]
         
-        state = tl_state + crosswalk_state_str
         #print(f"\nState: {state}\n")
-        traci.trafficlight.setRedYellowGreenState(self.tl_ids[0], state)
+        if state != self.last_signal_state:
+            self.sim.trafficlight.setRedYellowGreenState(self.tl_ids[0], state)
+            self.last_signal_state = state
 
     def _get_reward(self, current_tl_action):
         """ 
@@ -738,30 +743,21 @@ class ControlEnv(gym.Env):
         lambda1, lambda2, lambda3 = -0.33, -0.33, -0.33
 
         #### Pressure based ####
+        pressure_slices = self.lane_layout['pressure_slices']
         # Traffic Signal Control
-        vehicle_pressure = 0
-        for tl_id in self.tl_ids:
-            for direction in self.directions:
-                vehicle_pressure += self.pressure_dict[tl_id]['vehicle'][direction]
+        vehicle_pressure = self.pressures[pressure_slices['vehicle']].sum()
 
         # Crosswalk Signal Control
-        pedestrian_pressure = 0
-        for tl_id in self.tl_ids:
-            for direction in self.directions:
-                pedestrian_pressure += self.pressure_dict[tl_id]['pedestrian'][direction]
+        pedestrian_pressure = self.pressures[pressure_slices['pedestrian']].sum()
 
         #### MWAQ based ####
         # TODO:: Implement this and add to sweep.
 
         # Crosswalk control
-        crosswalks_pressure = 0
-        controlled_crosswalk_pressures = []
-        for crosswalk_id in self.controlled_crosswalk_masked_ids:
-            if crosswalk_id != '9687187501_c0':
-                controlled_crosswalk_pressures.append(self.pressure_dict['crosswalks'][crosswalk_id]) 
+        controlled_crosswalk_pressures = self.pressures[pressure_slices['crosswalks']]
 
         # Only collect the positive pressure values. A negative value means re-routed i.e., the pressure was discarded.
-        crosswalks_pressure = sum(pressure for pressure in controlled_crosswalk_pressures if pressure > 0)
+        crosswalks_pressure = controlled_crosswalk_pressures[controlled_crosswalk_pressures > 0].sum()
                 
         reward = lambda1*vehicle_pressure + lambda2*pedestrian_pressure + lambda3*crosswalks_pressure
 
@@ -775,18 +771,27 @@ class ControlEnv(gym.Env):
             reward -= 0.5  # Penalty for changing tl actions. Since this is per step reward. Action change is reflected multiplied by action steps.
         
         # Re-route penalty (because any re-route increases travel time). Only collect the negative pressure values
-        reroute_pressure = sum(pressure for pressure in controlled_crosswalk_pressures if pressure < 0) # This is already negative.
+        reroute_pressure = controlled_crosswalk_pressures[controlled_crosswalk_pressures < 0].sum() # This is already negative.
         reward -= reroute_pressure
 
         #print(f"\nStep Reward: {reward}")
-        return reward
+        return float(reward)
 
-    def _check_done(self):
+    def _check_done(self, num_steps=1):
         """
-        TODO: What more conditions can be added here?
-        - Gridlock? Jam? of vehicles or pedestrians? Crashes?
+        Returns (terminated, truncated).
+        - Terminated: the network is empty (the demand has drained).
+        - Truncated: max_timesteps reached (time limit), or gridlock/ jam (see TerminationDetector). The state is not terminal, PPO can bootstrap.
+        TODO: What more conditions can be added here? Crashes?
         """
-        return self.step_count >= self.max_timesteps
+        pending_demand = self.demand_injector.pending if self.demand_injector is not None else 0 # Not expected by SUMO yet
+        terminated, truncated, reason = self.termination_detector.update(self.collector, self.tl_ids, num_steps, pending_demand=pending_demand)
+        if not (terminated or truncated) and self.step_count >= self.max_timesteps:
+            truncated, reason = True, 'max_timesteps'
+        if terminated or truncated:
+            self.termination_reason = reason
+            print(f"\nEpisode ended at step {self.step_count}: {reason}")
+        return terminated, truncated
 
     def _disallow_pedestrians(self, walking_edges_to_reroute_from, related_junction_edges_to_lookup_from):
         """ 
@@ -795,7 +800,7 @@ class ControlEnv(gym.Env):
         This means some pedestrians which have spawned and reached the crosswalks in the last 10 steps will not be rerouted. Which is unlikely.
 
         One important consideration is: 
-        1. When to check if pedestrians need a re-route: whereever they may be at the action time step (because we go through all pedestrians) 
+        1. When to check if pedestrians need a re-route: only the persons on the walking edges to reroute from at the action time step (obtained per edge, not by going through all pedestrians) 
         2. When to actually perform the re-route: If they are present in the vicinity of the crosswalk. i.e., only if they are nearby, they will be able to see that a crosswalk is disabled. (closer to real-world scenario) 
 
         # We cannot check if a pedestrian far away has a crosswalk in their route (which they reach sometime in the future) and then re-route them immediately.
@@ -816,79 +821,156 @@ class ControlEnv(gym.Env):
          1. After assigning the new route, move the pedestrian to the first edge/ lane of the new route. (teleport)? The teleportation from simulation seems to work fine. And my own teleport does not
         """
 
-        for ped_id in traci.person.getIDList():
-            if ped_id not in self.currently_rerouted: # If they are already re-routed, no need to re-route them again. Until the next action where this list gets reset.
-                current_edge = traci.person.getRoadID(ped_id) # This may contain an internal edge.
-                
-                # Get the remaining edges in the person's route
-                remaining_stages_count = traci.person.getRemainingStages(ped_id)
-                remaining_edges = []
-                for i in range(remaining_stages_count):  
-                    stage = traci.person.getStage(ped_id, i)
-                    remaining_edges.extend(stage.edges)
+        # Only the persons that are on the walking edges to reroute from are candidates (instead of every person in the simulation).
+        # Persons directly on the crosswalk are not on these edges (they are continued to walk).
+        walking_edges_to_reroute_from = set(walking_edges_to_reroute_from)
+        for current_edge in walking_edges_to_reroute_from:
+            for ped_id in self.sim.edge.getLastStepPersonIDs(current_edge):
+                if ped_id in self.currently_rerouted: # If they are already re-routed, no need to re-route them again. Until the next action where this set gets reset.
+                    continue
                 
                 # For all pedestrians, print their route
-                # print(f"\nPedestrian {ped_id} remaining route: {remaining_edges}\n current edge: {current_edge}\n")
+                # print(f"\nPedestrian {ped_id} current edge: {current_edge}\n")
                 # print(f"\nWalking edges to reroute from: {walking_edges_to_reroute_from}\n")
                 # print(f"\nRelated junction edges to lookup from: {related_junction_edges_to_lookup_from}\n")
 
-                # If the person is in the vicinity of the crosswalk we want to disable or the look forward in the current edge by 1.
-                # If the person is directly on the edge that we want to disable, then they are continued to walk
-                # Disabling the forward lookup. Works without problems.
-                # If forward lookup is enabled, the auto-teleportation is too harsh. We need to do controlled teleportation 
-                if self._check_vicinity(current_edge, walking_edges_to_reroute_from, remaining_edges, related_junction_edges_to_lookup_from, forward_lookup= False): # If the route includes the ones we want to disable.
-                    
-                    # Get the destination (end) edge
-                    destination_edge = remaining_edges[-1] # Last edge of the last stage is the destination.
-
-                    # Based on whether current edge is upside or downside, select the new crosswalk's downside or upside.
-                    current_direction = self.edge_to_direction.get(current_edge) # This is the direction of the current edge.
-                    other_direction = 'upside' if current_direction == 'downside' else 'downside' # Just a simple way to get the other direction.
-
-                    # Choice of which alternate crosswalk to choose is based on shortest path. 
-                    # Among the alternate crosswalks, for each pedestrian, find the closest crosswalk.
-                    current_crosswalk_num = self.edge_to_numerical_crosswalk_id.get(current_edge)
-                    # make use of self.alternative_crosswalks_num to calculate smallest difference with current_crosswalk_num
-                    differences = [abs(current_crosswalk_num - crosswalk_num) for crosswalk_num in self.alternative_crosswalks_num]
-                    closest_crosswalk_index = differences.index(min(differences))
-                    new_crosswalk_num = self.alternative_crosswalks_num[closest_crosswalk_index]
-
-                    # This has to be gotten from the unmasked one because we need to include 1 and 2
-                    new_crosswalk_id = self.controlled_crosswalks_dict[new_crosswalk_num]['ids'][0] # Just get the first one.
-                    
-                    # print(f"\nPedestrian {ped_id} is being re-routed from crosswalk {current_crosswalk_num} to crosswalk {new_crosswalk_num} with ID: {new_crosswalk_id}")
-                    # print(f"Alternate crosswalk nums: {self.alternative_crosswalks_num}, differences: {differences}\n")
-
-                    # Get the re-route point related to this new crosswalk
-                    next_reroute_edge = self.crosswalk_to_reroute_edges[new_crosswalk_id].get(current_direction) # Understand the difference between teleport point and reroute point.
-
-                    # Append two new walking stages:
-                    # Althrough the routing can find a route from current edge directly to the destination edge, this is a problem because it can repeat the same route. 
-                    # Moreoever, we want to ensure that we pass through an enabled crosswalk. Hence, we do routing in two stages.
-                    # #    - One from the current edge to the new crosswalk 
-                    found_route = traci.simulation.findIntermodalRoute(current_edge, next_reroute_edge, modes='') # Walking is the default mode. This returns a Stage object.
-                    #print(f"\nFound route: {found_route}\n")
-
-                    other_side_of_crosswalk = self.crosswalk_to_reroute_edges[new_crosswalk_id].get(other_direction)
-                    found_route_2 = traci.simulation.findIntermodalRoute(next_reroute_edge, other_side_of_crosswalk, modes='') 
-                    #print(f"\nFound route 2: {found_route_2}\n")
-
-                    #   - Other from the new crosswalk to the destination edge
-                    found_route_3 = traci.simulation.findIntermodalRoute(other_side_of_crosswalk, destination_edge, modes='') # Walking is the default mode. This returns a Stage object.
-                    #print(f"\nFound route 3: {found_route_2}\n")
-
-                    # Clear all the remaining stages of the pedestrian
-                    # If a new stage is not immediately appended, this automatically removes the person in the next timestep.
-                    traci.person.removeStages(ped_id)
-                    
-                    # Since we are finding intermodal route, this route could potentially have had many stages. Just append the first one. which is walking to the destination.
-                    traci.person.appendStage(ped_id, found_route[0]) 
-                    traci.person.appendStage(ped_id, found_route_2[0]) 
-                    traci.person.appendStage(ped_id, found_route_3[0])
-
-                    # If they got re-routed, change color to red
-                    traci.person.setColor(ped_id, (255, 0, 0, 255))
-                    self.currently_rerouted.append(ped_id)
+                # The person is in the vicinity of the crosswalk we want to disable (the forward lookup is disabled, see _check_vicinity).
+                # Get the destination (end) edge. Last edge of the last stage is the destination. Stages are only fetched now (lazily), starting from the last one.
+                destination_edge = self._get_destination_edge(ped_id)
+                if destination_edge is None:
+                    continue
+
+                # Based on whether current edge is upside or downside, select the new crosswalk's downside or upside.
+                current_direction = self.edge_to_direction.get(current_edge) # This is the direction of the current edge.
+                other_direction = 'upside' if current_direction == 'downside' else 'downside' # Just a simple way to get the other direction.
+
+                # Choice of which alternate crosswalk to choose is based on shortest path. 
+                # Among the alternate crosswalks, for each pedestrian, find the closest crosswalk.
+                current_crosswalk_num = self.edge_to_numerical_crosswalk_id.get(current_edge)
+                # make use of self.alternative_crosswalks_num to calculate smallest difference with current_crosswalk_num
+                differences = [abs(current_crosswalk_num - crosswalk_num) for crosswalk_num in self.alternative_crosswalks_num]
+                closest_crosswalk_index = differences.index(min(differences))
+                new_crosswalk_num = self.alternative_crosswalks_num[closest_crosswalk_index]
+
+                # This has to be gotten from the unmasked one because we need to include 1 and 2
+                new_crosswalk_id = self.controlled_crosswalks_dict[new_crosswalk_num]['ids'][0] # Just get the first one.
+                
+                # print(f"\nPedestrian {ped_id} is being re-routed from crosswalk {current_crosswalk_num} to crosswalk {new_crosswalk_num} with ID: {new_crosswalk_id}")
+                # print(f"Alternate crosswalk nums: {self.alternative_crosswalks_num}, differences: {differences}\n")
+
+                # Get the re-route point related to this new crosswalk
+                next_reroute_edge = self.crosswalk_to_reroute_edges[new_crosswalk_id].get(current_direction) # Understand the difference between teleport point and reroute point.
+                other_side_of_crosswalk = self.crosswalk_to_reroute_edges[new_crosswalk_id].get(other_direction)
+
+                # Three new walking stages:
+                # Althrough the routing can find a route from current edge directly to the destination edge, this is a problem because it can repeat the same route. 
+                # Moreoever, we want to ensure that we pass through an enabled crosswalk. Hence, we do routing in stages.
+                #    - One from the current edge to the new crosswalk 
+                #    - One to the other side of the new crosswalk
+                #    - Other from the new crosswalk to the destination edge
+                # The stages are memoized per network iteration, a repeat reroute does not query the router.
+                stages = [self._find_walking_stage(current_edge, next_reroute_edge),
+                          self._find_walking_stage(next_reroute_edge, other_side_of_crosswalk),
+                          self._find_walking_stage(other_side_of_crosswalk, destination_edge)]
+
+                # Clear all the remaining stages of the pedestrian
+                # If a new stage is not immediately appended, this automatically removes the person in the next timestep.
+                self.sim.person.removeStages(ped_id)
+                for stage in stages:
+                    self.sim.person.appendStage(ped_id, stage)
+
+                # If they got re-routed, change color to red
+                self.sim.person.setColor(ped_id, (255, 0, 0, 255))
+                self.currently_rerouted.add(ped_id)
+
+    def _get_destination_edge(self, ped_id):
+        """
+        Last edge of the last stage that has edges (the stages are fetched from the last one backwards, usually only one call).
+        """
+        remaining_stages_count = self.sim.person.getRemainingStages(ped_id)
+        for i in reversed(range(remaining_stages_count)):
+            edges = self.sim.person.getStage(ped_id, i).edges
+            if edges:
+                return edges[-1]
+        return None
+
+    def _find_walking_stage(self, from_edge, to_edge):
+        """
+        Walking stage from from_edge to to_edge. The routes only depend on the network, so they are memoized per network iteration.
+        Since we are finding intermodal route, this route could potentially have had many stages. Just use the first one, which is walking to the destination.
+        """
+        key = (from_edge, to_edge)
+        stage = self.walking_stage_memo.get(key)
+        if stage is None:
+            stage = self.sim.simulation.findIntermodalRoute(from_edge, to_edge, modes='')[0] # Walking is the default mode. This returns a Stage object.
+            # findIntermodalRoute ignores the lane permissions. In the superset mode, keep the walk off the candidates that are switched off.
+            if self.superset is not None and not self.superset.get_inactive_edges(self.network_iteration).isdisjoint(stage.edges):
+                walk = self.superset.find_walk(from_edge, to_edge, self.network_iteration)
+                if walk is not None:
+                    stage.edges = walk
+            self.walking_stage_memo[key] = stage
+        return stage
+
+    def _set_crosswalks_to_disable(self, crosswalk_nums):
+        """
+        Set the crosswalks (numerical ids in CONTROLLED_CROSSWALKS_DICT) that are disabled. Only the controlled (masked) crosswalks can be disabled.
+        Nothing is done if the set did not change.
+        For the 'python' engine, this prepares the edges for _disallow_pedestrians. For the 'native' engine, this flips the lane permissions.
+        """
+        crosswalk_nums = [num for num in crosswalk_nums if num in self.controlled_crosswalks_masked_dict]
+        crosswalks_to_disable = [crosswalk_id for num in crosswalk_nums for crosswalk_id in self.controlled_crosswalks_dict[num]['ids']]
+        if set(crosswalks_to_disable) == set(self.crosswalks_to_disable):
+            return
+
+        previously_disabled = set(self.crosswalks_to_disable)
+        self.crosswalks_to_disable = crosswalks_to_disable
+        self.walking_edges_to_reroute_from = [edge for num in crosswalk_nums for edge in self.controlled_crosswalks_dict[num]['vicinity_walking_edges']]
+        self.related_junction_edges_to_lookup_from = [edge for num in crosswalk_nums for edge in self.controlled_crosswalks_dict[num]['related_junction_edges']]
+        # Any crosswalk that is not disabled (including 1 and 2) is an alternative
+        self.alternative_crosswalks_num = [num for num in self.controlled_crosswalks_dict.keys() if num not in crosswalk_nums]
+        self.alternative_crosswalks_flat = [crosswalk_id for num in self.alternative_crosswalks_num for crosswalk_id in self.controlled_crosswalks_dict[num]['ids']]
+        self.currently_rerouted = set()
+
+        if self.crosswalk_enforcement == 'native':
+            self._apply_crosswalk_permissions(previously_disabled, set(crosswalks_to_disable))
+
+    def _apply_crosswalk_permissions(self, previously_disabled, disabled):
+        """
+        Close (disallow pedestrians) or open the crosswalk lanes that changed.
+        New persons are routed by SUMO around the closed crosswalks. 
+        The persons that are already walking in the vicinity of a changed crosswalk get a new route from SUMO (rerouteTraveltime, with the current permissions). 
+        They are read from the collector's person index of the last step (no getIDList, no call per person in the simulation).
+        This happens once per change (not every step). There is no routing in python.
+        A crosswalk that is not in the loaded network (removed by a design) is skipped.
+        Note: SUMO (1.20) builds its pedestrian router at the first routing of a simulation and does not rebuild it when the permissions change. 
+        A crosswalk closed after that is still used by the router (also by rerouteTraveltime), and SUMO can crash when a person reaches it.
+        """
+        changed = disabled ^ previously_disabled
+        for crosswalk_id in changed:
+            lane_id = f"{crosswalk_id}_0"
+            if lane_id not in self.collector.known_lanes:
+                continue
+            if crosswalk_id in disabled:
+                self.sim.lane.setDisallowed(lane_id, ["all"]) # Not ["pedestrian"]: that would open the crossing to every vehicle class (and vehicles get routed over it)
+            else:
+                self.sim.lane.setAllowed(lane_id, ["pedestrian"])
+
+        persons_to_reroute = set()
+        for crosswalk_id in changed:
+            for edge in self.crosswalk_to_vicinity_walking_edges[crosswalk_id]:
+                persons_to_reroute.update(self.collector.get_person_ids(edge))
+        for ped_id in persons_to_reroute:
+            try:
+                self.sim.person.rerouteTraveltime(ped_id)
+            except get_command_errors(self.sim): # E.g., the person is not walking (waiting or riding) at the moment
+                pass
+
+    def _enforce_crosswalks(self):
+        """
+        Called every step. With the 'native' engine, SUMO enforces the closures (nothing to do here, O(1) in the number of pedestrians).
+        """
+        if self.crosswalk_enforcement == 'python' and self.crosswalks_to_disable:
+            self._disallow_pedestrians(self.walking_edges_to_reroute_from, self.related_junction_edges_to_lookup_from)
 
     def _check_vicinity(self, current_edge, walking_edges_to_reroute_from, remaining_edges, related_junction_edges_to_lookup_from, forward_lookup=False):
         """
@@ -917,60 +999,51 @@ class ControlEnv(gym.Env):
             # else:
             #     return False
 
-    def reset(self, options=None):
+    def _get_sumo_args(self, load_state=None):
         """
+        SUMO options (without the binary). Same for start() and load().
+        load_state: a snapshot to start from (the simulation starts at the time of the snapshot).
         """
-        super().reset()
-        if self.sumo_running:
-            time.sleep(5) # Wait until the process really finishes 
-            traci.close(False) #https://sumo.dlr.de/docs/TraCI/Interfacing_TraCI_from_Python.html
-        
-        # Automatically scale demand (separately for pedestrian and vehicle)
-        scale_factor_vehicle = random.uniform(self.demand_scale_min, self.demand_scale_max)
-        scale_factor_pedestrian = random.uniform(self.demand_scale_min, self.demand_scale_max)
-
-        scale_demand(self.vehicle_input_trips, self.vehicle_output_trips, scale_factor_vehicle, demand_type="vehicle")
-        scale_demand(self.pedestrian_input_trips, self.pedestrian_output_trips, scale_factor_pedestrian, demand_type="pedestrian")
-
-        # # This should be done here before the SUMO call. This can disallow pedestrians before the simulation run.
-        # # Randomly select crosswalks to disable
-        # to_disable = random.sample(self.controlled_crosswalks, min(5, len(self.controlled_crosswalks)))
-        
-        # #Before sumo call 
-        # self._modify_net_file(to_disable)
-
-        # create the new sumocfg file before the call
-        create_new_sumocfg(self.network_iteration)
-
+        sumo_args = list(SUMO_PROFILES[self.sumo_profile])
         if self.auto_start:
-            sumo_cmd = ["sumo-gui" if self.use_gui else "sumo", 
-                        "--verbose",
-                        "--start" , 
-                        "--quit-on-end", 
-                        "-c", "./SUMO_files/iterative_craver.sumocfg  ", 
-                        "--step-length", str(self.step_length),
-                        "--route-files", f"{self.vehicle_output_trips},{self.pedestrian_output_trips}"
-                        ]
-                        
-        else:
-            sumo_cmd = ["sumo-gui" if self.use_gui else "sumo", 
-                        "--verbose",
-                        "--quit-on-end", 
-                        "-c", "./SUMO_files/iterative_craver.sumocfg  ", 
+            sumo_args.append("--start")
+        sumo_args.extend(["--quit-on-end", 
+                        "-c", self.sumocfg_file, 
                         "--step-length", str(self.step_length),
-                        "--route-files", f"{self.vehicle_output_trips},{self.pedestrian_output_trips}"
-                        ]
-                        
+                        ])
+        if self.route_files:
+            sumo_args.extend(["--route-files", ",".join(self.route_files)])
+        if self.snapshot_cache is not None:
+            sumo_args.append("--save-state.transportables") # Without it, the persons (walking or added through TraCI) are not in the snapshots
+        if self.sumo_seed is not None:
+            sumo_args.extend(["--seed", str(self.sumo_seed)])
+        if load_state is not None:
+            sumo_args.extend(["--load-state", load_state])
+        return sumo_args
+
+    def _start_sumo(self, sumo_args):
+        """
+        Start a new SUMO instance. 
+        start() itself polls until SUMO accepts the connection. If it fails anyway (e.g., the port got taken), retry right away on a new port.
+        """
+        sumo_cmd = ["sumo-gui" if self.use_gui else "sumo"] + sumo_args
         max_retries = 3
         try:
             for attempt in range(max_retries):
                 try:
-                    traci.start(sumo_cmd)
+                    if self.sumo_label is not None:
+                        traci.start(sumo_cmd, label=self.sumo_label)
+                        # From now on, talk to this instance through its own connection object (same API as the traci module).
+                        self.sim = traci.getConnection(self.sumo_label)
+                        self.collector.sim = self.sim
+                        if self.demand_injector is not None:
+                            self.demand_injector.sim = self.sim
+                    else:
+                        self.sim.start(sumo_cmd)
                     break
-                except traci.exceptions.FatalTraCIError:
+                except get_start_errors(self.sim):
                     if attempt < max_retries - 1:
                         print(f"TraCI connection failed. Retrying... (Attempt {attempt + 1}/{max_retries})")
-                        time.sleep(10)
                     else:
                         print(f"Failed to start TraCI after {max_retries} attempts.")
                         raise
@@ -978,39 +1051,216 @@ class ControlEnv(gym.Env):
             print(f"An unexpected error occurred: {str(e)}")
             raise
 
+    def _wait_until_ready(self):
+        """
+        Instead of sleeping for a fixed time, poll SUMO until it answers (the simulation time is 0 after a start/ load).
+        """
+        deadline = time.perf_counter() + self.sumo_ready_timeout
+        while True:
+            try:
+                self.sim.simulation.getTime()
+                return
+            except get_start_errors(self.sim):
+                if time.perf_counter() > deadline:
+                    raise
+                time.sleep(0.01)
+
+    def _apply_demand_scale(self, scale_factor_vehicle, scale_factor_pedestrian):
+        """
+        Native demand mode: SUMO scales the traffic of the vehicle and pedestrian types (the scale of the types is reset on every load).
+        Same rate as the rewritten files (the original demand spans an hour), non integer factors are exact.
+        """
+        if self.demand_mode != 'native':
+            return
+        self.sim.vehicletype.setScale(DEMAND_TYPE_IDS['vehicle'], scale_factor_vehicle)
+        self.sim.vehicletype.setScale(DEMAND_TYPE_IDS['pedestrian'], scale_factor_pedestrian)
+        print(f"Demand scaled by SUMO: vehicle {scale_factor_vehicle:.2f}, pedestrian {scale_factor_pedestrian:.2f}")
+
+    def _inject_demand(self, until_time):
+        """
+        Inject demand mode: add the vehicles and persons that depart until the target time of the next simulation step.
+        """
+        if self.demand_injector is not None:
+            self.demand_injector.inject(until_time)
+
+    def _get_demand_files(self):
+        """
+        The trips files of this episode: pre-routed for the current network iteration if the route cache is used, the original input trips otherwise.
+        In the superset mode, the pedestrian trips are never pre-routed: SUMO routes the walks with the lane permissions of the design (see superset.py).
+        The input trips are also used if there is no net file for the network iteration.
+        """
+        if self.route_cache is None:
+            return self.vehicle_input_trips, self.pedestrian_input_trips
+        net_file = f"{self.network_dir}/network_iteration_{self._get_network_label()}.net.xml"
+        if not os.path.exists(net_file):
+            return self.vehicle_input_trips, self.pedestrian_input_trips
+        if self.superset is not None:
+            return self.route_cache.get(net_file, self.vehicle_input_trips), self.pedestrian_input_trips
+        return tuple(self.route_cache.prepare(net_file, [self.vehicle_input_trips, self.pedestrian_input_trips]))
+
+    def _get_network_label(self):
+        """
+        The network file of the episode is network_iteration_{label}.net.xml. The network iteration, or the superset network in the superset mode.
+        """
+        return SupersetNetwork.NETWORK_ITERATION if self.superset is not None else self.network_iteration
+
+    def _acquire_snapshot(self, scale_factor_vehicle, scale_factor_pedestrian):
+        """
+        Before SUMO is (re)loaded: returns (snapshot_path, status), see SnapshotCache.acquire. (None, None) without warm-up or snapshots.
+        A snapshot to 'load' is passed to SUMO with --load-state. 
+        Loading it afterwards (simulation.loadState) duplicates the demand of the route files that SUMO already read ahead from t=0.
+        """
+        if self.warmup_steps <= 0 or self.snapshot_cache is None:
+            return None, None
+        snapshot_path = self.snapshot_cache.get_path(self.network_iteration, scale_factor_vehicle, scale_factor_pedestrian, self.sumo_seed, profile=self.sumo_profile)
+        return snapshot_path, self.snapshot_cache.acquire(snapshot_path)
+
+    def _warm_up(self, snapshot_path=None, snapshot_status=None):
+        """
+        Run the warm-up (no actions, the TL runs its default program), unless SUMO started from a snapshot. Saves the snapshot if this worker creates it.
+        The episode starts after the warm-up (step_count is still 0).
+        """
+        if self.warmup_steps <= 0:
+            return
+        if snapshot_status == 'load':
+            if self.demand_injector is not None:
+                self.demand_injector.skip_to(self.sim.simulation.getTime()) # The demand until the snapshot is in the saved state
+            return
+
+        warmup_time = self.warmup_steps * self.step_length
+        self._inject_demand(warmup_time)
+        self.sim.simulationStep(warmup_time) # Simulate until this time in a single call
+        if snapshot_status == 'create':
+            self.snapshot_cache.save(self.sim, snapshot_path)
+            print(f"Saved warm-up snapshot: {snapshot_path}")
+
+    def reset(self, seed=None, options=None):
+        """
+        If persistent_sumo, the running SUMO instance is reused: load() the (new) network and new route files. 
+        Otherwise (or if SUMO is not running yet), close and start a new instance.
+        options can contain a 'network_iteration' to switch to a new network.
+        seed (as in gymnasium, usually only given at the first reset): the env's own generator is seeded with it, and every episode after it gets a SUMO seed (--seed) drawn from it.
+        """
+        super().reset(seed=seed)
+        if seed is not None:
+            self.rng = random.Random(seed)
+        if options is not None and 'network_iteration' in options:
+            self.network_iteration = options['network_iteration']
+        if self.walking_stage_memo_iteration != self.network_iteration: # Routes of the older network are stale.
+            self.walking_stage_memo = {}
+            self.walking_stage_memo_iteration = self.network_iteration
+
+        if self.sumo_running and not self.persistent_sumo:
+            close_backend(self.sim, wait=True) # Wait until the process really finishes 
+            self.sumo_running = False
+        
+        # Automatically scale demand (separately for pedestrian and vehicle). Unless a manual demand is given.
+        scale_factor_vehicle = self.manual_scale_vehicle if self.manual_scale_vehicle is not None else self.rng.uniform(self.demand_scale_min, self.demand_scale_max)
+        scale_factor_pedestrian = self.manual_scale_pedestrian if self.manual_scale_pedestrian is not None else self.rng.uniform(self.demand_scale_min, self.demand_scale_max)
+        if self.snapshot_cache is not None: 
+            # Snap to the demand buckets so that the route files match a shared snapshot.
+            scale_factor_vehicle = self.snapshot_cache.quantize(scale_factor_vehicle)
+            scale_factor_pedestrian = self.snapshot_cache.quantize(scale_factor_pedestrian)
+            self.sumo_seed = self.rng.randrange(self.num_snapshot_seeds)
+        else:
+            if self.rng is not random: # Seeded
+                self.sumo_seed = self.rng.randrange(2**31)
+            if self.demand_library is not None:
+                scale_factor_vehicle = self.demand_library.quantize(scale_factor_vehicle)
+                scale_factor_pedestrian = self.demand_library.quantize(scale_factor_pedestrian)
+
+        vehicle_trips, pedestrian_trips = self._get_demand_files()
+        if self.demand_mode == 'native':
+            # The original (or pre-routed) files, unchanged. The scale factors are set once SUMO is running (_apply_demand_scale).
+            self.route_files = [vehicle_trips, pedestrian_trips]
+        elif self.demand_mode == 'inject':
+            self.route_files = [] # Added by the demand injector once SUMO is running
+        elif self.demand_library is not None:
+            # Just pick the paths (the files are only generated the first time a scale factor is used on this machine).
+            self.route_files = [self.demand_library.get(vehicle_trips, scale_factor_vehicle, demand_type="vehicle"),
+                                self.demand_library.get(pedestrian_trips, scale_factor_pedestrian, demand_type="pedestrian")]
+        else:
+            scale_demand(vehicle_trips, self.vehicle_output_trips, scale_factor_vehicle, demand_type="vehicle")
+            scale_demand(pedestrian_trips, self.pedestrian_output_trips, scale_factor_pedestrian, demand_type="pedestrian")
+            self.route_files = [self.vehicle_output_trips, self.pedestrian_output_trips]
+
+        # # This should be done here before the SUMO call. This can disallow pedestrians before the simulation run.
+        # # Randomly select crosswalks to disable
+        # to_disable = random.sample(self.controlled_crosswalks, min(5, len(self.controlled_crosswalks)))
+        
+        # #Before sumo call 
+        # self._modify_net_file(to_disable)
+
+        # create the new sumocfg file before the call
+        create_new_sumocfg(self._get_network_label(), config_path=self.sumocfg_file, network_dir=self.network_dir)
+
+        snapshot_path, snapshot_status = self._acquire_snapshot(scale_factor_vehicle, scale_factor_pedestrian)
+        sumo_args = self._get_sumo_args(load_state=snapshot_path if snapshot_status == 'load' else None)
+        try:
+            if self.sumo_running: # Persistent
+                self.sim.load(sumo_args)
+            else:
+                self._start_sumo(sumo_args)
+            self._wait_until_ready()
+            if self.superset is not None:
+                # Before the first step, SUMO has not read the walks yet (they are routed with these permissions).
+                if not self.superset.candidates:
+                    self.superset.load()
+                num_active = self.superset.apply(self.sim, self.network_iteration)
+                print(f"Superset design {self.network_iteration}: {num_active} of {len(self.superset.candidates)} candidate crosswalks active")
+            self._apply_demand_scale(scale_factor_vehicle, scale_factor_pedestrian)
+            if self.demand_injector is not None:
+                self.demand_injector.reset(load_demand_table(vehicle_trips, 'vehicle'), 
+                                           load_demand_table(pedestrian_trips, 'pedestrian'), 
+                                           scale_factor_vehicle, scale_factor_pedestrian)
+            self._warm_up(snapshot_path, snapshot_status)
+        except Exception:
+            if snapshot_status == 'create': # Do not let the other workers wait for it
+                self.snapshot_cache.release(snapshot_path)
+            raise
+        self.sim_time = self.sim.simulation.getTime() # Tracked locally from here on (for coalesced steps)
+        self.last_signal_state = None # The TL runs its default program in a new simulation
+
         self.sumo_running = True
         self.step_count = 0 # This counts the timesteps in an episode. Needs reset.
         self.current_action_step = 0
-        self.tl_lane_dict = {}
-        self.tl_lane_dict['cluster_172228464_482708521_9687148201_9687148202_#5more'] = initialize_lanes()
+        self.tl_pedestrian_status.reset() # Person ids are reused in the new episode
+        self.crosswalks_to_disable = [] # A new simulation starts with all crosswalks open
+        self.currently_rerouted = set()
+        self.collector.subscribe() # Subscriptions are lost on close and load.
+        self.termination_detector.reset()
+        self.termination_reason = None
 
         # Randomly initialize the actions (current tl phase group and combined binary action for crosswalks) 
-        self.current_tl_phase_group = random.choice([0, 1, 2, 3]) # not including [4, 5] from the list
-        self.current_crosswalk_actions = str(random.randint(0, 1)) + str(random.randint(0, 1))
+        self.current_tl_phase_group = self.rng.choice([0, 1, 2, 3]) # not including [4, 5] from the list
+        self.current_crosswalk_actions = str(self.rng.randint(0, 1)) + str(self.rng.randint(0, 1))
 
         action_list = [int(x) for x in str(self.current_tl_phase_group) + self.current_crosswalk_actions]
         initial_action = torch.tensor(action_list, dtype=torch.long)
         print(f"\nInitial action: {initial_action}\n")
 
         # Initialize the observation buffer
-        observation_buffer = []
+        observation_buffer = self.observation_buffer
         for step in range(self.steps_per_action):
             # Apply the current phase group using _apply_action
             self._apply_action(initial_action, step, None)
-            traci.simulationStep()
+            self._inject_demand(self.sim_time + self.step_length)
+            self.sim.simulationStep()
+            self.sim_time += self.step_length
+            self.collector.update()
+            self.tl_pedestrian_status.update(self.collector, self.sim)
 
             # TODO: For the time being. Modify it later.
-            #obs = self._get_observation()
-            obs = np.random.rand(40)
-            observation_buffer.append(obs)
+            #self._get_observation(out=observation_buffer[step])
+            observation_buffer[step] = np.random.rand(40)
 
-        observation = np.asarray(observation_buffer, dtype=np.float32)
+        observation = observation_buffer.copy()
         info = {}
         return observation, info
 
     def close(self):
         if self.sumo_running:
-            traci.close(False) #https://sumo.dlr.de/docs/TraCI/Interfacing_TraCI_from_Python.html
+            close_backend(self.sim)
             self.sumo_running = False
 
     
\ No newline at end of file
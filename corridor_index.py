@@ -0,0 +1,79 @@
+import bisect
+import numpy as np
+
+class SegmentIndex:
+    """
+    The horizontal pedestrian segments (start x, end x, edge) along one side of the corridor, sorted by x. Zero length segments are left out.
+    """
+
+    def __init__(self, segments):
+        self.starts = [] # sorted start x
+        self.segments = [] # (start, end, edge) in the same order
+        for start, length, edge in sorted(segments, key=lambda segment: segment[0]):
+            self._insert(start, start + length, edge)
+
+    @classmethod
+    def from_horizontal_segment(cls, horizontal_segment):
+        """
+        From one side of _get_horizontal_segment_ped ({start x: [length, edge]}).
+        """
+        return cls([(start, length, (edge[0], edge[1])) for start, (length, edge) in horizontal_segment.items()])
+
+    def _insert(self, start, end, edge):
+        if not start < end:
+            return
+        index = bisect.bisect_right(self.starts, start)
+        if (index > 0 and self.segments[index - 1][1] > start) or (index < len(self.segments) and self.starts[index] < end):
+            raise ValueError(f"Pedestrian segment {edge} overlaps another segment.")
+        self.starts.insert(index, start)
+        self.segments.insert(index, (start, end, edge))
+
+    def copy(self):
+        index = SegmentIndex([])
+        index.starts = list(self.starts)
+        index.segments = list(self.segments)
+        return index
+
+    def find(self, x_location):
+        """
+        The segment (start, end, edge) with start <= x_location < end (denormalized). None if there is none.
+        """
+        index = bisect.bisect_right(self.starts, x_location) - 1
+        if index >= 0 and x_location < self.segments[index][1]:
+            return self.segments[index]
+        return None
+
+    def split(self, x_location, new_node, graph):
+        """
+        The segment at x_location was split in the graph by new_node (edges (from, new_node) and (to, new_node)). Replace it by the two new segments.
+        """
+        index = bisect.bisect_right(self.starts, x_location) - 1
+        _, _, (from_node, to_node) = self.segments.pop(index)
+        self.starts.pop(index)
+        new_x = graph.nodes[new_node]['pos'][0]
+        for node in (from_node, to_node):
+            node_x = graph.nodes[node]['pos'][0]
+            smaller_x, larger_x = min(node_x, new_x), max(node_x, new_x)
+            self._insert(smaller_x, smaller_x + (larger_x - smaller_x), (node, new_node)) # The graph lists the new edge from the older node
+
+class CenterlineInterpolator:
+    """
+    y of the vehicle centerline of the corridor at a given x, piecewise linear over the bottom (left to right) original vehicle edges.
+    """
+
+    def __init__(self, horizontal_edges_veh_original_data):
+        edges = sorted(horizontal_edges_veh_original_data['bottom'].values(), key=lambda edge_data: edge_data['from_x'])
+        x_points = [edges[0]['from_x']]
+        y_points = [edges[0]['from_y']]
+        for edge_data in edges:
+            if (edge_data['from_x'], edge_data['from_y']) != (x_points[-1], y_points[-1]):
+                raise ValueError(f"The corridor vehicle edges are not continuous at x={edge_data['from_x']}.")
+            x_points.append(edge_data['to_x'])
+            y_points.append(edge_data['to_y'])
+        self.x_points = np.array(x_points)
+        self.y_points = np.array(y_points)
+
+    def __call__(self, denorm_x_coordinate):
+        if not self.x_points[0] <= denorm_x_coordinate <= self.x_points[-1]:
+            raise ValueError(f"x={denorm_x_coordinate} is outside the corridor ({self.x_points[0]} to {self.x_points[-1]}).")
+        return float(np.interp(denorm_x_coordinate, self.x_points, self.y_points))
@@ -0,0 +1,139 @@
+import random
+import hashlib
+import numpy as np
+from demand_table import get_scaled_departs
+from sim_backend import get_command_errors
+
+class DemandInjector:
+    """
+    Adds the demand to a running simulation through TraCI instead of route files (demand_mode 'inject').
+    The trips are held as demand tables (demand_table.py) and the scaled demand of an episode as sorted arrays (get_scaled_departs), same demand as the route files.
+    Every step, the vehicles and persons whose depart falls before the next step target are added (with their exact depart):
+    - Vehicles: vehicle.add on a route. Pre-routed demand (route_cache.py) has the full route edges. Otherwise the route only has the from and to edges and SUMO routes the trip at insertion (like a trip in a route file).
+    - Persons: person.add and appendWalkingStage with the walk edges of the pre-routed demand. Otherwise the walking route from from to to (memoized per edge pair by the env).
+    With a persistent SUMO process, a new episode with a new demand scale needs no file writes and no restart, only load() of the network.
+
+    sim is the simulation backend. Routes and persons are lost on every load(), reset() is called after each.
+    The tables are given in every reset (a new network iteration has its own pre-routed demand).
+    """
+
+    def __init__(self, sim, find_walking_stage, seed=None):
+        self.sim = sim
+        self.find_walking_stage = find_walking_stage # (from_edge, to_edge) -> Stage. ControlEnv._find_walking_stage
+        self.rng = random.Random(seed) # For 'random' departPos/ arrivalPos
+
+        self.column_cache = {} # id of the table -> (table, columns)
+        self.vehicle_table = None
+        self.pedestrian_table = None
+        self.vehicle_columns = {}
+        self.pedestrian_columns = {}
+        self.edge_lengths = {}
+        self.routes = set()
+        self.vehicles = (np.empty(0), np.empty(0, dtype=int), np.empty(0, dtype=int))
+        self.persons = (np.empty(0), np.empty(0, dtype=int), np.empty(0, dtype=int))
+        self.vehicle_index = 0
+        self.person_index = 0
+
+    def _get_columns(self, table):
+        """
+        Columns are converted to lists once per table (the tables are memory-mapped, indexing lists is cheaper per entry).
+        """
+        cached = self.column_cache.get(id(table))
+        if cached is None or cached[0] is not table:
+            cached = (table, {name: table[name].tolist() for name in table.dtype.names}) # Holds the table, so the id is not reused
+            self.column_cache[id(table)] = cached
+        return cached[1]
+
+    def reset(self, vehicle_table, pedestrian_table, scale_factor_vehicle, scale_factor_pedestrian):
+        """
+        New episode (after the simulation was (re)loaded). Nothing is added yet.
+        """
+        self.vehicle_table = vehicle_table
+        self.pedestrian_table = pedestrian_table
+        self.vehicle_columns = self._get_columns(vehicle_table)
+        self.pedestrian_columns = self._get_columns(pedestrian_table)
+        self.vehicles = get_scaled_departs(self.vehicle_table, scale_factor_vehicle)
+        self.persons = get_scaled_departs(self.pedestrian_table, scale_factor_pedestrian)
+        self.vehicle_index = 0
+        self.person_index = 0
+        self.routes = set()
+        self.edge_lengths = {} # The network may have changed
+
+    def skip_to(self, sim_time):
+        """
+        After a snapshot is loaded: everything that departs until sim_time is already in the (saved) simulation. So are the routes.
+        """
+        self.routes = set(self.sim.route.getIDList())
+        self.vehicle_index = int(np.searchsorted(self.vehicles[0], sim_time, side='right'))
+        self.person_index = int(np.searchsorted(self.persons[0], sim_time, side='right'))
+
+    @property
+    def pending(self):
+        """
+        Number of vehicles and persons that are not added yet.
+        """
+        return (len(self.vehicles[0]) - self.vehicle_index) + (len(self.persons[0]) - self.person_index)
+
+    def inject(self, until_time):
+        """
+        Add everything that departs until until_time (the target time of the next simulation step). Returns the number added.
+        """
+        departs, rows, copies = self.vehicles
+        end = int(np.searchsorted(departs, until_time, side='right'))
+        for i in range(self.vehicle_index, end):
+            self._add_vehicle(rows[i], copies[i], departs[i])
+        added = end - self.vehicle_index
+        self.vehicle_index = end
+
+        departs, rows, copies = self.persons
+        end = int(np.searchsorted(departs, until_time, side='right'))
+        for i in range(self.person_index, end):
+            self._add_person(rows[i], copies[i], departs[i])
+        added += end - self.person_index
+        self.person_index = end
+        return added
+
+    def _add_vehicle(self, row, copy, depart):
+        columns = self.vehicle_columns
+        if 'route_edges' in columns: # Pre-routed
+            edges = columns['route_edges'][row].split()
+            route_id = f"injected_{hashlib.sha1(columns['route_edges'][row].encode()).hexdigest()[:12]}" # Same route, same id (shared by the vehicles)
+        else:
+            edges = [columns['from'][row], columns['to'][row]]
+            route_id = f"injected_{edges[0]}_{edges[1]}"
+        if route_id not in self.routes:
+            try:
+                self.sim.route.add(route_id, edges)
+            except get_command_errors(self.sim): # Already known
+                pass
+            self.routes.add(route_id)
+
+        vehicle_id = columns['id'][row] + (f"_{copy}" if copy > 0 else "")
+        optional = {name: columns[name][row] for name in ['departLane', 'departSpeed', 'fromTaz', 'toTaz'] if name in columns and columns[name][row] != ''}
+        self.sim.vehicle.add(vehicle_id, route_id, typeID=columns['type'][row] if 'type' in columns else 'DEFAULT_VEHTYPE', depart=f"{depart:.2f}", **optional)
+
+    def _add_person(self, row, copy, depart):
+        columns = self.pedestrian_columns
+        if 'walk_edges' in columns and columns['walk_edges'][row] != '': # Pre-routed
+            edges = columns['walk_edges'][row].split()
+        else:
+            edges = self.find_walking_stage(columns['walk_from'][row], columns['walk_to'][row]).edges
+
+        person_id = columns['id'][row] + (f"_{copy}" if copy > 0 else "")
+        depart_pos = self._get_position(columns['departPos'][row] if 'departPos' in columns else '', edges[0])
+        self.sim.person.add(person_id, edges[0], depart_pos, depart=depart)
+        # Without an arrivalPos, walk to the end of the last edge (-1, negative positions count from the end)
+        arrival_pos = self._get_position(columns['walk_arrivalPos'][row] if 'walk_arrivalPos' in columns else '', edges[-1], default=-1)
+        self.sim.person.appendWalkingStage(person_id, edges, arrival_pos)
+
+    def _get_position(self, value, edge, default=0.0):
+        """
+        A position attribute of the trips file ('random', a number or '' if absent) as a position on the edge.
+        """
+        if value == 'random':
+            if edge not in self.edge_lengths:
+                self.edge_lengths[edge] = self.sim.lane.getLength(f"{edge}_0")
+            return self.rng.uniform(0, self.edge_lengths[edge])
+        if value == '':
+            return default
+        return float(value)
@@ -0,0 +1,62 @@
+import os
+import glob
+import hashlib
+import threading
+from utils import scale_demand
+from cache_utils import content_hash, evict_least_recently_used
+
+class DemandLibrary:
+    """
+    Scaled demand files, generated once per quantized scale factor and shared by every worker and run on the machine.
+    """
+
+    FORMAT_VERSION = 1 # Bump if the output of scale_demand changes
+
+    def __init__(self, library_dir, grid_size=0.25, max_bytes=500*1024*1024):
+        self.library_dir = os.path.expanduser(library_dir)
+        self.grid_size = grid_size
+        self.max_bytes = max_bytes
+        os.makedirs(self.library_dir, exist_ok=True)
+
+    def quantize(self, scale_factor):
+        """
+        Snap a demand scale factor to the grid. Never returns 0.
+        """
+        step = max(1, round(scale_factor / self.grid_size))
+        return round(step * self.grid_size, 6)
+
+    def get_path(self, input_file, scale_factor, demand_type):
+        """
+        Path of the scaled demand file in the library (the file may not exist yet). Keyed by the content of the input file, if the input trips change the old files are not used anymore (and get evicted).
+        """
+        key = f"{content_hash(input_file)}|{demand_type}|{scale_factor:g}|{self.FORMAT_VERSION}"
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        return os.path.join(self.library_dir, f"{demand_type}_{scale_factor:g}_{digest}.rou.xml")
+
+    def get(self, input_file, scale_factor, demand_type):
+        """
+        Returns the path of the scaled demand file. Generated (and the library evicted) only if it is not in the library yet.
+        scale_factor is used as is (quantize it first). Workers that miss the same file at the same time both generate it (into their own temporary file), the result is identical.
+        """
+        path = self.get_path(input_file, scale_factor, demand_type)
+        try:
+            os.utime(path) # Hit: mark as recently used
+            return path
+        except FileNotFoundError:
+            pass
+
+        temp_path = path.replace('.rou.xml', f'_{os.getpid()}_{threading.get_ident()}.partial.xml')
+        scale_demand(input_file, temp_path, scale_factor, demand_type)
+        os.replace(temp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the library fits the disk budget. keep is never removed (the file that was just generated).
+        A file that is evicted while a SUMO instance still reads it stays readable for that instance (the open file handle survives the unlink).
+        """
+        removed = evict_least_recently_used(glob.glob(os.path.join(self.library_dir, "*.rou.xml")), self.max_bytes, keep=keep)
+        if removed > 0:
+            print(f"Evicted {removed} demand files from the library.")
+        return removed
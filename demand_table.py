@@ -0,0 +1,172 @@
+import os
+import hashlib
+import threading
+import numpy as np
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+DEMAND_TABLE_DIR = "~/.cache/urban_design/demand_tables"
+DEMAND_TAGS = {'vehicle': ('trip', 'vehicle'), 'pedestrian': ('person',)} # Elements of the demand in a trips/ routes file
+STAGE_TAGS = {'trip': None, 'vehicle': 'route', 'person': 'walk'} # The one child element each of them has (routed vehicles have a route)
+ROUTES_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<routes xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="http://sumo.dlr.de/xsd/routes_file.xsd">\n'
+
+_tables = {} # (input file, size, mtime) -> table. Each file is only loaded once per process.
+_templates = {} # id of the table -> (table, templates for the first copy, templates for the other copies)
+_lock = threading.Lock()
+
+def compile_demand_table(input_file, demand_type):
+    """
+    Parse a trips file once into a NumPy structured array (one row per trip/ person, in file order).
+    - 'depart' is a float column. All other attributes are fixed width string columns (named after the attribute, '' if absent).
+    - The attributes of the child element are in columns prefixed with its tag: 'walk_' for persons (e.g., 'walk_from', 'walk_edges'), 'route_' for routed vehicles ('route_edges').
+    Supported: trips, vehicles with a single route and persons with a single walk. That is what od2trips and duarouter write.
+    """
+    tags = DEMAND_TAGS[demand_type]
+    rows = []
+    columns = {} # Column name -> max length. In the order they are first seen (this is also the order of the attributes in the written XML).
+    for elem in ET.parse(input_file).getroot():
+        if elem.tag not in tags:
+            raise ValueError(f"Unsupported element <{elem.tag}> in {input_file}. Only {tags} elements can be compiled into a demand table.")
+        row = dict(elem.attrib)
+        children = list(elem)
+        stage_tag = STAGE_TAGS[elem.tag]
+        if stage_tag is None:
+            if children:
+                raise ValueError(f"Trip {row.get('id')} in {input_file} has child elements.")
+        else:
+            if len(children) != 1 or children[0].tag != stage_tag:
+                raise ValueError(f"<{elem.tag}> {row.get('id')} in {input_file} does not have exactly one <{stage_tag}>.")
+            row.update({f"{stage_tag}_{name}": value for name, value in children[0].attrib.items()})
+        for name, value in row.items():
+            columns[name] = max(columns.get(name, 1), len(value))
+        rows.append(row)
+
+    if not rows:
+        raise ValueError(f"No {demand_type} demand found in the input file")
+
+    dtype = [(name, np.float64) if name == 'depart' else (name, f"U{length}") for name, length in columns.items()]
+    table = np.zeros(len(rows), dtype=dtype)
+    for name, _ in dtype:
+        if name == 'depart':
+            table[name] = [float(row['depart']) for row in rows]
+        else:
+            table[name] = [row.get(name, '') for row in rows]
+    return table
+
+def _file_hash(input_file):
+    with open(input_file, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+def load_demand_table(input_file, demand_type, table_dir=DEMAND_TABLE_DIR):
+    """
+    The demand table of a trips file, memory-mapped (read only).
+    Compiled once and cached as .npy under the hash of the file content (all processes and runs on the machine share it).
+    Later calls in the same process return the already mapped table, without reading the trips file again.
+    """
+    stat = os.stat(input_file)
+    key = (os.path.abspath(input_file), stat.st_size, stat.st_mtime_ns, demand_type)
+    with _lock:
+        if key in _tables:
+            return _tables[key]
+
+        table_dir = os.path.expanduser(table_dir)
+        os.makedirs(table_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        table_path = os.path.join(table_dir, f"{name}_{demand_type}_{_file_hash(input_file)}.npy")
+        if not os.path.exists(table_path):
+            table = compile_demand_table(input_file, demand_type)
+            # Written to a temporary file and renamed (atomic), a partially written table is never mapped.
+            temp_path = table_path.replace('.npy', f'_{os.getpid()}_{threading.get_ident()}.tmp.npy')
+            np.save(temp_path, table)
+            os.replace(temp_path, table_path)
+            print(f"Compiled {demand_type} demand table: {table_path}")
+
+        _tables[key] = np.load(table_path, mmap_mode='r')
+        return _tables[key]
+
+def _escape(value):
+    """
+    Escaped for an XML attribute and for the % formatting of the templates.
+    """
+    return escape(value, {'"': '&quot;'}).replace('%', '%%')
+
+def _attribute(name, value):
+    return f' {name}="{_escape(value)}"'
+
+def _get_templates(table, demand_type):
+    """
+    One line template per row with the id suffix and the depart left open (%s). Built once per table.
+    Copies other than the first get a 'from' on walks that only have 'edges' (same as before).
+    """
+    cached = _templates.get(id(table))
+    if cached is not None and cached[0] is table:
+        return cached[1], cached[2]
+
+    stage_tag = 'walk' if demand_type == 'pedestrian' else 'route'
+    element_columns = [name for name in table.dtype.names if not name.startswith(f"{stage_tag}_")]
+    stage_columns = [name for name in table.dtype.names if name.startswith(f"{stage_tag}_")]
+    first_copy, other_copies = [], []
+    for row in table:
+        attributes = ''
+        for name in element_columns:
+            if name == 'id':
+                attributes += f' id="{_escape(str(row["id"]))}%s"'
+            elif name == 'depart':
+                attributes += ' depart="%s"'
+            elif row[name] != '':
+                attributes += _attribute(name, str(row[name]))
+        stage = {name[len(stage_tag) + 1:]: str(row[name]) for name in stage_columns if row[name] != ''}
+        if not stage: # A trip
+            template = f"    <trip{attributes}/>\n"
+            first_copy.append(template)
+            other_copies.append(template)
+            continue
+
+        tag = 'person' if demand_type == 'pedestrian' else 'vehicle'
+        stage_attributes = ''.join(_attribute(name, value) for name, value in stage.items())
+        first_copy.append(f"    <{tag}{attributes}>\n        <{stage_tag}{stage_attributes}/>\n    </{tag}>\n")
+        if stage_tag == 'walk' and 'from' not in stage and stage.get('edges', '').split():
+            stage_attributes += _attribute('from', stage['edges'].split()[0])
+        other_copies.append(f"    <{tag}{attributes}>\n        <{stage_tag}{stage_attributes}/>\n    </{tag}>\n")
+
+    _templates[id(table)] = (table, first_copy, other_copies) # Holds the table, so the id is not reused
+    return first_copy, other_copies
+
+def get_scaled_departs(table, scale_factor):
+    """
+    The scaled demand of a table as arrays, sorted by depart: (departs, rows, copies).
+    Same demand as utils.scale_demand_dom: the departs are compressed by the scale factor and int(scale_factor) copies fill the hour.
+    rows is the row in the table and copies the copy index (the id of copy i > 0 gets the suffix _i). departs are rounded to 2 decimals.
+    """
+    num_rows = len(table)
+    num_copies = max(1, int(scale_factor))
+
+    # Same rounding as before: the depart in the first copy is rounded to 2 decimals and the other copies are shifted from that.
+    base_departs = np.char.mod('%.2f', table['depart'] / scale_factor).astype(np.float64)
+    departs = np.concatenate([base_departs + (3600 * i / scale_factor) if i > 0 else base_departs for i in range(num_copies)])
+    departs = np.char.mod('%.2f', departs).astype(np.float64)
+    copies = np.repeat(np.arange(num_copies), num_rows)
+    rows = np.tile(np.arange(num_rows), num_copies)
+    # Sorted by the (rounded) depart, ties by copy and then by the position in the file.
+    order = np.lexsort((rows, copies, departs))
+    return departs[order], rows[order], copies[order]
+
+def write_scaled_demand(table, output_file, scale_factor, demand_type):
+    """
+    Write the scaled demand of a table as a route file (the only place where XML is produced).
+    The departs of all copies are computed and sorted as arrays (get_scaled_departs). Written to a temporary file and renamed (atomic).
+    """
+    first_copy, other_copies = _get_templates(table, demand_type)
+    departs, rows, copies = get_scaled_departs(table, scale_factor)
+    depart_texts = np.char.mod('%.2f', departs)
+
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    temp_output_file = f"{output_file}.tmp"
+    with open(temp_output_file, 'w', encoding='utf-8') as f:
+        f.write(ROUTES_HEADER)
+        f.writelines((first_copy[row] % ('', depart_text)) if copy == 0 else (other_copies[row] % (f"_{copy}", depart_text))
+                     for row, copy, depart_text in zip(rows.tolist(), copies.tolist(), depart_texts.tolist()))
+        f.write("</routes>\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_output_file, output_file)
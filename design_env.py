@@ -20,10 +20,17 @@ import traci
 import queue
 from ppo_alg import PPO, Memory
 from control_env import ControlEnv
+from vec_control_env import ControlVecEnv
 from sim_config import (PHASES, DIRECTIONS_AND_EDGES, 
                        CONTROLLED_CROSSWALKS_DICT, initialize_lanes)
 from utils import *
 from models import CNNActorCritic
+from snapshots import SnapshotCache
+from route_cache import RouteCache
+from superset import SupersetNetwork
+from network_cache import NetworkCache
+from plain_network import PlainNetwork, COMPONENT_EXTENSIONS
+from corridor_index import SegmentIndex, CenterlineInterpolator
 
 def parallel_worker(rank, control_args, model_init_params, policy_old_dict, memory_queue, global_seed, worker_device, network_iteration):
     """
@@ -55,7 +62,8 @@ def parallel_worker(rank, control_args, model_init_params, policy_old_dict, memo
     ep_reward = 0
     steps_since_update = 0
     
-    for _ in range(control_args['total_action_timesteps_per_episode']):
+    total_action_timesteps = control_args['total_action_timesteps_per_episode']
+    for action_timestep in range(total_action_timesteps):
         state_tensor = torch.FloatTensor(state).to(worker_device)
 
         # Select action
@@ -69,13 +77,15 @@ def parallel_worker(rank, control_args, model_init_params, policy_old_dict, memo
         # These reward and next_state are for the action_duration timesteps.
         next_state, reward, done, truncated, info = lower_env.step(action)
         ep_reward += reward
+        truncated = truncated or action_timestep == total_action_timesteps - 1 # The episode also ends (cut short) when the worker runs out of action timesteps
 
-        # Store data in memory
-        local_memory.append(torch.FloatTensor(state), action, logprob, reward, done)
+        # Store data in memory. A truncated step keeps its next state (PPO bootstraps from its value).
+        local_memory.append(torch.FloatTensor(state), action, logprob, reward, done, truncated, torch.FloatTensor(next_state.flatten()))
         steps_since_update += 1
 
         if steps_since_update >= memory_transfer_freq or done or truncated:
             # Put local memory in the queue for the main process to collect
+            local_memory.mark_truncated(torch.FloatTensor(next_state.flatten())) # Memories of all workers are combined, GAE must not chain into the next one
             memory_queue.put((rank, local_memory))
             local_memory = Memory()  # Reset local memory
             steps_since_update = 0
@@ -90,6 +100,74 @@ def parallel_worker(rank, control_args, model_init_params, policy_old_dict, memo
     lower_env.close()
     memory_queue.put((rank, None))  # Signal that this worker is done
 
+def parallel_vec_worker(rank, control_args, model_init_params, policy_old_dict, memory_queue, global_seed, worker_device, network_iteration):
+    """
+    Same as parallel_worker but a single worker drives lower_envs_per_process SUMO instances (ControlVecEnv).
+    The policy acts on the batch of states in one forward pass instead of one forward pass per env.
+    Each env keeps its own memory (trajectory) which is sent to the main process the same way as in parallel_worker.
+    """
+
+    shared_policy_old = CNNActorCritic(model_init_params['model_dim'], model_init_params['action_dim'], **model_init_params['kwargs'])
+    shared_policy_old.load_state_dict(policy_old_dict)
+
+    # Set seed for this worker
+    worker_seed = global_seed + rank
+    random.seed(worker_seed)
+    np.random.seed(worker_seed)
+    torch.manual_seed(worker_seed)
+
+    num_envs = control_args['lower_envs_per_process']
+    lower_envs = ControlVecEnv(control_args, num_envs, network_iteration=network_iteration, worker_id_offset=rank*num_envs)
+    memory_transfer_freq = control_args['memory_transfer_freq']  # Get from config
+
+    local_memories = [Memory() for _ in range(num_envs)]
+    shared_policy_old = shared_policy_old.to(worker_device)
+
+    states, _ = lower_envs.reset()
+    ep_rewards = np.zeros(num_envs)
+    steps_since_update = 0
+    
+    total_action_timesteps = control_args['total_action_timesteps_per_episode']
+    for action_timestep in range(total_action_timesteps):
+        states_tensor = torch.FloatTensor(states.reshape(num_envs, -1)).to(worker_device)
+
+        # Select actions (one batched forward pass)
+        with torch.no_grad():
+            actions, logprobs = shared_policy_old.act_batch(states_tensor)
+            actions = actions.cpu()  # Explicitly Move to CPU, Incase they were on GPU
+            logprobs = logprobs.cpu() 
+
+        next_states, rewards, dones, truncateds, _ = lower_envs.step(actions)
+        ep_rewards += rewards
+
+        # Early termination can end the envs at different steps. The batch stops with the first one: the rest are cut short (truncated) as well.
+        # So are all envs when the worker runs out of action timesteps.
+        batch_ends = dones.any() or truncateds.any() or action_timestep == total_action_timesteps - 1
+        if batch_ends:
+            truncateds = ~dones
+
+        # Store data in memory. A truncated step keeps its next state (PPO bootstraps from its value).
+        for i in range(num_envs):
+            local_memories[i].append(torch.FloatTensor(states[i].flatten()), actions[i], logprobs[i:i+1], float(rewards[i]), bool(dones[i]), bool(truncateds[i]), torch.FloatTensor(next_states[i].flatten()))
+        steps_since_update += 1
+
+        if steps_since_update >= memory_transfer_freq or batch_ends:
+            # Put local memories in the queue for the main process to collect
+            for i in range(num_envs):
+                local_memories[i].mark_truncated(torch.FloatTensor(next_states[i].flatten())) # Memories of all envs are combined, GAE must not chain into the next one
+                memory_queue.put((rank, local_memories[i]))
+            local_memories = [Memory() for _ in range(num_envs)]
+            steps_since_update = 0
+
+        if batch_ends:
+            break
+
+        states = next_states
+
+    print(f"Worker {rank} finished. Total rewards: {ep_rewards}")
+    lower_envs.close()
+    memory_queue.put((rank, None))  # Signal that this worker is done
+
 def pairwise(iterable):
     """
     Generates consecutive pairs from an iterable.
@@ -158,9 +236,17 @@ class DesignEnv(gym.Env):
         self.component_dir = design_args['component_dir']
         self.network_dir = design_args['network_dir']
         clear_folders(self.component_dir, self.network_dir) # Do not change the position of this.
+        # Generated networks by design, shared by all runs on the machine (network_cache.py). A repeated design is copied instead of running netconvert.
+        if design_args.get('use_network_cache', False):
+            self.network_cache = NetworkCache(design_args['network_cache_dir'], max_bytes=design_args['network_cache_max_mb']*1024*1024)
+        else:
+            self.network_cache = None
         
         # Generate the 5 different component XML files (node, edge, connection, type, tllogic) from the net file.
         self._create_component_xml_files(self.design_args['original_net_file'])
+        # Parsed once. Every iteration is a copy (copy-on-write) of the original (base) or of the base (other iterations) in memory, see _update_xml_files.
+        self.original_network = PlainNetwork.from_files(f'{self.component_dir}/original')
+        self.base_network = None # Set when the base XML files are created
 
         # Extract networkx graph from the component files. (Also update locations of nodes in existing_crosswalks)
         pedestrian_networkx_graph  = self._extract_networkx_graph() 
@@ -173,8 +259,27 @@ class DesignEnv(gym.Env):
         self.horizontal_nodes_bottom_ped = ['9727816638', '9727816862', '9727816846', '9727816629', '9727779405', '9740157080', '9727816625', '9740157142', '9740157169', '9740157145', '9740484033', '9740157174', '9740157171', '9740157154', '9740157158', '9740411703', '9740411701', '9740483978', '9740483934', '9740157180', '9740483946', '9740157204', '9740484420', '9740157211', '9740484523', '9740484522', '9740484512', '9740484528', '9739966899', '9739966895']
         
         self.horizontal_edges_veh_original_data = self._get_original_veh_edge_config()
+        # Sorted pedestrian segments of the base graph (copied and split as the crosswalks of a design are added) and the vehicle centerline (y of the middle nodes).
+        base_horizontal_segment = self._get_horizontal_segment_ped(self.horizontal_nodes_top_ped, self.horizontal_nodes_bottom_ped, self.base_networkx_graph)
+        self.base_segment_index = {side: SegmentIndex.from_horizontal_segment(base_horizontal_segment[side]) for side in ['top', 'bottom']}
+        self.centerline_y = CenterlineInterpolator(self.horizontal_edges_veh_original_data)
         self._update_xml_files(self.base_networkx_graph, 'base') # Create base XML files from latest networkx graph
 
+        # 'netconvert': every design step writes the XML components and runs netconvert for a new network.
+        # 'superset': all candidate crosswalks are compiled into one network here (once). A design step only picks the active candidates (superset.py).
+        self.design_mode = design_args.get('design_mode', 'netconvert')
+        if self.design_mode == 'superset':
+            # The candidates can only be where the corridor has a walkway on both sides (and not at the controlled intersection).
+            corridor_min, corridor_max = self._get_corridor_range()
+            self.superset = SupersetNetwork(self.network_dir, 
+                                            grid_size=design_args['superset_grid_size'], 
+                                            widths=design_args['superset_widths'], 
+                                            min_coordinate=max(self.min_coordinate, corridor_min), 
+                                            max_coordinate=min(self.max_coordinate, corridor_max))
+            self._compile_superset()
+        else:
+            self.superset = None
+
         if self.design_args['save_graph_images']:
             save_graph_visualization(graph=pedestrian_networkx_graph, iteration='original')
             save_graph_visualization(graph=self.base_networkx_graph, iteration='base')
@@ -248,26 +353,18 @@ class DesignEnv(gym.Env):
         """
         G = nx.Graph() # undirected graph
 
-        # Parse node file
-        node_tree = ET.parse(f'{self.component_dir}/original.nod.xml')
-        node_root = node_tree.getroot()
-
         # Add all nodes first (we'll remove non-pedestrian nodes later)
-        for node in node_root.findall('node'):
+        for node in self.original_network.nodes.values():
             node_id = node.get('id')
             x = float(node.get('x'))
             y = float(node.get('y'))
             G.add_node(node_id, pos=(x, y), type='regular')
 
-        # Parse edge file
-        edge_tree = ET.parse(f'{self.component_dir}/original.edg.xml')
-        edge_root = edge_tree.getroot()
-        
         # Keep track of nodes that are part of pedestrian paths
         pedestrian_nodes = set()
         
         # Add edges that are pedestrian walkways
-        for edge in edge_root.findall('edge'):
+        for edge in self.original_network.edges.values():
             edge_type = edge.get('type')
             allow = edge.get('allow', '')
             
@@ -296,7 +393,7 @@ class DesignEnv(gym.Env):
         """
         # Node (base_xml.nod.xml), Edge (base_xml.edg.xml), Connection (base_xml.con.xml), Type file (base_xml.typ.xml) and Traffic Light (base_xml.tll.xml)
         # Create the output directory if it doesn't exist
-        output_dir = "./SUMO_files/component_SUMO_files"
+        output_dir = self.component_dir
         os.makedirs(output_dir, exist_ok=True)
         
         # Run netconvert with output files in the specified directory
@@ -327,7 +424,24 @@ class DesignEnv(gym.Env):
         #print(f"\n\nProposals: {proposals}\n\n")
 
         # Apply the action to output the latest SUMO network file as well as modify the iterative_torch_graph.
-        self._apply_action(proposals, iteration)
+        # In the superset mode, there is no new network file. Only the active candidates of the superset network are written.
+        if self.superset is not None:
+            self._apply_superset_action(proposals, iteration)
+        else:
+            self._apply_action(proposals, iteration)
+
+        # The design changed. Warm-up snapshots of the older networks are stale.
+        if self.control_args['use_snapshots']:
+            SnapshotCache(self.control_args['snapshot_dir'], bucket_size=self.control_args['demand_bucket_size']).evict_stale(iteration)
+
+        # Route the demand on the new network once (here, before the workers start), instead of every worker routing every trip in every episode.
+        if self.control_args['use_routed_demand']:
+            # The superset network does not change, this is a cache hit after the first design step. Its walks are routed by SUMO (see superset.py).
+            if self.superset is not None:
+                net_file, trips_files = self.superset.net_file, [self.control_args['vehicle_input_trips']]
+            else:
+                net_file, trips_files = f'{self.network_dir}/network_iteration_{iteration}.net.xml', [self.control_args['vehicle_input_trips'], self.control_args['pedestrian_input_trips']]
+            RouteCache(self.control_args['route_cache_dir'], max_bytes=self.control_args['route_cache_max_mb']*1024*1024).prepare(net_file, trips_files)
 
         # Here you would typically:
         # 1. Calculate the reward
@@ -343,9 +457,11 @@ class DesignEnv(gym.Env):
         memory_queue = manager.Queue()
         processes = []
         
+        # If more than one env per process, each worker drives a vector env.
+        worker_target = parallel_vec_worker if self.control_args['lower_envs_per_process'] > 1 else parallel_worker
         for rank in range(self.control_args['lower_num_processes']):
             p = mp.Process(
-                target=parallel_worker,
+                target=worker_target,
                 args=(
                     rank,
                     self.control_args_worker,
@@ -457,10 +573,101 @@ class DesignEnv(gym.Env):
         3. Update XML
         """
 
+        # With the network cache, the network is built from the canonical design (sorted and rounded), so that the same design always gives the same network (and a cached one can be used).
+        # Without it, the proposals are used as given.
+        design = None
+        if self.network_cache is not None:
+            design = self._canonicalize_proposals(proposals)
+            proposals = [((x - self.normalizer_x['min']) / (self.normalizer_x['max'] - self.normalizer_x['min']), width) for x, width in design]
+
         # First make a copy
         self.iterative_networkx_graph = self.base_networkx_graph.copy()
-        latest_horizontal_nodes_top_ped = self.horizontal_nodes_top_ped
-        latest_horizontal_nodes_bottom_ped = self.horizontal_nodes_bottom_ped
+        self._add_crosswalks_to_graph(self.iterative_networkx_graph, proposals, f"iter{iteration}")
+
+        if self.design_args['save_graph_images']:
+            save_graph_visualization(graph=self.iterative_networkx_graph, iteration=iteration)
+            save_better_graph_visualization(graph=self.iterative_networkx_graph, iteration=iteration)
+
+        # 3. Update XML
+        self._write_network(self.iterative_networkx_graph, iteration, design, node_prefix='iter')
+
+    def _canonicalize_proposals(self, proposals):
+        """
+        The design as a list of [x, width]: the denormalized location and the thickness, rounded to 2 decimals (same as the node coordinates in the XML) and sorted by x.
+        Proposals that only differ in their order or below the rounding give the same design.
+        """
+        design = []
+        for location, thickness in proposals:
+            denorm_location = self.normalizer_x['min'] + float(location) * (self.normalizer_x['max'] - self.normalizer_x['min'])
+            design.append([round(denorm_location, 2), round(float(thickness), 2)])
+        return sorted(design)
+
+    def _write_network(self, networkx_graph, iteration, design, node_prefix):
+        """
+        _update_xml_files through the network cache: a design that was generated before (in any run) is copied from the cache instead of running netconvert.
+        Returns the m_node_mapping.
+        """
+        if self.network_cache is None:
+            return self._update_xml_files(networkx_graph, iteration)
+
+        # The network of a design is built from the original and base component files
+        source_files = [f'{self.component_dir}/{prefix}.{extension}.xml' for prefix in ['original', 'iteration_base'] for extension in COMPONENT_EXTENSIONS]
+        key = self.network_cache.get_key(design, source_files, node_prefix)
+        component_prefix = f'{self.component_dir}/iteration_{iteration}'
+        net_file = f'{self.network_dir}/network_iteration_{iteration}.net.xml'
+        m_node_mapping = self.network_cache.restore(key, component_prefix, net_file)
+        if m_node_mapping is None:
+            m_node_mapping = self._update_xml_files(networkx_graph, iteration)
+            self.network_cache.store(key, component_prefix, net_file, m_node_mapping)
+        return m_node_mapping
+
+    def _compile_superset(self):
+        """
+        Build the superset network: the base graph with every candidate crosswalk, through the same XML/ netconvert pipeline as any design.
+        """
+        superset_graph = self.base_networkx_graph.copy()
+        candidate_proposals = self.superset.get_candidate_proposals()
+        self._add_crosswalks_to_graph(superset_graph, candidate_proposals, "superset")
+        self._write_network(superset_graph, SupersetNetwork.NETWORK_ITERATION, self._canonicalize_proposals(candidate_proposals), node_prefix='superset')
+        self.superset.save()
+
+    def _get_corridor_range(self):
+        """
+        Normalized x range in which both the top and the bottom pedestrian segments of the base graph exist (a crosswalk needs both).
+        The range starts after the corridor edge at the controlled intersection: the control env observes its lanes by id (sim_config), a crosswalk on it would split and rename it.
+        """
+        horizontal_segment = self._get_horizontal_segment_ped(list(self.horizontal_nodes_top_ped), list(self.horizontal_nodes_bottom_ped), self.base_networkx_graph)
+        start_x = max(min(horizontal_segment[side]) for side in ['top', 'bottom'])
+        controlled_edge = self.horizontal_edges_veh_original_data['top']['-16666012#2']
+        start_x = max(start_x, controlled_edge['from_x'], controlled_edge['to_x'])
+        end_x = min(max(start + length for start, (length, _) in horizontal_segment[side].items()) for side in ['top', 'bottom'])
+        x_range = self.normalizer_x['max'] - self.normalizer_x['min']
+        return (start_x - self.normalizer_x['min']) / x_range, (end_x - self.normalizer_x['min']) / x_range
+
+    def _apply_superset_action(self, proposals, iteration):
+        """
+        Superset mode: snap the proposals to the candidates and write the active set for the workers (they switch off the rest at reset).
+        The networkx graph (for the state) gets the snapped crosswalks, so that it matches what is simulated. No XML and no netconvert.
+        """
+        active = self.superset.snap(proposals)
+        snapped_proposals = [(candidate['location'], candidate['width']) for candidate in self.superset.candidates if candidate['id'] in active]
+        print(f"\nSuperset design: {len(proposals)} proposals snapped to {len(active)} candidates\n")
+
+        self.iterative_networkx_graph = self.base_networkx_graph.copy()
+        self._add_crosswalks_to_graph(self.iterative_networkx_graph, snapped_proposals, f"iter{iteration}")
+        if self.design_args['save_graph_images']:
+            save_graph_visualization(graph=self.iterative_networkx_graph, iteration=iteration)
+            save_better_graph_visualization(graph=self.iterative_networkx_graph, iteration=iteration)
+
+        self.superset.save_design(iteration, active)
+
+    def _add_crosswalks_to_graph(self, graph, proposals, node_prefix):
+        """
+        Add the proposed crosswalks (location, thickness) to the networkx graph (in place). 
+        The new nodes are named {node_prefix}_{i}_top, {node_prefix}_{i}_bottom and {node_prefix}_{i}_mid (the mid node becomes the crossing and its traffic light).
+        The graph is a copy of the base graph: the pedestrian segments start as the ones of the base graph and are split as the crosswalks are added.
+        """
+        segment_index = {side: self.base_segment_index[side].copy() for side in ['top', 'bottom']}
 
         for i, (location, thickness) in enumerate(proposals):
             
@@ -472,9 +679,7 @@ class DesignEnv(gym.Env):
             # Add new nodes in both sides in this intersection of type 'regular'.
             # Connect the new nodes to the existing nodes via edges with the given thickness.
 
-            latest_horizontal_segment = self._get_horizontal_segment_ped(latest_horizontal_nodes_top_ped, latest_horizontal_nodes_bottom_ped, self.iterative_networkx_graph) # Start with set of nodes in base graph
-            #print(f"\nLatest horizontal segment: {latest_horizontal_segment}\n")
-            new_intersects = self._find_intersects_ped(denorm_location, latest_horizontal_segment, self.iterative_networkx_graph)
+            new_intersects = self._find_intersects_ped(denorm_location, segment_index, graph)
             #print(f"\nNew intersects: {new_intersects}\n")
 
             mid_node_details = {'top': {'y_cord': None, 'node_id': None}, 'bottom': {'y_cord': None, 'node_id': None}}
@@ -483,26 +688,23 @@ class DesignEnv(gym.Env):
             for side in ['top', 'bottom']:
                  # Remove the old edge first.
                 from_node, to_node = new_intersects[side]['edge'][0], new_intersects[side]['edge'][1]
-                self.iterative_networkx_graph.remove_edge(from_node, to_node)
+                graph.remove_edge(from_node, to_node)
 
                 # Add the new edge  
                 end_node_pos = new_intersects[side]['intersection_pos']
-                end_node_id = f"iter{iteration}_{i}_{side}"
-                self.iterative_networkx_graph.add_node(end_node_id, pos=end_node_pos, type='regular', width=-1) # type for this is regular (width specified for completeness as -1: Not used)
-                self.iterative_networkx_graph.add_edge(from_node, end_node_id, width=2.0) # The width of these edges is default (Not from the proposal)
-                self.iterative_networkx_graph.add_edge(end_node_id, to_node, width=2.0)
-
-                # Modify the horizontal segment (add the new node)
-                if side == 'top':
-                    latest_horizontal_nodes_top_ped.append(end_node_id)
-                else:
-                    latest_horizontal_nodes_bottom_ped.append(end_node_id)
+                end_node_id = f"{node_prefix}_{i}_{side}"
+                graph.add_node(end_node_id, pos=end_node_pos, type='regular', width=-1) # type for this is regular (width specified for completeness as -1: Not used)
+                graph.add_edge(from_node, end_node_id, width=2.0) # The width of these edges is default (Not from the proposal)
+                graph.add_edge(end_node_id, to_node, width=2.0)
+
+                # Modify the horizontal segment (split at the new node)
+                segment_index[side].split(denorm_location, end_node_id, graph)
 
                 mid_node_details[side]['y_cord'] = end_node_pos[1]
                 mid_node_details[side]['node_id'] = end_node_id
 
             # Add the mid node and edges 
-            mid_node_id = f"iter{iteration}_{i}_mid"
+            mid_node_id = f"{node_prefix}_{i}_mid"
             
             # Obtain the y_coordinate of the middle node. Based on adjacent vehicle edges. Use interpolation to find the y coordinate.
             # To ensure that the y coordinates of the graph and the net file are the same. This has to be done here. 
@@ -510,47 +712,29 @@ class DesignEnv(gym.Env):
             # mid_node_pos = (denorm_location, (mid_node_details['top']['y_cord'] + mid_node_details['bottom']['y_cord']) / 2)
 
             # new method, interpolation. Always using the original vehicle edge list (not updated with split of split).
-            mid_node_pos = (denorm_location, interpolate_y_coordinate(denorm_location, self.horizontal_edges_veh_original_data))
-
-            self.iterative_networkx_graph.add_node(mid_node_id, pos=mid_node_pos, type='middle', width=thickness) # The width is used later
-            self.iterative_networkx_graph.add_edge(mid_node_details['top']['node_id'], mid_node_id, width=thickness) # Thickness is from sampled proposal
-            self.iterative_networkx_graph.add_edge(mid_node_id, mid_node_details['bottom']['node_id'], width=thickness) # Thickness is from sampled proposal
+            mid_node_pos = (denorm_location, self.centerline_y(denorm_location))
 
-        if self.design_args['save_graph_images']:
-            save_graph_visualization(graph=self.iterative_networkx_graph, iteration=iteration)
-            save_better_graph_visualization(graph=self.iterative_networkx_graph, iteration=iteration)
-
-        # 3. Update XML
-        self._update_xml_files(self.iterative_networkx_graph, iteration)
+            graph.add_node(mid_node_id, pos=mid_node_pos, type='middle', width=thickness) # The width is used later
+            graph.add_edge(mid_node_details['top']['node_id'], mid_node_id, width=thickness) # Thickness is from sampled proposal
+            graph.add_edge(mid_node_id, mid_node_details['bottom']['node_id'], width=thickness) # Thickness is from sampled proposal
+        return graph
     
-    def _find_segment_intersects_ped(self, segments, x_location):
-        """
-        Helper function to check intersection. 
-        x_location is denormalized.
-        """
-        
-        for start_x, (length, edge) in segments.items():
-            end_x = start_x + length
-            if start_x <= x_location < end_x:
-                return {
-                    'edge': edge,
-                    'start_x': start_x,
-                    'length_x': length
-                }
-                    
-    def _find_intersects_ped(self, x_location, latest_horizontal_segment, latest_graph):
+    def _find_intersects_ped(self, x_location, segment_index, latest_graph):
         """
         Find where a given x-coordinate intersects with the horizontal pedestriansegments.
         Returns the edge IDs and positions where the intersection occurs.
-        The graph is always changing as edges are added/removed.
+        The graph is always changing as edges are added/removed (segment_index is kept up to date with it).
         """
         intersections = {}
 
         for side in ['top', 'bottom']:
             intersections[side] = {}
-            intersect = self._find_segment_intersects_ped(latest_horizontal_segment[side], x_location)
+            intersect = segment_index[side].find(x_location)
+            if intersect is None:
+                raise ValueError(f"No {side} pedestrian segment at x={x_location:.2f}.")
+            edge = intersect[2]
 
-            from_node, to_node = intersect['edge'][0], intersect['edge'][1]
+            from_node, to_node = edge[0], edge[1]
             
             # Extract node positions
             from_x, from_y = latest_graph.nodes[from_node]['pos']
@@ -566,7 +750,7 @@ class DesignEnv(gym.Env):
             # Now simply interpolate y
             y_location = from_y + x_diff * (to_y - from_y)
 
-            intersections[side]['edge'] = intersect['edge']
+            intersections[side]['edge'] = edge
             intersections[side]['intersection_pos'] = (x_location, y_location)
 
         return intersections
@@ -819,13 +1003,7 @@ class DesignEnv(gym.Env):
                                     '16666012#16', '16666012#17']
                                 }
         
-        node_file = f'{self.component_dir}/original.nod.xml'
-        node_tree = ET.parse(node_file)
-        node_root = node_tree.getroot()
-
-        edge_file = f'{self.component_dir}/original.edg.xml'
-        edge_tree = ET.parse(edge_file)
-        edge_root = edge_tree.getroot()
+        nodes = self.original_network.nodes # id -> node element
 
         horizontal_edges_veh_original_data = {
             'top': {},
@@ -833,17 +1011,17 @@ class DesignEnv(gym.Env):
         }
 
         for direction in ['top', 'bottom']:
-            for edge in edge_root.findall('edge'):
+            for edge in self.original_network.edges.values():
                 id = edge.get('id')
                 if id in horizontal_edges_veh[direction]:
                     from_node = edge.get('from')
-                    from_node_data = node_root.find(f'node[@id="{from_node}"]')
+                    from_node_data = nodes[from_node]
                     # Convert coordinates to float
                     from_x = float(from_node_data.get('x'))
                     from_y = float(from_node_data.get('y'))
 
                     to_node = edge.get('to')
-                    to_node_data = node_root.find(f'node[@id="{to_node}"]')
+                    to_node_data = nodes[to_node]
                     # Convert coordinates to float
                     to_x = float(to_node_data.get('x'))
                     to_y = float(to_node_data.get('y'))
@@ -864,6 +1042,7 @@ class DesignEnv(gym.Env):
         For base, use the "original" XML component files. For other iterations, use the "base" XML component files as a foundation and add/ remove elements.
         Iterative component files are saved in component_SUMO_files directory.
         Iterative net files are saved in network_iterations directory.
+        Returns the m_node_mapping (for every middle node, the vehicle edges to its left and right).
 
         Networkx graph will already have:
           - End nodes with position values that come from the proposal.
@@ -893,31 +1072,17 @@ class DesignEnv(gym.Env):
             - end with </lane></edge>
         """
 
-        # Parse the XML files
-        prefix = "original" if iteration == 'base' else "iteration_base" # Every iteration will have the same base XML files.
-        
-        node_file = f'{self.component_dir}/{prefix}.nod.xml'
-        node_tree = ET.parse(node_file)
-        node_root = node_tree.getroot()
-
-        edge_file = f'{self.component_dir}/{prefix}.edg.xml'
-        edge_tree = ET.parse(edge_file)
-        edge_root = edge_tree.getroot()
-
-        connection_file = f'{self.component_dir}/{prefix}.con.xml'
-        connection_tree = ET.parse(connection_file)
-        connection_root = connection_tree.getroot() 
-
-        traffic_light_file = f'{self.component_dir}/{prefix}.tll.xml'
-        traffic_light_tree = ET.parse(traffic_light_file)
-        traffic_light_root = traffic_light_tree.getroot()
-
-        type_file = f'{self.component_dir}/{prefix}.typ.xml'
-        type_tree = ET.parse(type_file)
+        # The XML trees (in memory, not parsed again): a copy of the original for base, a copy of the base for other iterations. Every iteration will have the same base XML files.
+        # The copy shares the elements with the original/ base. Adding and removing elements is fine, an element has to be made writable (network.writable) before it is changed.
+        network = (self.original_network if iteration == 'base' else self.base_network).copy()
+        node_root = network.roots['nod']
+        edge_root = network.roots['edg']
+        connection_root = network.roots['con']
+        traffic_light_root = network.roots['tll']
 
         # Find ALL the nodes and edges in the XML component files (nod.xml and edg.xml)
-        nodes_in_xml = { n.get('id'): n for n in node_root.findall('node') } # save the node element itself.
-        edges_in_xml = { (e.get('from'), e.get('to')): e for e in edge_root.findall('edge') } # save the from, to nodes and edge element.
+        nodes_in_xml = dict(network.nodes) # save the node element itself.
+        edges_in_xml = dict(network.edges_by_nodes) # save the from, to nodes and edge element.
 
         # Find PEDESTRIAN nodes and edges in the XML component .edg file. 
         pedestrian_edges_in_xml = {}
@@ -997,6 +1162,7 @@ class DesignEnv(gym.Env):
             tl_name = node.get('tl')
             if tl_name:
                 if tl_name not in default_tl:
+                    node = network.writable('nod', node)
                     node.set('type', 'dead_end')
                     del node.attrib['tl']
 
@@ -1004,7 +1170,8 @@ class DesignEnv(gym.Env):
         # In iterations other than base i.e., in iteration base, there will be no new nodes to add.
         # For regular nodes: <node id=" " x=" " y=" " />
         # For the nodes with type "middle": also add attributes: type = "traffic_light" and tl = "node_id" 
-        node_ids_to_add = pedestrian_nodes_in_graph - set(nodes_in_xml.keys()) 
+        # Sorted: the order of a set changes from process to process (hash randomization) and with it the order of the splits (edge ids). The same graph gives the same files.
+        node_ids_to_add = sorted(pedestrian_nodes_in_graph - set(nodes_in_xml.keys()))
         middle_nodes_to_add = []
         print(f"\nNodes to add: {node_ids_to_add}")
 
@@ -1028,7 +1195,7 @@ class DesignEnv(gym.Env):
 
         # Find the edges to add (present in networkx graph but not in XML component file).
         ped_edges_to_add = set(networkx_graph.edges()) - set(edges_in_xml.keys()) # These are all pedestrian edges.
-        ped_edges_to_add = list(ped_edges_to_add)
+        ped_edges_to_add = sorted(ped_edges_to_add)
         # print(f"\nPedestrian edges to add: Total: {len(ped_edges_to_add)},\n {ped_edges_to_add}\n")
 
         # The edge could be from a type = "regular" node to a type = "regular" node or from a type = "regular" node to a type = "middle" node (crossing).
@@ -1082,8 +1249,7 @@ class DesignEnv(gym.Env):
         # This happens iteratively (because multiple middle nodes may fall on the same vehicle edge) and is a bit complex.
         old_veh_edges_to_remove, new_veh_edges_to_add, updated_conn_root, m_node_mapping = get_new_veh_edges_connections(middle_nodes_to_add, 
                                                                                                          networkx_graph, 
-                                                                                                         f'{self.component_dir}/original.edg.xml', 
-                                                                                                         f'{self.component_dir}/original.nod.xml', 
+                                                                                                         self.original_network, 
                                                                                                          connection_root)
         # print(f"old_veh_edges_to_remove: {old_veh_edges_to_remove}\n")
         # print(f"new_veh_edges_to_add: {new_veh_edges_to_add}\n")
@@ -1205,6 +1371,7 @@ class DesignEnv(gym.Env):
                         connection_element.tail = "\n\t\t"
                         updated_conn_root.append(connection_element)
                         # Then, it can be updated in crossing.
+                        crossing = network.writable('con', crossing)
                         crossing.set('edges', f'{new_edge} -{new_edge}')
 
                     elif crossing.get('edges') == f'-{old_edge} {old_edge}':
@@ -1215,6 +1382,7 @@ class DesignEnv(gym.Env):
                         updated_conn_root.append(connection_element)
 
                         # Then, it can be updated in crossing.
+                        crossing = network.writable('con', crossing)
                         crossing.set('edges', f'-{new_edge} {new_edge}')
 
         
@@ -1223,14 +1391,14 @@ class DesignEnv(gym.Env):
         # They have the edges attribute (which are edges to the right) and outlineShape attribute (the shape of the crossing): 
         
         # outlineShape seems hard to specify, lets not specify and see what it does. They mention it as optional here: https://github.com/eclipse-sumo/sumo/issues/11668
-        # TODO: same node contains right and left components which creates two crossings instead of one. Find a way to avoid this (Only add the right part of the crossing).
-        for e1, e1_data in new_veh_edges_to_add['top'].items(): # Just looking at one direction (top) is enough.
-            if 'right' in e1.split('_')[-1]: # Add only the right part: 
-                e2 = e1.replace('-', '') # To get the bottom edge id.
+        # The crossing of a middle node is over the edges to its right: top `from` and bottom `to` in m_node_mapping (kept up to date through split of split).
+        # Earlier this looked for edge ids ending in 'right', which dropped the crossing of a node whose right edge was split again by a later node.
+        for middle_node, mapping_data in m_node_mapping.items():
+            e1, e2 = mapping_data['top']['from'], mapping_data['bottom']['to']
+            if e1 is not None and e2 is not None:
                 print(f"e1: {e1}, e2: {e2}")
 
                 # Then, a crossing element should be added with those edges.
-                middle_node = e1_data.get('new_node')
                 width = networkx_graph.nodes[middle_node].get('width')
                 crossing_attribs = {'node': middle_node, 'edges': e1 + ' ' + e2, 'priority': '1', 'width': str(width), 'linkIndex': '2' } # Width/ Thickness needs to come from the model.
                 crossing_element = ET.Element('crossing', crossing_attribs)
@@ -1263,6 +1431,7 @@ class DesignEnv(gym.Env):
         
         # TL 5. Add all the new connections.
         for conn in tl_connections_to_add:
+            conn = network.writable('tll', conn) # The default ones are shared with the base
             conn.text = None  
             conn.tail = "\n\t"
             traffic_light_root.append(conn)
@@ -1273,7 +1442,7 @@ class DesignEnv(gym.Env):
             old_edge = direction_data['old']
             if old_edge in old_veh_edges_to_remove:
                 new_edge = direction_data['new']
-                for conn in traffic_light_root.findall('connection'):
+                for conn in traffic_light_root.findall('connection'): # All writable (TL 5)
                     if conn.get('from') == old_edge: # positive
                         conn.set('from', new_edge)
                     if conn.get('from') == f"-{old_edge}": # negative
@@ -1313,15 +1482,14 @@ class DesignEnv(gym.Env):
                 connection_root.remove(conn)
         
         iteration_prefix = f'{self.component_dir}/iteration_{iteration}'
-        node_tree.write(f'{iteration_prefix}.nod.xml', encoding='utf-8', xml_declaration=True)
-        edge_tree.write(f'{iteration_prefix}.edg.xml', encoding='utf-8', xml_declaration=True)
-        connection_tree.write(f'{iteration_prefix}.con.xml', encoding='utf-8', xml_declaration=True)
-        type_tree.write(f'{iteration_prefix}.typ.xml', encoding='utf-8', xml_declaration=True)
-        traffic_light_tree.write(f'{iteration_prefix}.tll.xml', encoding='utf-8', xml_declaration=True)
+        network.write(iteration_prefix)
+        if iteration == 'base':
+            network.build_index()
+            self.base_network = network # The next iterations are copies of this one
 
         # Generate the final net file using netconvert
         output_file = f'{self.network_dir}/network_iteration_{iteration}.net.xml'
-        netconvert_log_file = f'SUMO_files/netconvert_log.txt'
+        netconvert_log_file = os.path.join(os.path.dirname(self.network_dir), 'netconvert_log.txt') # Next to the network iterations (in the run workspace if there is one)
         command = (
             f"netconvert "
             f"--node-files={iteration_prefix}.nod.xml "
@@ -1350,6 +1518,8 @@ class DesignEnv(gym.Env):
                     print("Failed all attempts to run netconvert")
                     raise
 
+        return m_node_mapping
+
     def _initialize_normalizers(self, graph):
         """
         Initialize normalizers based on the graph coordinates
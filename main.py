@@ -13,6 +13,7 @@ from control_env import ControlEnv
 import torch.multiprocessing as mp
 from wandb_sweep import HyperParameterTuner
 from config import classify_and_return_args
+from workspace import create_run_workspace, remove_run_workspace
 from torch.utils.tensorboard import SummaryWriter
 
 def save_config(config, SEED, save_path):
@@ -44,6 +45,17 @@ def train(train_config, is_sweep=False, sweep_config=None):
     print(f"Using device: {worker_device}")
     design_args, control_args, lower_ppo_args, higher_ppo_args = classify_and_return_args(train_config, worker_device)
 
+    # Every run gets its own workspace (on /dev/shm if possible). Network iterations, component files, snapshots and the files of each worker go there.
+    # So several runs can share a machine and the workers do not race on the same files.
+    run_dir = None
+    if train_config['use_run_workspace']:
+        run_dir = create_run_workspace(train_config['workspace_root'], min_free_mb=train_config['workspace_min_free_mb'])
+        design_args.update({'component_dir': os.path.join(run_dir, 'component_SUMO_files'), 
+                            'network_dir': os.path.join(run_dir, 'network_iterations')})
+        control_args.update({'run_dir': run_dir, 
+                             'network_dir': design_args['network_dir'], 
+                             'snapshot_dir': os.path.join(run_dir, 'snapshots')}) # Snapshots are keyed by the network iteration, which is only unique within a run
+
     # Before setup, print stats from dummy environments.
     dummy_envs = {
         'lower': ControlEnv(control_args, worker_id=None), # This is not a standard way to access control env (has to go through control agent). This is only for setup.
@@ -137,6 +149,9 @@ def train(train_config, is_sweep=False, sweep_config=None):
     else:
         writer.close()
 
+    if run_dir is not None and not train_config['keep_workspace']:
+        remove_run_workspace(run_dir)
+
 def evaluate(config, design_env):
     """
     Evaluate "RL agents (design + control)" vs "real-world (original design + TL)".
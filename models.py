@@ -120,7 +120,6 @@ class CNNActorCritic(nn.Module):
     def actor(self, state,):
         shared_features = self.shared_cnn(state)
         action_logits = self.actor_layers(shared_features)
-        print(f"\n\nAction logits: {action_logits}\n\n")
         return action_logits
     
     def critic(self, state):
@@ -132,38 +131,41 @@ class CNNActorCritic(nn.Module):
         Select an action based on the current state:
         - First action: 4-class classification for traffic light
         - Second and third actions: binary choices for crosswalks
+        Single state. See act_batch for multiple states.
         """
-        state_tensor = state.reshape(1, self.in_channels, self.action_duration, self.per_timestep_state_dim)
+        combined_action, log_prob = self.act_batch(state.reshape(1, -1))
+        combined_action = combined_action[0]
+        print(f"\nCombined action: {combined_action}")
+        print(f"\nLog probability: {log_prob}")
+        return combined_action, log_prob
+
+    def act_batch(self, states):
+        """
+        Same as act but for a batch of N states (e.g., one from each env in a vector env). A single forward pass.
+        Returns actions of shape (N, 3) and log probabilities of shape (N,)
+        """
+        state_tensor = states.reshape(-1, self.in_channels, self.action_duration, self.per_timestep_state_dim)
         action_logits = self.actor(state_tensor)
-        print(f"\nAction logits: {action_logits}")
         
         # Split logits into traffic light and crosswalk decisions
         traffic_logits = action_logits[:, :4]  # First 4 logits for traffic light (4-class)
         crosswalk_logits = action_logits[:, 4:]  # Last 2 logits for crosswalks (binary)
-        print(f"\nTraffic logits: {traffic_logits}")
-        print(f"Crosswalk logits: {crosswalk_logits}")
         
         # Multi-class classification for traffic light
         traffic_probs = F.softmax(traffic_logits, dim=1)
         traffic_dist = Categorical(traffic_probs)
         traffic_action = traffic_dist.sample() # This predicts 0, 1, 2, or 3
-        print(f"\nTraffic probabilities: {traffic_probs}")
-        print(f"Traffic action: {traffic_action}")
         
         # Binary choices for crosswalks
         crosswalk_probs = torch.sigmoid(crosswalk_logits)
         crosswalk_dist = Bernoulli(crosswalk_probs)
         crosswalk_actions = crosswalk_dist.sample() # This predicts 0 or 1
-        print(f"\nCrosswalk probabilities: {crosswalk_probs}")
-        print(f"Crosswalk actions: {crosswalk_actions}\n")
         
         # Combine actions
-        combined_action = torch.cat([traffic_action, crosswalk_actions.squeeze(0)], dim=0)
-        print(f"\nCombined action: {combined_action}")
+        combined_action = torch.cat([traffic_action.unsqueeze(1), crosswalk_actions], dim=1)
         
         # Calculate log probabilities
-        log_prob = traffic_dist.log_prob(traffic_action) + crosswalk_dist.log_prob(crosswalk_actions).sum()
-        print(f"\nLog probability: {log_prob}")
+        log_prob = traffic_dist.log_prob(traffic_action) + crosswalk_dist.log_prob(crosswalk_actions).sum(dim=1)
         
         return combined_action.long(), log_prob
 
@@ -0,0 +1,71 @@
+import os
+import json
+import glob
+import shutil
+import hashlib
+import threading
+from cache_utils import content_hash, evict_least_recently_used
+from plain_network import COMPONENT_EXTENSIONS
+
+class NetworkCache:
+    """
+    Generated networks (net file, the five component files and the m_node_mapping) keyed by the design, shared by every run on the machine.
+    """
+
+    FORMAT_VERSION = 1 # Bump if _update_xml_files changes its output
+
+    def __init__(self, cache_dir, max_bytes=500*1024*1024):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, design, source_files, node_prefix):
+        """
+        design: the canonical design (a list of (x, width), JSON serializable, see DesignEnv._canonicalize_proposals). source_files: the files the network is built from.
+        XML comments are not part of their content (netconvert writes the paths of the run into a comment).
+        """
+        source_hashes = [content_hash(path, strip_comments=True) for path in sorted(source_files)]
+        key = json.dumps({'design': design, 'sources': source_hashes, 'node_prefix': node_prefix, 'version': self.FORMAT_VERSION})
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    def restore(self, key, component_prefix, net_file):
+        """
+        On a hit: copy the cached files to {component_prefix}.{ext}.xml and net_file and return the m_node_mapping. None on a miss.
+        The node ids in a restored network are the ones of the design step that generated it (e.g., iter3_0_mid in network iteration 7). Nothing refers to them by id.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            os.utime(entry_dir) # Hit: mark as recently used
+            for extension in COMPONENT_EXTENSIONS:
+                shutil.copyfile(os.path.join(entry_dir, f"network.{extension}.xml"), f"{component_prefix}.{extension}.xml")
+            shutil.copyfile(os.path.join(entry_dir, "network.net.xml"), net_file)
+            with open(os.path.join(entry_dir, "m_node_mapping.json")) as f:
+                m_node_mapping = json.load(f)
+        except FileNotFoundError: # Not in the cache (or evicted while copying)
+            return None
+        print(f"Network restored from the cache ({key}): {net_file}")
+        return m_node_mapping
+
+    def store(self, key, component_prefix, net_file, m_node_mapping):
+        """
+        Add a generated network to the cache (written to a temporary directory and renamed, atomic). Evicts the least recently used networks beyond the disk budget.
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            return
+        temp_dir = f"{entry_dir}_{os.getpid()}_{threading.get_ident()}.partial"
+        os.makedirs(temp_dir, exist_ok=True)
+        for extension in COMPONENT_EXTENSIONS:
+            shutil.copyfile(f"{component_prefix}.{extension}.xml", os.path.join(temp_dir, f"network.{extension}.xml"))
+        shutil.copyfile(net_file, os.path.join(temp_dir, "network.net.xml"))
+        with open(os.path.join(temp_dir, "m_node_mapping.json"), 'w') as f:
+            json.dump(m_node_mapping, f)
+        try:
+            os.rename(temp_dir, entry_dir)
+        except OSError: # Stored by another process in the meantime (same content)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return
+
+        removed = evict_least_recently_used([path for path in glob.glob(os.path.join(self.cache_dir, "*")) if not path.endswith('.partial')], self.max_bytes, keep=entry_dir)
+        if removed > 0:
+            print(f"Evicted {removed} networks from the network cache.")
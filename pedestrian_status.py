@@ -0,0 +1,61 @@
+import sys
+
+class PedestrianStatusStore:
+    """
+    The persons that have crossed at a TL (once crossed, they are not counted as incoming again), evicted when they leave the simulation.
+    """
+
+    def __init__(self, sweep_interval=300):
+        self.sweep_interval = sweep_interval
+        self.reset()
+
+    def reset(self):
+        """
+        Person ids are reused in a new episode.
+        """
+        self.crossed = set()
+        self.steps_since_sweep = 0
+        self.num_evicted = 0
+        self.peak_size = 0
+
+    def __contains__(self, person):
+        return person in self.crossed
+
+    def __len__(self):
+        return len(self.crossed)
+
+    def mark_crossed(self, persons):
+        self.crossed.update(persons)
+        if len(self.crossed) > self.peak_size:
+            self.peak_size = len(self.crossed)
+
+    def evict(self, persons):
+        for person in persons:
+            if person in self.crossed:
+                self.crossed.discard(person)
+                self.num_evicted += 1
+
+    def update(self, collector, sim, num_steps=1):
+        """
+        Called after every collector.update(). sim is the simulation backend (for the periodic sweep).
+        - Every step: evict the persons that arrived in the step (simulation subscription, no extra TraCI calls).
+        - Every sweep_interval steps: evict the persons that are no longer in the simulation (one person.getIDList() call). Catches the ones the arrivals miss (removed persons, arrivals inside coalesced substeps).
+        """
+        if self.crossed:
+            self.evict(collector.arrived_persons)
+
+        self.steps_since_sweep += num_steps
+        if self.sweep_interval is not None and self.steps_since_sweep >= self.sweep_interval:
+            self.steps_since_sweep = 0
+            if self.crossed:
+                in_simulation = set(sim.person.getIDList())
+                self.evict([person for person in self.crossed if person not in in_simulation])
+
+    def get_metrics(self):
+        """
+        To confirm that the store stays flat over an episode. memory_bytes is the size of the set itself (without the id strings, which are shared with the occupancy map).
+        """
+        return {'size': len(self.crossed),
+                'peak_size': self.peak_size,
+                'evicted': self.num_evicted,
+                'memory_bytes': sys.getsizeof(self.crossed)}
@@ -0,0 +1,87 @@
+import copy
+import xml.etree.ElementTree as ET
+
+COMPONENT_EXTENSIONS = ['nod', 'edg', 'con', 'typ', 'tll'] # The five plain XML component files of a network
+
+class PlainNetwork:
+    """
+    The five plain XML component files of a network (node, edge, connection, type, tllogic) in memory, copied copy-on-write for every design iteration.
+    """
+
+    def __init__(self, roots):
+        self.roots = roots # extension -> root element
+        self.shared = set() # ids of the elements that are shared with the parent network
+        self.build_index()
+
+    @classmethod
+    def from_files(cls, prefix):
+        """
+        Parse {prefix}.{ext}.xml.
+        """
+        return cls({extension: ET.parse(f'{prefix}.{extension}.xml').getroot() for extension in COMPONENT_EXTENSIONS})
+
+    def build_index(self):
+        """
+        Index the current elements. Called after parsing. Call again after changing a network that is copied later (the index of a copy starts as the index of its parent).
+        """
+        self.nodes = {node.get('id'): node for node in self.roots['nod'].findall('node')}
+        self.edges = {edge.get('id'): edge for edge in self.roots['edg'].findall('edge')}
+        self.edges_by_nodes = {(edge.get('from'), edge.get('to')): edge for edge in self.edges.values()}
+        self.connections = self.roots['con'].findall('connection')
+        self.crossings = self.roots['con'].findall('crossing')
+        self.tl_logics = {tl.get('id'): tl for tl in self.roots['tll'].findall('tlLogic')}
+        self.node_coordinates = None # id -> x (rounded), built on first use
+
+    def copy(self):
+        """
+        A new network with the same elements (copy-on-write, no parse and no deep copy). Adding and removing children only changes the copy, a shared element has to be made writable first.
+        The index is the one of this network (it is not updated when the copy changes). Nothing changes the elements of a network after it was copied (original and iteration_base are only read).
+        """
+        roots = {}
+        for extension, root in self.roots.items():
+            new_root = ET.Element(root.tag, dict(root.attrib))
+            new_root.text, new_root.tail = root.text, root.tail
+            new_root.extend(root)
+            roots[extension] = new_root
+        network = PlainNetwork.__new__(PlainNetwork)
+        network.roots = roots
+        network.shared = {id(element) for root in roots.values() for element in root}
+        network.nodes = dict(self.nodes)
+        network.edges = dict(self.edges)
+        network.edges_by_nodes = dict(self.edges_by_nodes)
+        network.connections = list(self.connections)
+        network.crossings = list(self.crossings)
+        network.tl_logics = dict(self.tl_logics)
+        network.node_coordinates = None
+        return network
+
+    def writable(self, extension, element):
+        """
+        Returns an element that can be changed: the element itself if it belongs to this network only, a copy otherwise (replaces the element in the root if it is still there).
+        Use the returned element.
+        """
+        if id(element) not in self.shared:
+            return element
+        self.shared.discard(id(element))
+        element_copy = copy.deepcopy(element)
+        root = self.roots[extension]
+        for index, child in enumerate(root):
+            if child is element:
+                root[index] = element_copy
+                break
+        return element_copy
+
+    def get_node_coordinates(self):
+        """
+        x coordinate (rounded to 2 decimals) of every node.
+        """
+        if self.node_coordinates is None:
+            self.node_coordinates = {node_id: round(float(node.get('x')), 2) for node_id, node in self.nodes.items()}
+        return self.node_coordinates
+
+    def write(self, prefix):
+        """
+        Write the five files to {prefix}.{ext}.xml.
+        """
+        for extension, root in self.roots.items():
+            ET.ElementTree(root).write(f'{prefix}.{extension}.xml', encoding='utf-8', xml_declaration=True)
@@ -16,8 +16,10 @@ class Memory:
         self.logprobs = []
         self.rewards = []
         self.is_terminals = []
+        self.truncateds = [] # The trajectory was cut after this step (not terminal). GAE stops here and bootstraps from the value of the next state.
+        self.next_states = [] # The next state of a truncated step (None otherwise)
 
-    def append(self, state, action, logprob, reward, done):
+    def append(self, state, action, logprob, reward, done, truncated=False, next_state=None):
         # clone creates a copy to ensure that subsequent operations on the copy do not affect the original tensor. 
         # Detach removes a tensor from the computational graph, preventing gradients from flowing through it during backpropagation.
         # store cpu tensors
@@ -27,6 +29,17 @@ class Memory:
         self.logprobs.append(logprob.cpu())
         self.rewards.append(reward) # these are scalars
         self.is_terminals.append(done) # these are scalars
+        truncated = truncated and not done # A terminal step has no future to bootstrap from
+        self.truncateds.append(truncated)
+        self.next_states.append(next_state.cpu() if truncated and next_state is not None else None)
+
+    def mark_truncated(self, next_state):
+        """
+        Cut the trajectory after the last step (e.g., the memory is sent to the main process before the episode ends, the next memory of this worker does not follow it in the combined memory).
+        """
+        if self.rewards and not self.is_terminals[-1]:
+            self.truncateds[-1] = True
+            self.next_states[-1] = next_state.cpu()
 
     def clear_memory(self):
         del self.actions[:]
@@ -34,6 +47,8 @@ class Memory:
         del self.logprobs[:]
         del self.rewards[:]
         del self.is_terminals[:]
+        del self.truncateds[:]
+        del self.next_states[:]
 
 class GraphDataset(torch.utils.data.Dataset):
     """
@@ -154,12 +169,13 @@ class PPO:
             param_group['lr'] = new_lr
         return new_lr
     
-    def compute_gae(self, rewards, values, is_terminals, gamma, gae_lambda):
+    def compute_gae(self, rewards, values, is_terminals, gamma, gae_lambda, truncateds=None, bootstrap_values=None):
         """
         Compute the Generalized Advantage Estimation (GAE) for the collected experiences.
         For most steps in the sequence, we use the value estimate of the next state to calculate the TD error.
         For the last step (step == len(rewards) - 1), we use the value estimate of the current state. 
-
+        For a truncated step (the trajectory was cut, e.g., gridlock or max_timesteps), the next entry belongs to another trajectory: 
+        the chain is cut there and the TD error uses bootstrap_values[step] (the value of its next state).
         """ 
         advantages = []
         gae = 0
@@ -168,7 +184,10 @@ class PPO:
         for step in reversed(range(len(rewards))):
 
             # If its the terminal step (which has no future) or if its the last step in our collected experiences (which may not be terminal).
-            if is_terminals[step] or step == len(rewards) - 1:
+            if truncateds is not None and truncateds[step] and not is_terminals[step]:
+                next_value = bootstrap_values[step]
+                gae = 0
+            elif is_terminals[step] or step == len(rewards) - 1:
                 next_value = 0
                 gae = 0
             else:
@@ -182,6 +201,27 @@ class PPO:
 
         return torch.tensor(advantages, dtype=torch.float32).to(self.device)
 
+    def _get_bootstrap_values(self, memory, agent_type):
+        """
+        Value of the next state of every truncated step (0 for the other steps). One critic pass over the next states.
+        """
+        bootstrap_values = [0.0] * len(memory.rewards)
+        indices = [index for index, next_state in enumerate(memory.next_states) if next_state is not None]
+        if not indices:
+            return bootstrap_values
+
+        next_states = [memory.next_states[index] for index in indices]
+        with torch.no_grad():
+            if agent_type == 'lower': # Same input shape as in act_batch
+                next_states = torch.stack([next_state.reshape(-1) for next_state in next_states])
+                next_states = next_states.reshape(-1, self.policy.in_channels, self.policy.action_duration, self.policy.per_timestep_state_dim)
+                next_values = self.policy.critic(next_states.to(self.device))
+            else:
+                next_values = self.policy.critic(Batch.from_data_list(next_states).to(self.device))
+        for index, value in zip(indices, next_values.reshape(-1).tolist()):
+            bootstrap_values[index] = value
+        return bootstrap_values
+
     def update(self, memories, agent_type='higher'):
         """
         Update the policy and value networks using the collected experiences.
@@ -203,6 +243,8 @@ class PPO:
                 combined_memory.logprobs.extend(memory.logprobs)
                 combined_memory.rewards.extend(memory.rewards)
                 combined_memory.is_terminals.extend(memory.is_terminals)
+                combined_memory.truncateds.extend(memory.truncateds)
+                combined_memory.next_states.extend(memory.next_states)
 
             old_states = torch.stack(combined_memory.states).to(self.device)
             with torch.no_grad():
@@ -226,7 +268,8 @@ class PPO:
         print(f"\nValues: {values}")
 
         # Compute GAE
-        advantages = self.compute_gae(combined_memory.rewards, values, combined_memory.is_terminals, self.gamma, self.gae_lambda)
+        bootstrap_values = self._get_bootstrap_values(combined_memory, agent_type)
+        advantages = self.compute_gae(combined_memory.rewards, values, combined_memory.is_terminals, self.gamma, self.gae_lambda, combined_memory.truncateds, bootstrap_values)
 
         # Advantage = how much better is it to take a specific action compared to the average action. 
         # GAE = difference between the empirical return and the value function estimate.
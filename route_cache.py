@@ -0,0 +1,66 @@
+import os
+import glob
+import hashlib
+import threading
+import subprocess
+from cache_utils import content_hash, evict_least_recently_used
+
+class RouteCache:
+    """
+    Trips files routed once per network with duarouter (vehicles get a <route>, persons a <walk> with edges), shared by every worker and run on the machine.
+    """
+
+    DUAROUTER_OPTIONS = ["--ignore-errors", "--no-warnings", "--no-step-log"] # Unroutable trips are dropped (SUMO would drop them at runtime as well)
+
+    def __init__(self, cache_dir, max_bytes=500*1024*1024):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_path(self, net_file, trips_file):
+        """
+        Path of the routed file in the cache (the file may not exist yet). Keyed by the content of the net file and the trips file, a new network iteration gets new routed files.
+        """
+        key = f"{content_hash(net_file)}|{content_hash(trips_file)}|{' '.join(self.DUAROUTER_OPTIONS)}"
+        digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+        name = os.path.splitext(os.path.basename(trips_file))[0]
+        return os.path.join(self.cache_dir, f"{name}_{digest}.rou.xml")
+
+    def get(self, net_file, trips_file):
+        """
+        Returns the path of the routed trips file for this network. duarouter only runs if it is not in the cache yet (e.g., a network the DesignEnv did not prepare).
+        """
+        path = self.get_path(net_file, trips_file)
+        try:
+            os.utime(path) # Hit: mark as recently used
+            return path
+        except FileNotFoundError:
+            pass
+
+        temp_path = path.replace('.rou.xml', f'_{os.getpid()}_{threading.get_ident()}.partial.xml')
+        command = ["duarouter", "--net-file", net_file, "--route-files", trips_file, "--output-file", temp_path] + self.DUAROUTER_OPTIONS
+        try:
+            result = subprocess.run(command, check=True, capture_output=True, text=True)
+            if result.stderr:
+                print(f"Warnings/Errors from duarouter: {result.stderr}")
+        except subprocess.CalledProcessError as e:
+            print(f"Error running duarouter: {e}")
+            print("Error output:", e.stderr)
+            raise
+        finally:
+            # duarouter also writes the route alternatives next to the output (not used)
+            try:
+                os.remove(temp_path.replace('.xml', '.alt.xml'))
+            except FileNotFoundError:
+                pass
+        os.replace(temp_path, path)
+        print(f"Routed {trips_file} for {net_file}: {path}")
+
+        evict_least_recently_used(glob.glob(os.path.join(self.cache_dir, "*.rou.xml")), self.max_bytes, keep=path)
+        return path
+
+    def prepare(self, net_file, trips_files):
+        """
+        Route all trips files for a (new) network. Returns the routed paths.
+        """
+        return [self.get(net_file, trips_file) for trips_file in trips_files]
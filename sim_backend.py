@@ -0,0 +1,57 @@
+import traci
+
+def get_sim_backend(use_libsumo=False, gui=False):
+    """
+    Returns the module through which SUMO is controlled. Everything that was done with traci.* is done with backend.* instead.
+    Both traci and libsumo expose the same API (start, simulationStep, close, person, lane, edge, junction, trafficlight, simulation etc.).
+
+    - traci: SUMO runs as a separate process, every call is a round-trip over a TCP socket. Required for the GUI.
+    - libsumo: SUMO runs inside this python process, every call is a function call (no IPC). Headless only.
+    libsumo keeps one simulation per process. This is fine since each worker is its own process.
+
+    If libsumo is requested together with the GUI (or libsumo is not installed), traci is used.
+    """
+    if use_libsumo:
+        if gui:
+            print("libsumo does not support the GUI. Using traci.")
+        else:
+            try:
+                import libsumo
+                return libsumo
+            except ImportError:
+                print("libsumo is not installed (pip install libsumo). Using traci.")
+    return traci
+
+def get_backend_name(backend):
+    """
+    'libsumo' or 'traci'. A labeled traci connection object (traci.getConnection) is also 'traci'.
+    """
+    return 'libsumo' if getattr(backend, '__name__', 'traci').startswith('libsumo') else 'traci'
+
+def get_start_errors(backend):
+    """
+    Exceptions that a failed start() can raise for this backend. Used for the retries.
+    """
+    errors = [traci.exceptions.FatalTraCIError]
+    for name in ['FatalTraCIError', 'TraCIException']:
+        error = getattr(backend, name, None)
+        if isinstance(error, type) and issubclass(error, Exception):
+            errors.append(error)
+    return tuple(errors)
+
+def get_command_errors(backend):
+    """
+    Exceptions that a failed command (e.g., on an object that does not exist anymore) can raise for this backend.
+    """
+    return (traci.exceptions.TraCIException,) + get_start_errors(backend)
+
+def close_backend(backend, wait=False):
+    """
+    With traci, wait=True blocks until the SUMO process has really finished (instead of sleeping for a fixed time).
+    wait=False does not wait (https://sumo.dlr.de/docs/TraCI/Interfacing_TraCI_from_Python.html).
+    libsumo has no process to wait for.
+    """
+    if get_backend_name(backend) == 'libsumo':
+        backend.close()
+    else:
+        backend.close(wait)
@@ -23,6 +23,7 @@ Phase information (22 characters). Incoming vehicle lanes, or pedestrian crossin
 21: unused
 22: pedestrian crossing west
 """
+import numpy as np
 
 # TL_IDS, PHASES, PHASE_GROUPS, DIRECTIONS, TURNS, ORIGINAL_NET_FILE, CONTROLLED_CROSSWALKS_DICT, initialize_lanes
 
@@ -306,3 +307,155 @@ def initialize_lanes():
         }
     }
 
+# The vTypes of the demand in the original trips files (vehicles use type="DEFAULT_VEHTYPE", persons the default pedestrian type).
+# With the native demand mode, SUMO scales the traffic of these types (vehicletype.setScale).
+DEMAND_TYPE_IDS = {
+    'vehicle': 'DEFAULT_VEHTYPE',
+    'pedestrian': 'DEFAULT_PEDTYPE',
+}
+
+# Named SUMO option bundles (config 'sumo_profile'), from the most faithful to the fastest. Pick per phase of training, benchmark.py (benchmark_sumo_profiles) reports the speed and the drift of each against 'fidelity'.
+# - fidelity: SUMO defaults (striping pedestrian model, Euler position updates) with the verbose log. What the env always ran with.
+# - train-fast: the same models (same trajectories), without the step log, warnings and duration log.
+# - screening: for quickly ranking many network designs. Non-interacting pedestrians (constant speed, never blocked. The striping model is most of the cost on the Craver network),
+#   ballistic position updates and stuck vehicles teleport sooner. The pedestrian metrics drift a lot from 'fidelity'.
+# Not used: --threads and --device.rerouting.threads. On the Craver network they only add overhead (the demand is pre-routed, see route_cache.py). 
+# Neither is --step-method.ballistic in train-fast, it changes the pedestrian arrivals by more than 50%.
+SUMO_PROFILES = {
+    'fidelity': ["--verbose"],
+    'train-fast': ["--no-step-log", "--no-warnings", "--duration-log.disable"],
+    'screening': ["--no-step-log", "--no-warnings", "--duration-log.disable", 
+                  "--pedestrian.model", "nonInteracting", 
+                  "--step-method.ballistic", 
+                  "--time-to-teleport", "120"],
+}
+
+# Incoming (and inside) vehicle lane groups whose vehicles head towards each outgoing direction.
+# E.g., vehicles going north come from the south (straight), from the east (right turn) and from the west (left turn).
+VEHICLE_PRESSURE_SOURCES = {
+    'north': ['south-straight', 'east-right', 'west-left'],
+    'south': ['north-straight', 'east-left', 'west-right'],
+    'east': ['west-straight', 'north-left', 'south-right'],
+    'west': ['east-straight', 'north-right', 'south-left'],
+}
+
+def compile_lane_layout(tl_lane_dict, controlled_crosswalks_dict, directions_and_edges, directions=('north', 'east', 'south', 'west'), turns=('straight', 'right', 'left')):
+    """
+    Compile the lane tables (initialize_lanes, CONTROLLED_CROSSWALKS_DICT, DIRECTIONS_AND_EDGES) once into integer indexed arrays.
+    The string conventions ('edge.' prefix, '-1' sentinel, direction lookups) are resolved here so that they are not parsed every step.
+
+    Every lane group (and every crosswalk upside/ downside/ inside/ rerouted) gets a slot in a count vector.
+    Slot order per TL (same as the observation): vehicle incoming (12), vehicle inside (12), vehicle outgoing (4), pedestrian incoming (4), pedestrian outgoing (4).
+    Crosswalk slots come after all TLs (4 per crosswalk). Crosswalks with multiple ids (e.g., the special case 0) share the same slots.
+
+    Pressures are computed as pressure_matrix @ counts. Rows: vehicle (4 per TL), pedestrian (4 per TL), crosswalks (1 per crosswalk).
+    For crosswalks, the rerouted override (pressure = -rerouted) is applied afterwards using crosswalk_rerouted_slots.
+
+    We are returning the data structure.
+    """
+    groups = [] # slot -> (owner, agent_type, direction, lane_group). owner is the tl_id or 'crosswalks'
+    slot = {}
+
+    def add_slot(key):
+        slot[key] = len(groups)
+        groups.append(key)
+
+    for tl_id in tl_lane_dict.keys():
+        for direction in ['incoming', 'inside']:
+            for d in directions:
+                for t in turns:
+                    add_slot((tl_id, 'vehicle', direction, f"{d}-{t}"))
+        for d in directions:
+            add_slot((tl_id, 'vehicle', 'outgoing', d))
+        for direction in ['incoming', 'outgoing']:
+            for d in directions:
+                add_slot((tl_id, 'pedestrian', direction, d))
+
+    crosswalk_keys = [] # The first id represents the crosswalk
+    for _, data in controlled_crosswalks_dict.items():
+        crosswalk_key = data['ids'][0]
+        crosswalk_keys.append(crosswalk_key)
+        for group in ['upside', 'downside', 'inside', 'rerouted']:
+            add_slot(('crosswalks', crosswalk_key, group, None))
+
+    # Sources. Resolve 'edge.' (it is an edge, not a lane) and '-1' (shared with the straight lane group, decided by the blinker).
+    vehicle_sources = [] # (slot, kind, object_id) kind is 'lane' or 'edge'
+    shared_sources = [] # (slot, kind, straight_object_id, turn)
+    pedestrian_sources = [] # (slot, direction, edge)
+
+    def resolve(lane):
+        return ('edge', lane.split('.')[1]) if "edge" in lane else ('lane', lane)
+
+    for tl_id, lanes in tl_lane_dict.items():
+        for direction, lane_groups in lanes['vehicle'].items():
+            for lane_group, lane_list in lane_groups.items():
+                group_slot = slot[(tl_id, 'vehicle', direction, lane_group)]
+                for lane in lane_list:
+                    if lane != '-1':
+                        vehicle_sources.append((group_slot,) + resolve(lane))
+                    else:
+                        straight_lane = lane_groups[f"{lane_group.split('-')[0]}-straight"][0]
+                        kind, object_id = resolve(straight_lane)
+                        shared_sources.append((group_slot, kind, object_id, lane_group.split('-')[1]))
+
+        for direction, lane_groups in lanes['pedestrian'].items():
+            for lane_group, lane_list in lane_groups.items():
+                group_slot = slot[(tl_id, 'pedestrian', direction, lane_group)]
+                for lane in lane_list:
+                    if lane.startswith(':'):
+                        pedestrian_sources.append((group_slot, direction, lane))
+                    else:
+                        print("Only implemented to work with JunctionDomain. Not implemented yet for external lanes or edges")
+
+    edge_to_direction = {edge: direction for direction, edges in directions_and_edges.items() for edge in edges}
+    crosswalk_sources = [] # (slot, edge)
+    for _, data in controlled_crosswalks_dict.items():
+        crosswalk_key = data['ids'][0]
+        for edge in data['vicinity_walking_edges']:
+            crosswalk_sources.append((slot[('crosswalks', crosswalk_key, edge_to_direction[edge], None)], edge))
+        for crosswalk_id in data['ids']:
+            crosswalk_sources.append((slot[('crosswalks', crosswalk_key, 'inside', None)], crosswalk_id))
+
+    # Incidence matrix.
+    num_tls = len(tl_lane_dict)
+    pressure_matrix = np.zeros((2*len(directions)*num_tls + len(crosswalk_keys), len(groups)), dtype=np.float32)
+    row = 0
+    for tl_id in tl_lane_dict.keys():
+        for d in directions:
+            for lane_group in VEHICLE_PRESSURE_SOURCES[d]:
+                pressure_matrix[row, slot[(tl_id, 'vehicle', 'incoming', lane_group)]] = 1
+                pressure_matrix[row, slot[(tl_id, 'vehicle', 'inside', lane_group)]] = 1
+            pressure_matrix[row, slot[(tl_id, 'vehicle', 'outgoing', d)]] = -1
+            row += 1
+    for tl_id in tl_lane_dict.keys():
+        for d in directions:
+            pressure_matrix[row, slot[(tl_id, 'pedestrian', 'incoming', d)]] = 1
+            pressure_matrix[row, slot[(tl_id, 'pedestrian', 'outgoing', d)]] = -1
+            row += 1
+    for crosswalk_key in crosswalk_keys:
+        pressure_matrix[row, slot[('crosswalks', crosswalk_key, 'upside', None)]] = 1
+        pressure_matrix[row, slot[('crosswalks', crosswalk_key, 'downside', None)]] = 1
+        pressure_matrix[row, slot[('crosswalks', crosswalk_key, 'inside', None)]] = -1
+        row += 1
+
+    vehicle_rows = len(directions)*num_tls
+    first_tl = next(iter(tl_lane_dict.keys()))
+    observation_start = slot[(first_tl, 'vehicle', 'incoming', f"{directions[0]}-{turns[0]}")]
+    return {
+        'groups': groups,
+        'slot': slot,
+        'num_slots': len(groups),
+        'vehicle_sources': vehicle_sources,
+        'shared_sources': shared_sources,
+        'pedestrian_sources': pedestrian_sources,
+        'crosswalk_sources': crosswalk_sources,
+        'crosswalk_keys': crosswalk_keys,
+        'crosswalk_rerouted_slots': np.array([slot[('crosswalks', c, 'rerouted', None)] for c in crosswalk_keys], dtype=np.int64),
+        'observation_slots': np.arange(observation_start, observation_start + 2*len(directions)*len(turns) + 3*len(directions), dtype=np.int64),
+        'pressure_matrix': pressure_matrix,
+        'pressure_slices': {
+            'vehicle': slice(0, vehicle_rows),
+            'pedestrian': slice(vehicle_rows, 2*vehicle_rows),
+            'crosswalks': slice(2*vehicle_rows, 2*vehicle_rows + len(crosswalk_keys)),
+        },
+    }
@@ -0,0 +1,101 @@
+import os
+import glob
+import time
+
+class SnapshotCache:
+    """
+    Warm-start snapshots of the simulation state (saveState/ --load-state).
+    Every episode used to simulate from t=0 with an empty network. The first stretch (warm-up) has unrepresentative traffic.
+    The warm-up only depends on the network, the demand and the SUMO seed. So it is simulated once and saved:
+    - Key: (network_iteration, demand scale bucket (vehicle, pedestrian), seed, SUMO profile). A state saved with one pedestrian model or step method is not loaded with another.
+    - The first worker that needs a key takes a lock (lock file created with O_EXCL, which is atomic), simulates the warm-up and saves the state.
+    - All other workers wait for the snapshot file (poll) and load it.
+    - The snapshot is written to a temporary file and renamed (atomic), a partially written snapshot is never loaded.
+    - When the design changes (new network iteration), the snapshots of the older iterations are evicted.
+
+    The demand scale factors are quantized into buckets (bucket_size) so that workers with close demands share the same snapshot.
+    The quantized value is the one that is actually used to scale the demand (the route files must match the snapshot).
+    """
+
+    def __init__(self, snapshot_dir, bucket_size=0.25, wait_timeout=300):
+        self.snapshot_dir = snapshot_dir
+        self.bucket_size = bucket_size
+        self.wait_timeout = wait_timeout # seconds. If the worker holding the lock does not finish in this time, the lock is considered stale.
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+
+    def quantize(self, scale_factor):
+        """
+        Snap a demand scale factor to the center of its bucket. Never returns 0.
+        """
+        bucket = max(1, round(scale_factor / self.bucket_size))
+        return round(bucket * self.bucket_size, 6)
+
+    def get_path(self, network_iteration, scale_factor_vehicle, scale_factor_pedestrian, seed, profile='fidelity'):
+        """
+        The key is encoded in the file name. The scale factors are expected to be quantized.
+        """
+        name = f"snapshot_{network_iteration}_veh{scale_factor_vehicle:g}_ped{scale_factor_pedestrian:g}_seed{seed}_{profile}.xml.gz"
+        return os.path.join(self.snapshot_dir, name)
+
+    def acquire(self, snapshot_path):
+        """
+        Returns 'load' if the snapshot exists.
+        Returns 'create' if this worker got the lock (it has to simulate the warm-up and call save).
+        Waits while another worker holds the lock. Returns 'simulate' if the wait times out (do the warm-up without saving).
+        """
+        lock_path = f"{snapshot_path}.lock"
+        deadline = time.perf_counter() + self.wait_timeout
+        while True:
+            if os.path.exists(snapshot_path):
+                return 'load'
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                if os.path.exists(snapshot_path): # Saved in between
+                    os.remove(lock_path)
+                    return 'load'
+                return 'create'
+            except FileExistsError:
+                pass
+
+            if time.perf_counter() > deadline:
+                print(f"Timed out waiting for snapshot {snapshot_path}. Simulating the warm-up.")
+                return 'simulate'
+            time.sleep(0.1)
+
+    def save(self, sim, snapshot_path):
+        """
+        Save the current state of the simulation (sim is the backend) and release the lock.
+        """
+        # The file name has to end with .xml.gz for SUMO to compress it.
+        temp_path = snapshot_path.replace('.xml.gz', f'_tmp{os.getpid()}.xml.gz')
+        try:
+            sim.simulation.saveState(temp_path)
+            os.replace(temp_path, snapshot_path)
+        finally:
+            self.release(snapshot_path)
+
+    def release(self, snapshot_path):
+        """
+        Remove the lock (also if saving failed, so that other workers do not wait for nothing).
+        """
+        lock_path = f"{snapshot_path}.lock"
+        if os.path.exists(lock_path):
+            os.remove(lock_path)
+
+    def evict_stale(self, current_network_iteration):
+        """
+        Remove the snapshots (and leftover locks) that belong to other network iterations. Called when the design changes.
+        """
+        removed = 0
+        for path in glob.glob(os.path.join(self.snapshot_dir, "snapshot_*")):
+            network_iteration = os.path.basename(path).split('_')[1]
+            if network_iteration != str(current_network_iteration):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError: # Removed by someone else
+                    pass
+        if removed > 0:
+            print(f"Evicted {removed} stale snapshot files.")
+        return removed
@@ -0,0 +1,196 @@
+import re
+import traci.constants as tc # Same constants for traci and libsumo
+
+SPLIT_EDGE_SUFFIX = re.compile(r'^(.*?)((?:_(?:left|right)\d+)+)$') # A corridor edge split by a design (see utils.get_new_veh_edges_connections): -16666012#2_left4, -16666012#2_left4_right7
+
+class SubscriptionCollector:
+    """
+    Collects everything the occupancy map needs from SUMO through TraCI subscriptions.
+    The subscription results are sent back by SUMO together with the response to simulationStep().
+    Reading them with getAllSubscriptionResults() is therefore a local lookup and does not cost a socket round-trip.
+
+    Subscriptions (the objects come from the compiled lane layout, see sim_config.compile_lane_layout):
+    - Lane/ edge variable subscriptions (vehicle ids) for every vehicle lane group.
+    - Edge variable subscriptions (person ids) for the walking areas and crossings of the TL and the crosswalk vicinity edges.
+    - A junction context subscription for every TL with the cutoff radius. Returns position, signals (blinkers), speed and waiting time of all vehicles in the radius.
+    - Simulation variables: the minimum number of expected vehicles/ persons (0 means the demand has drained) and the number of teleports in the step (used for early termination), and the persons that arrived in the step (to evict them from the pedestrian status store).
+
+    The person ids are used to build a per-step pedestrian index (edge -> persons) so that the occupancy map does not need to scan all persons.
+
+    Subscriptions are lost when SUMO is closed (or a new simulation is loaded), subscribe() needs to be called after every (re)start.
+    The ids are checked against the loaded network in subscribe(). A design can remove crosswalks (their edges are then counted as empty) and split the corridor edges (the pieces are read instead).
+    sim is the simulation backend (traci or libsumo, see sim_backend.py).
+    """
+
+    def __init__(self, sim, tl_ids, lane_layout, cutoff_distance=100):
+        self.sim = sim
+        self.tl_ids = tl_ids
+        self.cutoff_distance = cutoff_distance
+
+        self.lane_ids = set()
+        self.edge_ids = set()
+        for source in lane_layout['vehicle_sources'] + lane_layout['shared_sources']:
+            kind, object_id = source[1], source[2]
+            if kind == 'edge':
+                self.edge_ids.add(object_id)
+            else:
+                self.lane_ids.add(object_id)
+
+        self.person_edge_ids = set(edge for _, _, edge in lane_layout['pedestrian_sources'])
+        self.person_edge_ids.update(edge for _, edge in lane_layout['crosswalk_sources'])
+
+        # Set in subscribe() for the loaded network
+        self.known_lanes = set()
+        self.known_edges = set()
+        self.resolved_lanes = {} # lane id (in the layout) -> the lane ids in the loaded network (empty if not there)
+        self.resolved_edges = {}
+        self.missing_ids = set()
+
+        self.junction_positions = {}
+        self.lane_results = {}
+        self.edge_results = {}
+        self.person_index = {}
+        self.context_results = {tl_id: {} for tl_id in self.tl_ids}
+        self.min_expected_number = None
+        self.teleports_starting = 0
+        self.arrived_persons = ()
+
+    def _resolve_ids(self):
+        """
+        Map the lanes and edges of the layout to the ones in the loaded network (two getIDList calls per load).
+        An id that is not in the network is replaced by the pieces of its split (same lane index for lanes), or by nothing.
+        """
+        self.known_lanes = set(self.sim.lane.getIDList())
+        self.known_edges = set(self.sim.edge.getIDList()) # Includes the internal edges (walking areas and crossings)
+        pieces = {} # split edge -> the edges it was split into
+        for edge in self.known_edges:
+            match = SPLIT_EDGE_SUFFIX.match(edge)
+            if match:
+                pieces.setdefault(match.group(1), []).append(edge)
+
+        self.resolved_lanes = {}
+        for lane in self.lane_ids:
+            if lane in self.known_lanes:
+                self.resolved_lanes[lane] = [lane]
+            else:
+                edge, index = lane.rsplit('_', 1)
+                self.resolved_lanes[lane] = [f"{piece}_{index}" for piece in sorted(pieces.get(edge, [])) if f"{piece}_{index}" in self.known_lanes]
+        self.resolved_edges = {}
+        for edge in self.edge_ids | self.person_edge_ids:
+            self.resolved_edges[edge] = [edge] if edge in self.known_edges else sorted(pieces.get(edge, []))
+
+        missing_ids = {object_id for resolved in [self.resolved_lanes, self.resolved_edges] for object_id, ids in resolved.items() if not ids}
+        if missing_ids != self.missing_ids:
+            print(f"{len(missing_ids)} observed lanes/ edges are not in the network (counted as empty): {sorted(missing_ids)}")
+        self.missing_ids = missing_ids
+
+    def subscribe(self):
+        """
+        Set up all subscriptions. Called once after the connection to SUMO is established.
+        """
+        self._resolve_ids()
+        for lanes in self.resolved_lanes.values():
+            for lane in lanes:
+                self.sim.lane.subscribe(lane, [tc.LAST_STEP_VEHICLE_ID_LIST])
+        # Subscribing to the same edge again replaces the earlier variables. Subscribe once with all variables that are needed.
+        edge_variables = {}
+        for edge, edges in self.resolved_edges.items():
+            for resolved_edge in edges:
+                variables = edge_variables.setdefault(resolved_edge, [])
+                if edge in self.edge_ids and tc.LAST_STEP_VEHICLE_ID_LIST not in variables:
+                    variables.append(tc.LAST_STEP_VEHICLE_ID_LIST)
+                if edge in self.person_edge_ids and tc.LAST_STEP_PERSON_ID_LIST not in variables:
+                    variables.append(tc.LAST_STEP_PERSON_ID_LIST)
+        for edge, variables in edge_variables.items():
+            self.sim.edge.subscribe(edge, variables)
+
+        for tl_id in self.tl_ids:
+            # Junctions do not move. Only get their position once.
+            self.junction_positions[tl_id] = self.sim.junction.getPosition(tl_id)
+            self.sim.junction.subscribeContext(tl_id, tc.CMD_GET_VEHICLE_VARIABLE, self.cutoff_distance, [tc.VAR_POSITION, tc.VAR_SIGNALS, tc.VAR_SPEED, tc.VAR_WAITING_TIME])
+
+        self.sim.simulation.subscribe([tc.VAR_MIN_EXPECTED_VEHICLES, tc.VAR_TELEPORT_STARTING_VEHICLES_NUMBER, tc.VAR_ARRIVED_PERSONS_IDS])
+
+    def update(self):
+        """
+        Read the latest subscription results (delivered with the last simulation step). Called once per step.
+        """
+        self.lane_results = self.sim.lane.getAllSubscriptionResults()
+        self.edge_results = self.sim.edge.getAllSubscriptionResults()
+
+        # Pedestrian index. Built once per step, every person on a subscribed edge is visited once.
+        self.person_index = {}
+        for edge in self.person_edge_ids:
+            persons = self._get_results(self.edge_results, self.resolved_edges[edge], tc.LAST_STEP_PERSON_ID_LIST)
+            if persons:
+                self.person_index[edge] = persons
+
+        for tl_id in self.tl_ids:
+            self.context_results[tl_id] = self.sim.junction.getContextSubscriptionResults(tl_id) or {}
+
+        simulation_results = self.sim.simulation.getSubscriptionResults()
+        self.min_expected_number = simulation_results.get(tc.VAR_MIN_EXPECTED_VEHICLES)
+        self.teleports_starting = simulation_results.get(tc.VAR_TELEPORT_STARTING_VEHICLES_NUMBER, 0)
+        self.arrived_persons = simulation_results.get(tc.VAR_ARRIVED_PERSONS_IDS, ())
+
+    def _get_results(self, results, object_ids, variable):
+        """
+        A variable of the resolved ids of one lane/ edge (usually one id, the pieces if it was split, none if it is not in the network).
+        """
+        if len(object_ids) == 1:
+            result = results.get(object_ids[0])
+            return result[variable] if result else ()
+        values = []
+        for object_id in object_ids:
+            result = results.get(object_id)
+            if result:
+                values.extend(result[variable])
+        return values
+
+    def get_vehicle_ids(self, kind, object_id):
+        """
+        Vehicle ids in a lane or an edge (kind is 'lane' or 'edge') during the last step.
+        """
+        if kind == 'edge':
+            return self._get_results(self.edge_results, self.resolved_edges[object_id], tc.LAST_STEP_VEHICLE_ID_LIST)
+        return self._get_results(self.lane_results, self.resolved_lanes[object_id], tc.LAST_STEP_VEHICLE_ID_LIST)
+
+    def get_person_ids(self, edge):
+        """
+        Person ids on an edge (walking area, crossing or walking edge) during the last step.
+        """
+        return self.person_index.get(edge, ())
+
+    def is_nearby(self, tl_id, vehicle_id):
+        """
+        If the vehicle is within the cutoff distance of the junction.
+        """
+        return vehicle_id in self.context_results[tl_id]
+
+    def get_signals(self, tl_id, vehicle_id):
+        """
+        Signal state (blinkers) of a vehicle. Only available for vehicles within the cutoff distance (None otherwise).
+        """
+        data = self.context_results[tl_id].get(vehicle_id)
+        return data[tc.VAR_SIGNALS] if data else None
+
+    def get_position(self, tl_id, vehicle_id):
+        """
+        Position of a vehicle. Only available for vehicles within the cutoff distance (None otherwise).
+        """
+        data = self.context_results[tl_id].get(vehicle_id)
+        return data[tc.VAR_POSITION] if data else None
+
+    def get_traffic_stats(self, tl_id, stopped_speed=0.1):
+        """
+        For the vehicles within the cutoff distance of the junction: number of vehicles, number of stopped vehicles (speed below stopped_speed) and the maximum waiting time.
+        """
+        num_vehicles = len(self.context_results[tl_id])
+        num_stopped = 0
+        max_waiting_time = 0.0
+        for data in self.context_results[tl_id].values():
+            if data[tc.VAR_SPEED] < stopped_speed:
+                num_stopped += 1
+            if data[tc.VAR_WAITING_TIME] > max_waiting_time:
+                max_waiting_time = data[tc.VAR_WAITING_TIME]
+        return num_vehicles, num_stopped, max_waiting_time
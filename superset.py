@@ -0,0 +1,196 @@
+import os
+import json
+import math
+import numpy as np
+import networkx as nx
+import xml.etree.ElementTree as ET
+
+class SupersetNetwork:
+    """
+    A single network that contains every candidate crosswalk (design_mode 'superset').
+    The candidate crosswalk locations along the corridor are discretized to a grid and compiled once (with netconvert, same pipeline as any network iteration):
+    - Every grid cell (grid_size, normalized location) has one candidate per width variant (widths). The variants of a cell are spread evenly over the cell (a crossing can not share a node with another).
+    - Every candidate is a crossing with its own traffic light (the mid node, same as the proposals in DesignEnv._apply_action).
+    A design then only picks a subset of the candidates (snap): the location snaps to its cell and the thickness to the closest width variant.
+    At reset, the control env switches the inactive candidates off (apply): the traffic light stays green for the vehicles (red for the crossing) and the crossing and its walkways are closed for pedestrians.
+    No netconvert and no new network per design step. The network file (and with it the pre-routed vehicle demand) stays the same for the whole run.
+
+    Walks: SUMO routes the walks of the persons it loads with the current lane permissions, so the pedestrian trips are not pre-routed in this mode (a pre-routed walk over a closed candidate stops SUMO).
+    TraCI's findIntermodalRoute does not see the permissions though. Walking stages found with it are checked and rerouted around the inactive candidates here (find_walk).
+
+    Files in network_dir: network_iteration_superset.net.xml, superset.json (the candidates and their lanes) and superset_design_{iteration}.json (the active candidates of each design).
+    """
+
+    NETWORK_ITERATION = 'superset' # The network file is network_iteration_superset.net.xml
+
+    def __init__(self, network_dir, grid_size=0.1, widths=(2.0, 4.0, 6.0), min_coordinate=0.0, max_coordinate=1.0):
+        self.network_dir = network_dir
+        self.grid_size = grid_size
+        self.widths = sorted(widths)
+        self.min_coordinate = min_coordinate
+        self.max_coordinate = max_coordinate
+        self.num_cells = max(1, math.ceil(round((max_coordinate - min_coordinate) / grid_size, 9))) # Rounded first, 1.0/0.1 is not exactly 10
+        self.candidates = [] # Set by save/ load: [{'id': mid node id, 'location': normalized location, 'width': width, 'lanes': [crossing and walkway lanes], 'off_state': signal state when inactive}]
+        self.designs = {} # iteration -> set of active candidate ids
+        self.inactive_edges = {} # iteration -> set of edges of the inactive candidates
+        self.pedestrian_graph = None # Built on the first find_walk
+
+    @property
+    def net_file(self):
+        return os.path.join(self.network_dir, f"network_iteration_{self.NETWORK_ITERATION}.net.xml")
+
+    def get_candidate_proposals(self):
+        """
+        (location, width) of every candidate, in candidate order (cell by cell, variants by width). Candidate i becomes superset_{i}_mid.
+        The last cell can be shorter than grid_size (ends at max_coordinate).
+        """
+        proposals = []
+        for cell in range(self.num_cells):
+            cell_start = self.min_coordinate + cell * self.grid_size
+            cell_length = min(self.grid_size, self.max_coordinate - cell_start)
+            for variant, width in enumerate(self.widths):
+                proposals.append((cell_start + (variant + 0.5) / len(self.widths) * cell_length, width))
+        return proposals
+
+    def get_candidate_index(self, location, thickness):
+        """
+        The candidate a proposal snaps to.
+        """
+        cell = int(np.clip((location - self.min_coordinate) // self.grid_size, 0, self.num_cells - 1))
+        variant = int(np.argmin([abs(thickness - width) for width in self.widths]))
+        return cell * len(self.widths) + variant
+
+    def snap(self, proposals):
+        """
+        The candidate ids of a design (proposals as (location, thickness)). Proposals that snap to the same candidate count once.
+        """
+        active = []
+        for location, thickness in proposals:
+            candidate_id = self.candidates[self.get_candidate_index(location, thickness)]['id']
+            if candidate_id not in active:
+                active.append(candidate_id)
+        return active
+
+    def save(self):
+        """
+        After the network was compiled: find the lanes of every candidate in the network file (the crossing and the walkways to it) and write superset.json.
+        The signal state of an inactive candidate is green for the vehicle links and red for the crossing links (from the links of its traffic light).
+        """
+        mid_ids = [f"superset_{i}_mid" for i in range(len(self.get_candidate_proposals()))]
+        lanes = {mid_id: [] for mid_id in mid_ids}
+        links = {mid_id: {} for mid_id in mid_ids} # link index -> crossing link or not
+        for _, elem in ET.iterparse(self.net_file):
+            if elem.tag == 'edge':
+                edge_id = elem.get('id')
+                if elem.get('function') == 'crossing':
+                    mid_id = edge_id[1:].rsplit('_c', 1)[0] # :{node}_c0
+                    if mid_id in lanes:
+                        lanes[mid_id].append(f"{edge_id}_0")
+                elif elem.get('type') == 'highway.footway':
+                    for node in (elem.get('from'), elem.get('to')):
+                        if node in lanes:
+                            lanes[node].append(f"{edge_id}_0")
+                elem.clear()
+            elif elem.tag == 'connection':
+                if elem.get('tl') in links:
+                    links[elem.get('tl')][int(elem.get('linkIndex'))] = elem.get('to').startswith(':') # Into the crossing (from the walking area)
+                elem.clear()
+
+        self.candidates = []
+        for mid_id, (location, width) in zip(mid_ids, self.get_candidate_proposals()):
+            if not any(lane.startswith(':') for lane in lanes[mid_id]):
+                print(f"Candidate {mid_id} has no crossing in the superset network. It can not be activated.")
+            off_state = ''.join('r' if links[mid_id].get(index, False) else 'G' for index in range(max(links[mid_id], default=-1) + 1))
+            self.candidates.append({'id': mid_id, 'location': location, 'width': width, 'lanes': lanes[mid_id], 'off_state': off_state})
+
+        with open(os.path.join(self.network_dir, "superset.json"), 'w') as f:
+            json.dump({'grid_size': self.grid_size, 'widths': self.widths, 'min_coordinate': self.min_coordinate, 'max_coordinate': self.max_coordinate, 'candidates': self.candidates}, f, indent=4)
+        print(f"Superset network with {len(self.candidates)} candidate crosswalks: {self.net_file}")
+
+    def load(self):
+        """
+        Read superset.json (in the workers).
+        """
+        with open(os.path.join(self.network_dir, "superset.json")) as f:
+            data = json.load(f)
+        self.grid_size = data['grid_size']
+        self.widths = data['widths']
+        self.min_coordinate = data['min_coordinate']
+        self.max_coordinate = data['max_coordinate']
+        self.num_cells = len(data['candidates']) // len(self.widths)
+        self.candidates = data['candidates']
+        return self
+
+    def save_design(self, iteration, active):
+        """
+        The active candidates of a design iteration. Written to a temporary file and renamed (atomic).
+        """
+        path = os.path.join(self.network_dir, f"superset_design_{iteration}.json")
+        with open(f"{path}.{os.getpid()}.tmp", 'w') as f:
+            json.dump({'active': list(active)}, f)
+        os.replace(f.name, path)
+
+    def load_design(self, iteration):
+        if iteration not in self.designs:
+            with open(os.path.join(self.network_dir, f"superset_design_{iteration}.json")) as f:
+                self.designs[iteration] = set(json.load(f)['active'])
+        return self.designs[iteration]
+
+    def get_inactive_edges(self, iteration):
+        """
+        The edges (crossing and walkways) of the candidates that are switched off in this design iteration.
+        """
+        if iteration not in self.inactive_edges:
+            active = self.load_design(iteration)
+            self.inactive_edges[iteration] = {lane.rsplit('_', 1)[0] for candidate in self.candidates if candidate['id'] not in active for lane in candidate['lanes']}
+        return self.inactive_edges[iteration]
+
+    def _get_pedestrian_graph(self):
+        """
+        Undirected graph of the edges pedestrians can use (sidewalks, footways, walking areas and crossings), from the pedestrian connections in the network file.
+        The weight of a link is the mean length of the two edges.
+        """
+        if self.pedestrian_graph is None:
+            lengths = {}
+            graph = nx.Graph()
+            for _, elem in ET.iterparse(self.net_file):
+                if elem.tag == 'edge':
+                    for lane in elem.findall('lane'):
+                        allow, disallow = lane.get('allow', ''), lane.get('disallow', '')
+                        if 'pedestrian' in allow.split() or (not allow and 'pedestrian' not in disallow.split()):
+                            lengths[elem.get('id')] = float(lane.get('length'))
+                            break
+                    elem.clear()
+                elif elem.tag == 'connection':
+                    # Pedestrians move between edges through the walking areas and crossings (internal edges)
+                    from_edge, to_edge = elem.get('from'), elem.get('to')
+                    if from_edge in lengths and to_edge in lengths and (from_edge.startswith(':') or to_edge.startswith(':')):
+                        graph.add_edge(from_edge, to_edge, weight=(lengths[from_edge] + lengths[to_edge]) / 2)
+                    elem.clear()
+            self.pedestrian_graph = graph
+        return self.pedestrian_graph
+
+    def find_walk(self, from_edge, to_edge, iteration):
+        """
+        Shortest walk (normal edges, as in a walking stage) from from_edge to to_edge that does not use the inactive candidates of the design iteration. None if there is none.
+        """
+        inactive_edges = self.get_inactive_edges(iteration)
+        graph = nx.subgraph_view(self._get_pedestrian_graph(), filter_node=lambda edge: edge not in inactive_edges)
+        try:
+            path = nx.shortest_path(graph, from_edge, to_edge, weight='weight')
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            return None
+        return [edge for edge in path if not edge.startswith(':')]
+
+    def apply(self, sim, iteration):
+        """
+        Switch off the candidates that are not in the design of this iteration. Called after every (re)load, which starts with all candidates on.
+        """
+        active = self.load_design(iteration)
+        for candidate in self.candidates:
+            if candidate['id'] in active:
+                continue
+            sim.trafficlight.setRedYellowGreenState(candidate['id'], candidate['off_state'])
+            for lane in candidate['lanes']:
+                sim.lane.setDisallowed(lane, ["all"]) # Not ["pedestrian"]: that would open the crossing to every vehicle class
+        return len(active)
@@ -0,0 +1,51 @@
+class TerminationDetector:
+    """
+    Early episode termination. Fed every step by the subscription data that was already collected (SubscriptionCollector.update), no extra TraCI calls.
+    - Empty network: the demand has drained (no vehicles/ persons in the net or waiting to start). Nothing else can happen, the episode is terminated.
+    - Gridlock/ jam: the episode is truncated (the state is not terminal, the value of the next state is still meaningful). 
+      The workers store the flag and the next state in the memory (Memory.append) and PPO.compute_gae bootstraps from the value of the next state.
+        - A fraction of vehicles near the junction above stopped_fraction for patience consecutive steps.
+        - A vehicle near the junction waiting longer than max_waiting_time.
+        - More than max_teleports teleports in the episode (SUMO teleports vehicles that are stuck).
+    A threshold set to None disables that check. The defaults are in config.py.
+    """
+
+    def __init__(self, terminate_on_empty, stopped_fraction, patience, min_vehicles, max_waiting_time, max_teleports):
+        self.terminate_on_empty = terminate_on_empty
+        self.stopped_fraction = stopped_fraction
+        self.patience = patience
+        self.min_vehicles = min_vehicles # Do not call a couple of vehicles waiting at a red light a gridlock
+        self.max_waiting_time = max_waiting_time
+        self.max_teleports = max_teleports
+        self.reset()
+
+    def reset(self):
+        self.stopped_steps = 0
+        self.teleports = 0
+
+    def update(self, collector, tl_ids, num_steps=1, pending_demand=0):
+        """
+        Called once per (simulation) step after collector.update(). num_steps if the step advanced multiple substeps at once.
+        pending_demand: vehicles/ persons that will still be added through TraCI (see demand_injector.py). SUMO does not know about them yet.
+        Returns (terminated, truncated, reason)
+        """
+        if self.terminate_on_empty and collector.min_expected_number == 0 and pending_demand == 0:
+            return True, False, 'empty_network'
+
+        self.teleports += collector.teleports_starting
+        if self.max_teleports is not None and self.teleports > self.max_teleports:
+            return False, True, 'teleports'
+
+        gridlocked = False
+        for tl_id in tl_ids:
+            num_vehicles, num_stopped, max_waiting_time = collector.get_traffic_stats(tl_id)
+            if self.max_waiting_time is not None and max_waiting_time > self.max_waiting_time:
+                return False, True, 'waiting_time'
+            if self.stopped_fraction is not None and num_vehicles >= self.min_vehicles and num_stopped >= self.stopped_fraction*num_vehicles:
+                gridlocked = True
+
+        self.stopped_steps = self.stopped_steps + num_steps if gridlocked else 0
+        if self.patience is not None and self.stopped_steps >= self.patience:
+            return False, True, 'gridlock'
+
+        return False, False, None
@@ -0,0 +1,51 @@
+import os
+import shutil
+import numpy as np
+import pytest
+import torch
+from config import get_config, classify_and_return_args
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROPOSALS = [[0.3, 3.0], [0.6, 2.0]] # The first one splits the controlled approach edge -16666012#2
+
+pytestmark = pytest.mark.skipif(shutil.which('netconvert') is None or shutil.which('sumo') is None, reason="SUMO is not on the PATH")
+
+def get_args(tmp_path, design_mode):
+    """
+    design_args, control_args and lower_ppo_args with every file of the run in tmp_path.
+    """
+    config = get_config()
+    for key in ['vehicle_input_trips', 'vehicle_output_trips', 'pedestrian_input_trips', 'pedestrian_output_trips', 'original_net_file']:
+        config[key] = os.path.join(REPO_DIR, config[key])
+    config.update({'design_mode': design_mode, 'gui': False, 'save_graph_images': False, 'use_network_cache': False,
+                   'component_dir': str(tmp_path / 'component_SUMO_files'), 'network_dir': str(tmp_path / 'network_iterations')})
+    design_args, control_args, lower_ppo_args, _ = classify_and_return_args(config, torch.device('cpu'))
+    control_args.update({'run_dir': str(tmp_path / 'run'), 'route_cache_dir': str(tmp_path / 'routed_demand')})
+    return design_args, control_args, lower_ppo_args
+
+@pytest.mark.parametrize('design_mode, network_iteration', [('netconvert', 'base'), ('netconvert', 1), ('superset', 1)])
+def test_reset_and_step_on_generated_network(tmp_path, monkeypatch, design_mode, network_iteration):
+    """
+    The generated networks do not have the controlled crosswalks of the original network, and a design can split the observed corridor lanes.
+    reset() and step() have to work on them.
+    """
+    monkeypatch.chdir(tmp_path) # DesignEnv clears and recreates graph_iterations/ gmm_iterations in the working directory
+    from design_env import DesignEnv
+    from control_env import ControlEnv
+    design_args, control_args, lower_ppo_args = get_args(tmp_path, design_mode)
+    design_env = DesignEnv(design_args, control_args, lower_ppo_args)
+    if design_mode == 'superset':
+        design_env._apply_superset_action(np.array(PROPOSALS), network_iteration) # Same as DesignEnv.step
+    elif network_iteration != 'base':
+        design_env._apply_action(np.array(PROPOSALS), network_iteration)
+
+    env = ControlEnv(control_args, worker_id=0, network_iteration=network_iteration)
+    try:
+        observation, _ = env.reset()
+        for action in [[1, 0, 0], [3, 1, 1]]:
+            observation, _, _, _, _ = env.step(torch.tensor(action))
+        assert observation.shape == env.observation_space.shape
+        if design_mode == 'netconvert' and network_iteration != 'base':
+            assert env.collector.resolved_lanes['-16666012#2_0'] == ['-16666012#2_left0_0', '-16666012#2_right0_0']
+    finally:
+        env.close()
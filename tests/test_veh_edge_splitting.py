@@ -0,0 +1,255 @@
+import os
+import random
+import shutil
+import subprocess
+import xml.etree.ElementTree as ET
+import networkx as nx
+import pytest
+from plain_network import PlainNetwork
+from utils import get_initial_veh_edge_config, get_new_veh_edges_connections
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ORIGINAL_NET_FILE = os.path.join(REPO_DIR, 'SUMO_files', 'Craver_traffic_lights.net.xml')
+
+def get_new_veh_edges_connections_scan(middle_nodes_to_add, networkx_graph, original_network, conn_root):
+    """
+    Find which vehicle edges to remove and which to add (use x-coordinate of middle node to find intersecting edges that are split) .
+    Update the connection root to reflect the new connections.
+    original_network: the original component files in memory (PlainNetwork), only read.
+    The earlier version of utils.get_new_veh_edges_connections (scans all edges, connections and earlier middle nodes per middle node). Kept as the reference for the tests below.
+    """
+
+    # Dictionary of node coordinates 
+    node_coords = original_network.get_node_coordinates()
+
+    edges_dict = original_network.edges
+    iterative_edges = get_initial_veh_edge_config(edges_dict, node_coords) # Initialize iterative_edges with initial edge config.
+
+    all_edges = {} # also contain all the connected vehicle edges outside the corridor.
+    for edge_id in edges_dict.keys():
+        attributes_dict = dict(edges_dict[edge_id].attrib) # only from and to will be used (a copy, the original elements are shared)
+        # Add from_x and to_x to the attributes_dict
+        attributes_dict['from_x'] = node_coords[attributes_dict['from']]
+        attributes_dict['to_x'] = node_coords[attributes_dict['to']]
+        all_edges[edge_id] = attributes_dict
+
+    edges_to_remove = []
+    edges_to_add = {'top': {}, 'bottom': {}}
+    
+    # For left-right connections with middle nodes. Each middle node will have an edge to the left and right of it.
+    m_node_mapping = {
+        m_node: {
+            'top': {'from': None, 'to': None},
+            'bottom': {'from': None, 'to': None}
+        } for m_node in middle_nodes_to_add
+    }
+
+    # As multiple middle nodes can intersect with the same vehicle edge, the splitting of one old edge into multiple new edges has to happen iteratively (splitting one edge at a time).
+    # In the same process, the connections (in the conn file) need to change as we go. i.e., Find intersects for each middle node and then update the conn file.
+    # The old edge in a connection could either be a 'to' or a 'from' edge. 
+    for i in range(len(middle_nodes_to_add)):
+        m_node = middle_nodes_to_add[i]
+        x_coord = round(networkx_graph.nodes[m_node]['pos'][0], 2)
+        
+        # Handle top edges and top connection
+        for edge_id, edge_data in list(iterative_edges['top'].items()): # convert to list first 
+            # The directions are reversed in top and bottom. For top, greater than `to` and less than `from`.
+            if (edge_data['to_x'] < x_coord < edge_data['from_x']) and edge_id not in edges_to_remove: 
+
+                print(f"Top edge {edge_id} intersects mnode {m_node} at x={x_coord:.2f}.")
+                edges_to_remove.append(edge_id)
+    
+                # Add new edges to edges_to_add
+                # Right part of split (from original from to middle)
+                right_edge_id_top = f"{edge_id}_right{i}" # The same edge can be split multiple times. Value of i not neceaasrily corresponding to number of times split.
+                right_edge_data = {
+                    'new_node': m_node,
+                    'from': edge_data['from'],
+                    'to': m_node,
+                    'from_x': round(edge_data['from_x'], 2),
+                    'to_x': x_coord,
+                }
+                
+                edges_to_add['top'][right_edge_id_top] = right_edge_data
+                iterative_edges['top'][right_edge_id_top] = right_edge_data # new_node attribute is extra here.
+                all_edges[right_edge_id_top] = right_edge_data # only from_x and to_x are used.
+
+                # Left part of split (from middle to original to)
+                left_edge_id_top = f"{edge_id}_left{i}" # The same edge can be split multiple times.
+                left_edge_data = {
+                    'new_node': m_node,
+                    'from': m_node,
+                    'to': edge_data['to'],
+                    'from_x': x_coord,
+                    'to_x': round(edge_data['to_x'], 2),
+                }
+
+                edges_to_add['top'][left_edge_id_top] = left_edge_data
+                iterative_edges['top'][left_edge_id_top] = left_edge_data # new_node attribute is extra here.
+                all_edges[left_edge_id_top] = left_edge_data # only from_x and to_x are used.
+
+                # Update current node mapping (for connections). On Top, connections go from right to left.
+                m_node_mapping[m_node]['top']['from'] = right_edge_id_top
+                m_node_mapping[m_node]['top']['to'] = left_edge_id_top
+                
+                # Update previous nodes' mappings if they referenced this split edge
+                for prev_node in middle_nodes_to_add[:i]:  # Only look at nodes we've processed before
+                    prev_mapping = m_node_mapping[prev_node]['top']
+                    if prev_mapping['from'] == edge_id:
+                        prev_mapping['from'] = left_edge_id_top # If the previous `from` edge was split, the new left will connect to it.
+                    if prev_mapping['to'] == edge_id:
+                        prev_mapping['to'] = right_edge_id_top # Similar reasoning as above. Previous left will connect to new right.
+
+                # Now add new connections to conn_root and remove old connections.
+                for connection in conn_root.findall('connection'): # This root is updated later so find all works
+                    from_edge, to_edge = connection.get('from'), connection.get('to') # Existing connection edge ids 
+                    if from_edge == edge_id or to_edge == edge_id:
+                        print(f"mnode {m_node} intersects top edge {edge_id} at x={x_coord:.2f} and is ref in conn: {connection}.")
+
+                        if edge_id == from_edge: 
+                            attributes = {'from': left_edge_id_top  , 'to': to_edge, 'fromLane': str(0), 'toLane': connection.get('toLane')}
+                        else:
+                            attributes = {'from': from_edge, 'to': right_edge_id_top, 'fromLane': connection.get('fromLane'), 'toLane': str(0)}
+
+                        #print(f"Adding new connection: {attributes}")
+                        new_connection = ET.Element('connection', attributes)
+                        new_connection.text = None  # Ensure there's no text content
+                        new_connection.tail = "\n\t\t"
+                        conn_root.append(new_connection)
+                        conn_root.remove(connection) # remove old connection
+
+        # Check bottom edges and bottom connection
+        for edge_id, edge_data in list(iterative_edges['bottom'].items()):
+            # For bottom, greater than `from` and less than `to`.
+            if (edge_data['from_x'] < x_coord < edge_data['to_x']) and edge_id not in edges_to_remove:
+
+                print(f"Bottom edge {edge_id} intersects mnode {m_node} at x={x_coord:.2f}.")
+                edges_to_remove.append(edge_id) # Need to check both in top and bottom.
+                
+                # Add new edges to edges_to_add
+                # Right part of split (In bottom, 'to' nodes are in the right, 'from' nodes are in the left)
+                right_edge_id_bottom = f"{edge_id}_right{i}" # The same edge can be split multiple times.
+                right_edge_data = {
+                    'new_node': m_node,
+                    'to': edge_data['to'],
+                    'from': m_node,
+                    'from_x': x_coord,
+                    'to_x': round(edge_data['to_x'], 2),
+                }
+                edges_to_add['bottom'][right_edge_id_bottom] = right_edge_data
+                iterative_edges['bottom'][right_edge_id_bottom] = right_edge_data # new_node attribute is extra here.
+                all_edges[right_edge_id_bottom] = right_edge_data # only from_x and to_x are used.
+
+                # Left part of split
+                left_edge_id_bottom = f"{edge_id}_left{i}" # The same edge can be split multiple times.
+                left_edge_data = {
+                    'new_node': m_node,
+                    'to': m_node,
+                    'from': edge_data['from'],
+                    'from_x': round(edge_data['from_x'], 2),
+                    'to_x': x_coord,
+                }
+                edges_to_add['bottom'][left_edge_id_bottom] = left_edge_data
+                iterative_edges['bottom'][left_edge_id_bottom] = left_edge_data # new_node attribute is extra here.
+                all_edges[left_edge_id_bottom] = left_edge_data # only from_x and to_x are used.
+
+                # Update current node mapping (for connections). On Bottom, connections go from left to right.
+                m_node_mapping[m_node]['bottom']['from'] = left_edge_id_bottom
+                m_node_mapping[m_node]['bottom']['to'] = right_edge_id_bottom
+                
+                # Update previous nodes' mappings if they referenced this split edge
+                for prev_node in middle_nodes_to_add[:i]:  # Only look at nodes we've processed before
+                    prev_mapping = m_node_mapping[prev_node]['bottom']
+                    if prev_mapping['from'] == edge_id:
+                        prev_mapping['from'] = right_edge_id_bottom # If the previous `from` edge was split, the new right will connect to it. 
+                    if prev_mapping['to'] == edge_id:
+                        prev_mapping['to'] = left_edge_id_bottom # If the previous `to` edge was split, the new left will connect to it.
+
+                # Now add new connections to conn_root and remove old connections.
+                for connection in conn_root.findall('connection'): # This root is updated later so find all works.
+                    from_edge, to_edge = connection.get('from'), connection.get('to') # Existing connection edge ids 
+                    if from_edge == edge_id or to_edge == edge_id:
+                        print(f"mnode {m_node} intersects bottom edge {edge_id} at x={x_coord:.2f} and is ref in conn: {connection}.")
+
+                        if edge_id == from_edge: 
+                            attributes = {'from': right_edge_id_bottom, 'to': to_edge, 'fromLane': str(0), 'toLane': connection.get('toLane')}
+                        else:
+                            attributes = {'from': from_edge, 'to': left_edge_id_bottom, 'fromLane': connection.get('fromLane'), 'toLane': str(0)}
+                        
+                        #print(f"Adding new connection: {attributes}")
+                        new_connection = ET.Element('connection', attributes)
+                        new_connection.text = None  # Ensure there's no text content
+                        new_connection.tail  = "\n\t\t"
+                        conn_root.append(new_connection)
+                        conn_root.remove(connection)
+    
+    # corrections.
+    # We may have added a connection, but one of those edges may have gotten split later.
+    # If a `from` or a `to` edge in a connection contains an edge in edges_to_remove, then we need to remove that connection.
+    for connection in conn_root.findall('connection'):
+        from_edge, to_edge = connection.get('from'), connection.get('to')
+        if from_edge in edges_to_remove or to_edge in edges_to_remove:
+            conn_root.remove(connection)
+
+    # If the edges are present in edges_to_remove, then they should not be present in edges_to_add (they may be because of a split of a split).
+    for edge_id in edges_to_remove:
+        if edge_id in edges_to_add['top']:
+            del edges_to_add['top'][edge_id]
+        if edge_id in edges_to_add['bottom']:
+            del edges_to_add['bottom'][edge_id]
+
+    # This edges_to_remove edge list will be used to remove edges from the edg file.
+    # Hence Filter edges to remove that are not part of the original edges (edges that are split of a split will not be there).
+    # Remove edges that have `right` or `left` in their id.
+    edges_to_remove = [edge_id for edge_id in edges_to_remove if not 'right' in edge_id and not 'left' in edge_id]
+    return edges_to_remove, edges_to_add, conn_root, m_node_mapping
+
+@pytest.fixture(scope='module')
+def original_network(tmp_path_factory):
+    """
+    The original component files (netconvert, same as DesignEnv).
+    """
+    if shutil.which('netconvert') is None:
+        pytest.skip("netconvert (SUMO) is not on the PATH")
+    prefix = tmp_path_factory.mktemp('components') / 'original'
+    command = f"netconvert --sumo-net-file {ORIGINAL_NET_FILE} --plain-output-prefix {prefix} --plain-output.lanes true"
+    subprocess.run(command, shell=True, check=True, capture_output=True, text=True)
+    return PlainNetwork.from_files(str(prefix))
+
+def random_middle_nodes(rng, design, num_proposals, corridor_min, corridor_max, node_x):
+    """
+    A graph with num_proposals middle nodes (only the position is used). Some land exactly on a corridor node or on another proposal (edge cases of the split).
+    """
+    graph = nx.Graph()
+    middle_nodes = []
+    for j in range(num_proposals):
+        choice = rng.random()
+        if choice < 0.1:
+            x = rng.choice(node_x)
+        elif choice < 0.2 and middle_nodes:
+            x = graph.nodes[rng.choice(middle_nodes)]['pos'][0]
+        else:
+            x = rng.uniform(corridor_min - 10, corridor_max + 10)
+        middle_nodes.append(f"iter{design}_{j}_mid")
+        graph.add_node(middle_nodes[-1], pos=(x, 0.0), type='middle')
+    return middle_nodes, graph
+
+def split(function, middle_nodes, graph, original_network):
+    conn_root = original_network.copy().roots['con'] # Both only add and remove connections
+    edges_to_remove, edges_to_add, conn_root, m_node_mapping = function(list(middle_nodes), graph, original_network, conn_root)
+    return edges_to_remove, {direction: list(edges.items()) for direction, edges in edges_to_add.items()}, m_node_mapping, ET.tostring(conn_root)
+
+@pytest.mark.parametrize('seed', range(5))
+def test_index_matches_scan(original_network, seed, num_designs=40, max_proposals=30):
+    """
+    Same edges to remove, edges to add (same order), middle node mapping and connection file as the scan, on random designs (1 to max_proposals middle nodes).
+    """
+    node_coords = original_network.get_node_coordinates()
+    corridor_x = [node_coords[original_network.edges[edge_id].get(end)] for edge_id in ['16666012#2', '16666012#17'] for end in ['from', 'to']]
+    node_x = sorted(set(node_coords[node] for edge_id in original_network.edges if edge_id.lstrip('-').startswith('16666012#') for node in [original_network.edges[edge_id].get('from'), original_network.edges[edge_id].get('to')]))
+
+    rng = random.Random(seed)
+    for design in range(num_designs):
+        middle_nodes, graph = random_middle_nodes(rng, design, rng.randint(1, max_proposals), min(corridor_x), max(corridor_x), node_x)
+        expected = split(get_new_veh_edges_connections_scan, middle_nodes, graph, original_network)
+        assert split(get_new_veh_edges_connections, middle_nodes, graph, original_network) == expected, [graph.nodes[node]['pos'][0] for node in middle_nodes]
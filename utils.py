@@ -1,7 +1,9 @@
 import os
 import time
-import xml
+import threading
+import bisect
 import xml.etree.ElementTree as ET
+from demand_table import load_demand_table, write_scaled_demand
 import logging
 import matplotlib.pyplot as plt
 import seaborn as sns
@@ -22,27 +24,13 @@ def convert_demand_to_scale_factor(demand, demand_type, input_file):
     if demand_type not in ['vehicle', 'pedestrian']:
         raise ValueError("Demand type must be either 'vehicle' or 'pedestrian'")
     
-    # Calculate the original demand from the input file
-    tree = ET.parse(input_file)
-    root = tree.getroot()
-    
-    if demand_type == 'vehicle':
-        original_demand = len(root.findall("trip"))
-    else:  # pedestrian
-        original_demand = len(root.findall(".//person"))
-    
-    if original_demand == 0:
-        raise ValueError(f"No {demand_type} demand found in the input file")
-    
-    # Calculate the time span of the original demand
-    if demand_type == 'vehicle':
-        elements = root.findall("trip")
-    else:
-        elements = root.findall(".//person")
+    # Calculate the original demand from the input file (compiled demand table, see demand_table.py)
+    departs = load_demand_table(input_file, demand_type)['depart']
+    original_demand = len(departs)
     
     # Find the start and end time of the demand
-    start_time = min(float(elem.get('depart')) for elem in elements)
-    end_time = max(float(elem.get('depart')) for elem in elements)
+    start_time = float(departs.min())
+    end_time = float(departs.max())
     time_span = (end_time - start_time) / 3600  # Convert to hours
     
     # Calculate the original demand per hour
@@ -59,98 +47,16 @@ def convert_demand_to_scale_factor(demand, demand_type, input_file):
 
 def scale_demand(input_file, output_file, scale_factor, demand_type):
     """
-    This function was causing some errors, so there is a new version as well.
+    Scale the demand in a trips file. Same output as the older versions (benchmark.scale_demand_dom and benchmark.scale_demand_streaming).
+    The trips file is compiled into a memory-mapped demand table once (demand_table.py), the scaling is done on arrays.
+    XML is only written at the end, the trips file is not parsed again.
     """
-    # Parse the XML file
-    tree = ET.parse(input_file)
-    root = tree.getroot()
-
-    if demand_type == "vehicle":
-        # Vehicle demand
-        trips = root.findall("trip")
-        for trip in trips:
-            current_depart = float(trip.get('depart'))
-            new_depart = current_depart / scale_factor
-            trip.set('depart', f"{new_depart:.2f}")
-
-        original_trip_count = len(trips)
-        for i in range(1, int(scale_factor)):
-            for trip in trips[:original_trip_count]:
-                new_trip = ET.Element('trip')
-                for attr, value in trip.attrib.items():
-                    if attr == 'id':
-                        new_trip.set(attr, f"{value}_{i}")
-                    elif attr == 'depart':
-                        new_depart = float(value) + (3600 * i / scale_factor)
-                        new_trip.set(attr, f"{new_depart:.2f}")
-                    else:
-                        new_trip.set(attr, value)
-                root.append(new_trip)
-
-    elif demand_type == "pedestrian":
-        # Pedestrian demand
-        persons = root.findall(".//person")
-        for person in persons:
-            current_depart = float(person.get('depart'))
-            new_depart = current_depart / scale_factor
-            person.set('depart', f"{new_depart:.2f}")
-
-        original_person_count = len(persons)
-        for i in range(1, int(scale_factor)):
-            for person in persons[:original_person_count]:
-                new_person = ET.Element('person')
-                for attr, value in person.attrib.items():
-                    if attr == 'id':
-                        new_person.set(attr, f"{value}_{i}")
-                    elif attr == 'depart':
-                        new_depart = float(value) + (3600 * i / scale_factor)
-                        new_person.set(attr, f"{new_depart:.2f}")
-                    else:
-                        new_person.set(attr, value)
-                
-                # Copy all child elements (like <walk>)
-                for child in person:
-                    new_child = ET.SubElement(new_person, child.tag, child.attrib)
-                    # Ensure 'from' attribute is present for walk elements
-                    if child.tag == 'walk' and 'from' not in child.attrib:
-                        # If 'from' is missing, use the first edge in the route
-                        edges = child.get('edges', '').split()
-                        if edges:
-                            new_child.set('from', edges[0])
-                        else:
-                            logging.warning(f"Walk element for person {new_person.get('id')} is missing both 'from' and 'edges' attributes.")
-                
-                # Find the correct parent to append the new person
-                parent = root.find(".//routes")
-                if parent is None:
-                    parent = root
-                parent.append(new_person)
-
-    else:
+    if demand_type not in ['vehicle', 'pedestrian']:
         print("Invalid demand type. Please specify 'vehicle' or 'pedestrian'.")
         return
 
-    # Convert to string
-    xml_str = ET.tostring(root, encoding='unicode')
-   
-    # Pretty print the XML string
-    dom = xml.dom.minidom.parseString(xml_str)
-    pretty_xml_str = dom.toprettyxml(indent="    ")
-   
-    # Remove extra newlines between elements
-    pretty_xml_str = '\n'.join([line for line in pretty_xml_str.split('\n') if line.strip()])
-    
-    # If there are folders in the path that dont exist, create them
-    os.makedirs(os.path.dirname(output_file), exist_ok=True)
-
-    # Write the formatted XML to the output file
-    with open(output_file, 'w', encoding='utf-8') as f:
-        f.write(pretty_xml_str)
-    
-    print(f"{demand_type.capitalize()} demand scaled by factor {scale_factor}.") # Output written to {output_file}")
-    
-    # Wait for the file writing operations to finish (it could be large)
-    time.sleep(2)
+    write_scaled_demand(load_demand_table(input_file, demand_type), output_file, scale_factor, demand_type)
+    print(f"{demand_type.capitalize()} demand scaled by factor {scale_factor}.")
 
 
 def find_connecting_edges(net, start_edge_id, end_edge_id):
@@ -183,14 +89,16 @@ def find_connecting_edges(net, start_edge_id, end_edge_id):
     
     return None  # No path found
 
-def create_new_sumocfg(network_iteration):
+def create_new_sumocfg(network_iteration, config_path='./SUMO_files/iterative_craver.sumocfg', network_dir='./SUMO_files/network_iterations'):
     """
     Need to iteratively load a new net file.
+    Paths in a sumocfg are relative to the sumocfg. The logs are written next to it (each worker has its own sumocfg in the run workspace, see workspace.py).
     """
+    net_file = os.path.relpath(os.path.join(network_dir, f"network_iteration_{network_iteration}.net.xml"), os.path.dirname(os.path.abspath(config_path)))
     config_content = f"""<?xml version="1.0" encoding="UTF-8"?>
                         <configuration>
                             <input>
-                                <net-file value="network_iterations/network_iteration_{network_iteration}.net.xml"/>
+                                <net-file value="{net_file}"/>
                             </input>
                             <output>
                                 <log value="sumo_logfile.txt"/>
@@ -198,9 +106,11 @@ def create_new_sumocfg(network_iteration):
                             </output>
                         </configuration>"""
     
-    temp_config_path = './SUMO_files/iterative_craver.sumocfg'
-    with open(temp_config_path, 'w') as f:
+    temp_config_path = config_path
+    # Multiple envs (processes or threads) write this file. Write to a temporary file and rename it (atomic), SUMO never reads a partial file.
+    with open(f"{temp_config_path}.{os.getpid()}_{threading.get_ident()}.tmp", 'w') as f:
         f.write(config_content)
+    os.replace(f.name, temp_config_path)
 
 def modify_net_file(crosswalks_to_disable, net_file_path):
     """
@@ -476,27 +386,46 @@ def get_initial_veh_edge_config(edges_dict, node_coords):
                 }
     return veh_edges
 
-def get_new_veh_edges_connections(middle_nodes_to_add, networkx_graph, original_edg_file, original_nod_file, conn_root):
+def get_new_veh_edges_connections(middle_nodes_to_add, networkx_graph, original_network, conn_root):
     """
     Find which vehicle edges to remove and which to add (use x-coordinate of middle node to find intersecting edges that are split) .
     Update the connection root to reflect the new connections.
-    """
+    original_network: the original component files in memory (PlainNetwork), only read.
 
-    # Create a dictionary of node coordinates 
-    node_coords = {}
-    for node in ET.parse(original_nod_file).getroot().findall('node'):
-        node_coords[node.get('id')] = round(float(node.get('x')), 2)
+    Same output as the earlier version that went through all corridor edges for every middle node and through all connections (and all earlier middle nodes) for every split
+    (kept as the reference in tests/test_veh_edge_splitting.py). Here:
+    - The corridor edges that are not split (yet) are kept sorted by x-range, per direction. They form a chain (no overlaps), so the edge of a middle node is found with bisect.
+    - Connections are indexed by the edges they refer to (updated with every split). conn_root is only rebuilt at the end.
+    - The mapping sides of earlier middle nodes are indexed by the edge they refer to as well.
+    """
+    node_coords = original_network.get_node_coordinates()
+    iterative_edges = get_initial_veh_edge_config(original_network.edges, node_coords) # Initialize iterative_edges with initial edge config.
 
-    edges_dict = {edge.get('id'): edge for edge in ET.parse(original_edg_file).getroot().findall('edge')}
-    iterative_edges = get_initial_veh_edge_config(edges_dict, node_coords) # Initialize iterative_edges with initial edge config.
+    # The edges that can be split: sorted (lower x, upper x, edge id). A middle node at x splits the edge with lower < x < upper.
+    # The directions are reversed in top and bottom. For top, greater than `to` and less than `from`. For bottom, greater than `from` and less than `to`.
+    intervals = {}
+    for direction in ['top', 'bottom']:
+        ranges = []
+        for edge_id, edge_data in iterative_edges[direction].items():
+            lower, upper = (edge_data['to_x'], edge_data['from_x']) if direction == 'top' else (edge_data['from_x'], edge_data['to_x'])
+            if lower < upper: # Otherwise nothing can fall inside
+                ranges.append((lower, upper, edge_id))
+        ranges.sort()
+        for previous, current in zip(ranges, ranges[1:]):
+            if current[0] < previous[1]:
+                raise ValueError(f"The {direction} corridor edges {previous[2]} and {current[2]} overlap.")
+        intervals[direction] = ranges
+
+    # Connections by edge id (from and to), in the order of conn_root.
+    connections_by_edge = {}
+    def index_connection(connection):
+        for edge_id in {connection.get('from'), connection.get('to')}:
+            connections_by_edge.setdefault(edge_id, []).append(connection)
 
-    all_edges = {} # also contain all the connected vehicle edges outside the corridor.
-    for edge_id in edges_dict.keys():
-        attributes_dict = edges_dict[edge_id].attrib # only from and to will be used
-        # Add from_x and to_x to the attributes_dict
-        attributes_dict['from_x'] = node_coords[attributes_dict['from']]
-        attributes_dict['to_x'] = node_coords[attributes_dict['to']]
-        all_edges[edge_id] = attributes_dict
+    for connection in conn_root.findall('connection'):
+        index_connection(connection)
+    removed_connections = set() # ids of the connection elements to drop from conn_root
+    appended_connections = []
 
     edges_to_remove = []
     edges_to_add = {'top': {}, 'bottom': {}}
@@ -508,186 +437,85 @@ def get_new_veh_edges_connections(middle_nodes_to_add, networkx_graph, original_
             'bottom': {'from': None, 'to': None}
         } for m_node in middle_nodes_to_add
     }
+    mapping_sides = {'top': {}, 'bottom': {}} # edge id -> [(middle node, 'from'/ 'to')] of the mappings that refer to it
 
-    # As multiple middle nodes can intersect with the same vehicle edge, the splitting of one old edge into multiple new edges has to happen iteratively (splitting one edge at a time).
-    # In the same process, the connections (in the conn file) need to change as we go. i.e., Find intersects for each middle node and then update the conn file.
-    # The old edge in a connection could either be a 'to' or a 'from' edge. 
-    for i in range(len(middle_nodes_to_add)):
-        m_node = middle_nodes_to_add[i]
+    for i, m_node in enumerate(middle_nodes_to_add):
         x_coord = round(networkx_graph.nodes[m_node]['pos'][0], 2)
-        
-        # Handle top edges and top connection
-        for edge_id, edge_data in list(iterative_edges['top'].items()): # convert to list first 
-            # The directions are reversed in top and bottom. For top, greater than `to` and less than `from`.
-            if (edge_data['to_x'] < x_coord < edge_data['from_x']) and edge_id not in edges_to_remove: 
 
-                print(f"Top edge {edge_id} intersects mnode {m_node} at x={x_coord:.2f}.")
-                edges_to_remove.append(edge_id)
-    
-                # Add new edges to edges_to_add
-                # Right part of split (from original from to middle)
-                right_edge_id_top = f"{edge_id}_right{i}" # The same edge can be split multiple times. Value of i not neceaasrily corresponding to number of times split.
-                right_edge_data = {
-                    'new_node': m_node,
-                    'from': edge_data['from'],
-                    'to': m_node,
-                    'from_x': round(edge_data['from_x'], 2),
-                    'to_x': x_coord,
-                }
-                
-                edges_to_add['top'][right_edge_id_top] = right_edge_data
-                iterative_edges['top'][right_edge_id_top] = right_edge_data # new_node attribute is extra here.
-                all_edges[right_edge_id_top] = right_edge_data # only from_x and to_x are used.
-
-                # Left part of split (from middle to original to)
-                left_edge_id_top = f"{edge_id}_left{i}" # The same edge can be split multiple times.
-                left_edge_data = {
-                    'new_node': m_node,
-                    'from': m_node,
-                    'to': edge_data['to'],
-                    'from_x': x_coord,
-                    'to_x': round(edge_data['to_x'], 2),
-                }
+        for direction in ['top', 'bottom']:
+            ranges = intervals[direction]
+            index = bisect.bisect_left(ranges, (x_coord,)) - 1 # The last edge with lower < x
+            if index < 0 or not x_coord < ranges[index][1]:
+                continue
+            edge_id = ranges[index][2]
+            edge_data = iterative_edges[direction][edge_id]
+
+            print(f"{direction.capitalize()} edge {edge_id} intersects mnode {m_node} at x={x_coord:.2f}.")
+            edges_to_remove.append(edge_id)
+
+            # The same edge can be split multiple times. Value of i not neceaasrily corresponding to number of times split.
+            right_edge_id, left_edge_id = f"{edge_id}_right{i}", f"{edge_id}_left{i}"
+            if direction == 'top': # Right part of split (from original from to middle), left part (from middle to original to)
+                right_edge_data = {'new_node': m_node, 'from': edge_data['from'], 'to': m_node, 'from_x': round(edge_data['from_x'], 2), 'to_x': x_coord}
+                left_edge_data = {'new_node': m_node, 'from': m_node, 'to': edge_data['to'], 'from_x': x_coord, 'to_x': round(edge_data['to_x'], 2)}
+            else: # In bottom, 'to' nodes are in the right, 'from' nodes are in the left
+                right_edge_data = {'new_node': m_node, 'to': edge_data['to'], 'from': m_node, 'from_x': x_coord, 'to_x': round(edge_data['to_x'], 2)}
+                left_edge_data = {'new_node': m_node, 'to': m_node, 'from': edge_data['from'], 'from_x': round(edge_data['from_x'], 2), 'to_x': x_coord}
+            edges_to_add[direction][right_edge_id] = right_edge_data
+            edges_to_add[direction][left_edge_id] = left_edge_data
+            iterative_edges[direction][right_edge_id] = right_edge_data
+            iterative_edges[direction][left_edge_id] = left_edge_data
+            if direction == 'top':
+                ranges[index:index + 1] = [(left_edge_data['to_x'], left_edge_data['from_x'], left_edge_id), (right_edge_data['to_x'], right_edge_data['from_x'], right_edge_id)]
+            else:
+                ranges[index:index + 1] = [(left_edge_data['from_x'], left_edge_data['to_x'], left_edge_id), (right_edge_data['from_x'], right_edge_data['to_x'], right_edge_id)]
+
+            # Current node mapping (for connections). On Top, connections go from right to left. On Bottom, from left to right.
+            # Earlier nodes that referred to the split edge: on top, a `from` edge is now the new left and a `to` edge the new right (the other way around on bottom).
+            new_from, new_to = (right_edge_id, left_edge_id) if direction == 'top' else (left_edge_id, right_edge_id)
+            for prev_node, side in mapping_sides[direction].pop(edge_id, []):
+                new_edge_id = new_to if side == 'from' else new_from
+                m_node_mapping[prev_node][direction][side] = new_edge_id
+                mapping_sides[direction].setdefault(new_edge_id, []).append((prev_node, side))
+            m_node_mapping[m_node][direction]['from'] = new_from
+            m_node_mapping[m_node][direction]['to'] = new_to
+            mapping_sides[direction].setdefault(new_from, []).append((m_node, 'from'))
+            mapping_sides[direction].setdefault(new_to, []).append((m_node, 'to'))
+
+            # Replace the connections that refer to the split edge (a connection from it now starts at new_to, a connection to it ends at new_from).
+            for connection in list(connections_by_edge.get(edge_id, [])):
+                if id(connection) in removed_connections:
+                    continue
+                from_edge, to_edge = connection.get('from'), connection.get('to') # Existing connection edge ids 
+                print(f"mnode {m_node} intersects {direction} edge {edge_id} at x={x_coord:.2f} and is ref in conn: {connection}.")
+                if edge_id == from_edge: 
+                    attributes = {'from': new_to, 'to': to_edge, 'fromLane': str(0), 'toLane': connection.get('toLane')}
+                else:
+                    attributes = {'from': from_edge, 'to': new_from, 'fromLane': connection.get('fromLane'), 'toLane': str(0)}
+
+                new_connection = ET.Element('connection', attributes)
+                new_connection.text = None  # Ensure there's no text content
+                new_connection.tail = "\n\t\t"
+                appended_connections.append(new_connection)
+                index_connection(new_connection)
+                removed_connections.add(id(connection))
 
-                edges_to_add['top'][left_edge_id_top] = left_edge_data
-                iterative_edges['top'][left_edge_id_top] = left_edge_data # new_node attribute is extra here.
-                all_edges[left_edge_id_top] = left_edge_data # only from_x and to_x are used.
-
-                # Update current node mapping (for connections). On Top, connections go from right to left.
-                m_node_mapping[m_node]['top']['from'] = right_edge_id_top
-                m_node_mapping[m_node]['top']['to'] = left_edge_id_top
-                
-                # Update previous nodes' mappings if they referenced this split edge
-                for prev_node in middle_nodes_to_add[:i]:  # Only look at nodes we've processed before
-                    prev_mapping = m_node_mapping[prev_node]['top']
-                    if prev_mapping['from'] == edge_id:
-                        prev_mapping['from'] = left_edge_id_top # If the previous `from` edge was split, the new left will connect to it.
-                    if prev_mapping['to'] == edge_id:
-                        prev_mapping['to'] = right_edge_id_top # Similar reasoning as above. Previous left will connect to new right.
-
-                # Now add new connections to conn_root and remove old connections.
-                for connection in conn_root.findall('connection'): # This root is updated later so find all works
-                    from_edge, to_edge = connection.get('from'), connection.get('to') # Existing connection edge ids 
-                    if from_edge == edge_id or to_edge == edge_id:
-                        print(f"mnode {m_node} intersects top edge {edge_id} at x={x_coord:.2f} and is ref in conn: {connection}.")
-
-                        if edge_id == from_edge: 
-                            attributes = {'from': left_edge_id_top  , 'to': to_edge, 'fromLane': str(0), 'toLane': connection.get('toLane')}
-                        else:
-                            attributes = {'from': from_edge, 'to': right_edge_id_top, 'fromLane': connection.get('fromLane'), 'toLane': str(0)}
-
-                        #print(f"Adding new connection: {attributes}")
-                        new_connection = ET.Element('connection', attributes)
-                        new_connection.text = None  # Ensure there's no text content
-                        new_connection.tail = "\n\t\t"
-                        conn_root.append(new_connection)
-                        conn_root.remove(connection) # remove old connection
-
-        # Check bottom edges and bottom connection
-        for edge_id, edge_data in list(iterative_edges['bottom'].items()):
-            # For bottom, greater than `from` and less than `to`.
-            if (edge_data['from_x'] < x_coord < edge_data['to_x']) and edge_id not in edges_to_remove:
-
-                print(f"Bottom edge {edge_id} intersects mnode {m_node} at x={x_coord:.2f}.")
-                edges_to_remove.append(edge_id) # Need to check both in top and bottom.
-                
-                # Add new edges to edges_to_add
-                # Right part of split (In bottom, 'to' nodes are in the right, 'from' nodes are in the left)
-                right_edge_id_bottom = f"{edge_id}_right{i}" # The same edge can be split multiple times.
-                right_edge_data = {
-                    'new_node': m_node,
-                    'to': edge_data['to'],
-                    'from': m_node,
-                    'from_x': x_coord,
-                    'to_x': round(edge_data['to_x'], 2),
-                }
-                edges_to_add['bottom'][right_edge_id_bottom] = right_edge_data
-                iterative_edges['bottom'][right_edge_id_bottom] = right_edge_data # new_node attribute is extra here.
-                all_edges[right_edge_id_bottom] = right_edge_data # only from_x and to_x are used.
-
-                # Left part of split
-                left_edge_id_bottom = f"{edge_id}_left{i}" # The same edge can be split multiple times.
-                left_edge_data = {
-                    'new_node': m_node,
-                    'to': m_node,
-                    'from': edge_data['from'],
-                    'from_x': round(edge_data['from_x'], 2),
-                    'to_x': x_coord,
-                }
-                edges_to_add['bottom'][left_edge_id_bottom] = left_edge_data
-                iterative_edges['bottom'][left_edge_id_bottom] = left_edge_data # new_node attribute is extra here.
-                all_edges[left_edge_id_bottom] = left_edge_data # only from_x and to_x are used.
-
-                # Update current node mapping (for connections). On Bottom, connections go from left to right.
-                m_node_mapping[m_node]['bottom']['from'] = left_edge_id_bottom
-                m_node_mapping[m_node]['bottom']['to'] = right_edge_id_bottom
-                
-                # Update previous nodes' mappings if they referenced this split edge
-                for prev_node in middle_nodes_to_add[:i]:  # Only look at nodes we've processed before
-                    prev_mapping = m_node_mapping[prev_node]['bottom']
-                    if prev_mapping['from'] == edge_id:
-                        prev_mapping['from'] = right_edge_id_bottom # If the previous `from` edge was split, the new right will connect to it. 
-                    if prev_mapping['to'] == edge_id:
-                        prev_mapping['to'] = left_edge_id_bottom # If the previous `to` edge was split, the new left will connect to it.
-
-                # Now add new connections to conn_root and remove old connections.
-                for connection in conn_root.findall('connection'): # This root is updated later so find all works.
-                    from_edge, to_edge = connection.get('from'), connection.get('to') # Existing connection edge ids 
-                    if from_edge == edge_id or to_edge == edge_id:
-                        print(f"mnode {m_node} intersects bottom edge {edge_id} at x={x_coord:.2f} and is ref in conn: {connection}.")
-
-                        if edge_id == from_edge: 
-                            attributes = {'from': right_edge_id_bottom, 'to': to_edge, 'fromLane': str(0), 'toLane': connection.get('toLane')}
-                        else:
-                            attributes = {'from': from_edge, 'to': left_edge_id_bottom, 'fromLane': connection.get('fromLane'), 'toLane': str(0)}
-                        
-                        #print(f"Adding new connection: {attributes}")
-                        new_connection = ET.Element('connection', attributes)
-                        new_connection.text = None  # Ensure there's no text content
-                        new_connection.tail  = "\n\t\t"
-                        conn_root.append(new_connection)
-                        conn_root.remove(connection)
-    
     # corrections.
     # We may have added a connection, but one of those edges may have gotten split later.
     # If a `from` or a `to` edge in a connection contains an edge in edges_to_remove, then we need to remove that connection.
-    for connection in conn_root.findall('connection'):
-        from_edge, to_edge = connection.get('from'), connection.get('to')
-        if from_edge in edges_to_remove or to_edge in edges_to_remove:
-            conn_root.remove(connection)
+    for edge_id in edges_to_remove:
+        for connection in connections_by_edge.get(edge_id, []):
+            removed_connections.add(id(connection))
+    if removed_connections:
+        conn_root[:] = [child for child in list(conn_root) + appended_connections if id(child) not in removed_connections] # New connections go to the end (in the order they were added)
 
     # If the edges are present in edges_to_remove, then they should not be present in edges_to_add (they may be because of a split of a split).
     for edge_id in edges_to_remove:
-        if edge_id in edges_to_add['top']:
-            del edges_to_add['top'][edge_id]
-        if edge_id in edges_to_add['bottom']:
-            del edges_to_add['bottom'][edge_id]
+        edges_to_add['top'].pop(edge_id, None)
+        edges_to_add['bottom'].pop(edge_id, None)
 
     # This edges_to_remove edge list will be used to remove edges from the edg file.
     # Hence Filter edges to remove that are not part of the original edges (edges that are split of a split will not be there).
     # Remove edges that have `right` or `left` in their id.
     edges_to_remove = [edge_id for edge_id in edges_to_remove if not 'right' in edge_id and not 'left' in edge_id]
     return edges_to_remove, edges_to_add, conn_root, m_node_mapping
-
-# Instead of setting the y-coordinate of the middle node as mid_point in networkx_graph, interpolation is used.
-def interpolate_y_coordinate(denorm_x_coordinate, horizontal_edges_veh_original_data):
-    """
-    Helper function to interpolate y-coordinate. 
-    top and bottom will have two coordinates. 
-
-    For both top and bottom: x-coordinate increases from left to right. y-coordinate increases from bottom to top.
-    """
-    coords = []
-    for direction in ['top', 'bottom']:
-        for _, edge_data in horizontal_edges_veh_original_data[direction].items():
-            print(edge_data)
-            if edge_data['from_x'] <= denorm_x_coordinate <= edge_data['to_x']:
-                sign = +1 if edge_data['to_x'] > edge_data['from_x'] else -1
-                percentage_of_x = (denorm_x_coordinate - edge_data['from_x']) / (edge_data['to_x'] - edge_data['from_x'])
-                
-                y_coord = edge_data['from_y'] + sign * percentage_of_x * (edge_data['to_y'] - edge_data['from_y'])
-                coords.append(y_coord)
-
-    return coords[0] # only top one
-
-
@@ -0,0 +1,82 @@
+import numpy as np
+import gymnasium as gym
+from concurrent.futures import ThreadPoolExecutor
+from control_env import ControlEnv
+
+class ControlVecEnv(gym.vector.VectorEnv):
+    """
+    Drives N ControlEnv (each with its own SUMO instance) from a single process.
+    - Each env talks to its SUMO over a labeled traci connection (traci.start(label=...)), the connections are independent of each other.
+    - step() first issues the step to all envs (step_async) and then collects the results (step_wait).
+    Each env runs in its own thread. While one thread waits for its SUMO to reply (socket I/O releases the GIL), the others keep going.
+    So the N SUMO processes simulate in parallel, and the policy can act on the batch of N states in a single forward pass (CNNActorCritic.act_batch).
+
+    Envs are not automatically reset when they are done (with early termination, see termination.py, they can end at different steps). Call reset() again.
+    libsumo cannot be used here (one simulation per process).
+    """
+
+    def __init__(self, control_args, num_envs, network_iteration=None, worker_id_offset=0):
+        self.envs = []
+        for i in range(num_envs):
+            worker_id = worker_id_offset + i # Unique per env across all processes (trips files and connection labels)
+            self.envs.append(ControlEnv(control_args, worker_id=worker_id, network_iteration=network_iteration, sumo_label=f"worker_{worker_id}"))
+
+        # gymnasium 0.29 (requirements.txt): sets num_envs, the single and the batched spaces and closed.
+        super().__init__(num_envs, self.envs[0].observation_space, self.envs[0].action_space)
+
+        self.executor = ThreadPoolExecutor(max_workers=num_envs)
+        self._futures = None
+
+    def reset_async(self, seed=None, options=None):
+        """
+        seed: an int (env i gets seed + i, as in gymnasium's vector envs), a list with one seed per env, or None.
+        """
+        if seed is None or isinstance(seed, int):
+            seeds = [None if seed is None else seed + i for i in range(self.num_envs)]
+        else:
+            seeds = list(seed)
+            if len(seeds) != self.num_envs:
+                raise ValueError(f"Got {len(seeds)} seeds for {self.num_envs} envs")
+        self._futures = [self.executor.submit(env.reset, seed=env_seed, options=options) for env, env_seed in zip(self.envs, seeds)]
+
+    def reset_wait(self, seed=None, options=None):
+        results = [future.result() for future in self._futures]
+        self._futures = None
+        observations = np.stack([observation for observation, _ in results])
+        infos = {'env_infos': [info for _, info in results]}
+        return observations, infos
+
+    def reset(self, seed=None, options=None):
+        """
+        options are passed to every env (e.g., {'network_iteration': n}). For seed, see reset_async.
+        """
+        self.reset_async(seed=seed, options=options)
+        return self.reset_wait(seed=seed, options=options)
+
+    def step_async(self, actions):
+        """
+        actions: (N, 3) tensor. Row i is the action for env i.
+        """
+        self._futures = [self.executor.submit(env.step, action) for env, action in zip(self.envs, actions)]
+
+    def step_wait(self):
+        results = [future.result() for future in self._futures]
+        self._futures = None
+        observations = np.stack([result[0] for result in results])
+        rewards = np.array([result[1] for result in results], dtype=np.float32)
+        terminations = np.array([result[2] for result in results], dtype=bool)
+        truncations = np.array([result[3] for result in results], dtype=bool)
+        infos = {'env_infos': [result[4] for result in results]}
+        return observations, rewards, terminations, truncations, infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self, **kwargs):
+        if self.closed:
+            return
+        for env in self.envs:
+            env.close()
+        self.executor.shutdown(wait=True)
+        self.closed = True
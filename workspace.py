@@ -0,0 +1,47 @@
+import os
+import shutil
+from datetime import datetime
+
+TMPFS_ROOT = "/dev/shm/urban_design" # In memory: the small files (sumocfg, logs, scaled trips, net iterations) never touch the disk
+DISK_ROOT = "./workspaces" # Fallback
+
+def get_workspace_root(root=None, min_free_mb=1024):
+    """
+    Where the run workspaces are created. root if given.
+    Otherwise /dev/shm (tmpfs) if it exists and has at least min_free_mb free, the disk otherwise.
+    """
+    if root is not None:
+        return os.path.expanduser(root)
+    tmpfs = os.path.dirname(TMPFS_ROOT)
+    if os.path.isdir(tmpfs) and os.access(tmpfs, os.W_OK) and shutil.disk_usage(tmpfs).free >= min_free_mb*1024*1024:
+        return TMPFS_ROOT
+    print(f"{tmpfs} is not available (or has less than {min_free_mb} MB free). Using {DISK_ROOT} for the workspace.")
+    return DISK_ROOT
+
+def create_run_workspace(root=None, run_id=None, min_free_mb=1024):
+    """
+    A new workspace for one training run: <root>/<run_id>. Everything the run writes and other runs must not touch goes here
+    (network iterations, component files, warm-up snapshots, netconvert log and a folder per worker).
+    run_id defaults to the start time and pid, so runs started in the same second do not collide.
+    """
+    if run_id is None:
+        run_id = f"{datetime.now().strftime('%b%d_%H-%M-%S')}_{os.getpid()}"
+    run_dir = os.path.abspath(os.path.join(get_workspace_root(root, min_free_mb), run_id))
+    os.makedirs(run_dir, exist_ok=True)
+    print(f"Run workspace: {run_dir}")
+    return run_dir
+
+def get_worker_workspace(run_dir, worker_id):
+    """
+    The folder of one worker (control env) in the run workspace: its sumocfg, SUMO logs and scaled trips.
+    """
+    worker_dir = os.path.join(run_dir, f"worker_{worker_id if worker_id is not None else 'main'}")
+    os.makedirs(worker_dir, exist_ok=True)
+    return worker_dir
+
+def remove_run_workspace(run_dir):
+    """
+    Delete the workspace at the end of the run (on tmpfs it holds memory).
+    """
+    shutil.rmtree(run_dir, ignore_errors=True)
+    print(f"Removed run workspace: {run_dir}")